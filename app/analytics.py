@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import date
+from functools import partial
+from typing import Any, Dict, Iterable, List, Optional
+
+from app.mirror import store_key
+from app.parsers import epoch_seconds
+from app.resilience import detach, remaining
+from app.shopify import ShopifyDeadlineExceeded
+
+# 商品IDがない明細（削除済み商品・カスタム明細）
+NO_PRODUCT = -1
+
+
+class SalesColumns:
+    """注文と明細を列ごとの配列で保持する。追加・更新はバッファに貯め、集計時にまとめて反映する。
+    同じ注文IDの注文は置き換える（編集・キャンセル・返金は orders/updated のWebhookで届く）"""
+
+    def __init__(self):
+        # numpy は読み込みに時間がかかるため、起動時ではなく列データを作るときに読み込む
+        import numpy as np
+
+        self.order_id = np.empty(0, dtype=np.int64)
+        self.created_at = np.empty(0, dtype="datetime64[s]")
+        self.total = np.empty(0, dtype=np.float64)
+        # 明細: 所属する注文の行番号、商品ID、数量、単価
+        self.line_order = np.empty(0, dtype=np.int64)
+        self.product_id = np.empty(0, dtype=np.int64)
+        self.quantity = np.empty(0, dtype=np.int64)
+        self.price = np.empty(0, dtype=np.float64)
+        self.titles: Dict[int, str] = {}
+        # 次に読み込むページのカーソル（注文はID順のため、続きが新しい注文になる）
+        self.cursor: Optional[str] = None
+        self.refreshed_at = 0.0
+        # 全注文から作り始めた時刻（作り直しの判定に使う）
+        self.built_at = time.time()
+        self._pending: List[Dict[str, Any]] = []
+
+    def __len__(self) -> int:
+        return len(self.order_id) + len(self._pending)
+
+    def upsert(self, orders: Iterable[Dict[str, Any]]) -> None:
+        self._pending.extend(orders)
+
+    def _remove(self, order_ids) -> None:
+        import numpy as np
+
+        keep = ~np.isin(self.order_id, order_ids)
+        if keep.all():
+            return
+        # 残る注文の新しい行番号に明細の参照を付け替える
+        row = np.cumsum(keep) - 1
+        line_keep = keep[self.line_order]
+        self.line_order = row[self.line_order[line_keep]]
+        self.product_id = self.product_id[line_keep]
+        self.quantity = self.quantity[line_keep]
+        self.price = self.price[line_keep]
+        self.order_id = self.order_id[keep]
+        self.created_at = self.created_at[keep]
+        self.total = self.total[keep]
+
+    def _flush(self) -> None:
+        import numpy as np
+
+        if not self._pending:
+            return
+        # 同じ注文が複数回届いた場合は最後のものを使い、反映済みの行は置き換える
+        orders = list({order["id"]: order for order in self._pending}.values())
+        self._pending = []
+        self._remove(np.fromiter((o["id"] for o in orders), np.int64, len(orders)))
+        offset = len(self.order_id)
+        lines = [(offset + i, item) for i, order in enumerate(orders) for item in order["items"]]
+        for _, item in lines:
+            if item["product_id"] is not None:
+                self.titles[item["product_id"]] = item["title"]
+
+        self.order_id = np.concatenate([self.order_id, np.fromiter((o["id"] for o in orders), np.int64, len(orders))])
+        self.created_at = np.concatenate([
+            self.created_at,
+            np.fromiter((epoch_seconds(o["created_at"]) for o in orders), np.int64, len(orders)).astype("datetime64[s]"),
+        ])
+        self.total = np.concatenate([self.total, np.fromiter((o["total_price"] or 0.0 for o in orders), np.float64, len(orders))])
+        self.line_order = np.concatenate([self.line_order, np.fromiter((i for i, _ in lines), np.int64, len(lines))])
+        self.product_id = np.concatenate([
+            self.product_id,
+            np.fromiter((NO_PRODUCT if item["product_id"] is None else item["product_id"] for _, item in lines), np.int64, len(lines)),
+        ])
+        self.quantity = np.concatenate([self.quantity, np.fromiter((item["quantity"] or 0 for _, item in lines), np.int64, len(lines))])
+        self.price = np.concatenate([self.price, np.fromiter((item["price"] or 0.0 for _, item in lines), np.float64, len(lines))])
+
+    def summarize(
+        self,
+        start: Optional[date] = None,
+        end: Optional[date] = None,
+        utc_offset_minutes: int = 0,
+        top_n: int = 10,
+    ) -> Dict[str, Any]:
+        """期間内の売上合計・注文数・平均注文額、日別売上、売上上位の商品を返す。
+        start, end はその日を含む。日付の区切りは utc_offset_minutes（例: 日本時間なら540）で指定する"""
+        import numpy as np
+
+        self._flush()
+        local_time = self.created_at + np.timedelta64(utc_offset_minutes, "m")
+        mask = np.ones(len(self.order_id), dtype=bool)
+        if start is not None:
+            mask &= local_time >= np.datetime64(start, "s")
+        if end is not None:
+            mask &= local_time < np.datetime64(end, "s") + np.timedelta64(1, "D")
+
+        totals = self.total[mask]
+        days, day_index = np.unique(local_time[mask].astype("datetime64[D]"), return_inverse=True)
+        revenue_by_day = np.bincount(day_index, weights=totals, minlength=len(days))
+        orders_by_day = np.bincount(day_index, minlength=len(days))
+
+        line_mask = mask[self.line_order] & (self.product_id != NO_PRODUCT)
+        products, product_index = np.unique(self.product_id[line_mask], return_inverse=True)
+        quantities = self.quantity[line_mask]
+        product_revenue = np.bincount(product_index, weights=quantities * self.price[line_mask], minlength=len(products))
+        product_quantity = np.bincount(product_index, weights=quantities, minlength=len(products))
+        top = np.argsort(-product_revenue, kind="stable")[:top_n]
+
+        order_count = int(mask.sum())
+        revenue = float(totals.sum())
+        return {
+            "orders": order_count,
+            "revenue": round(revenue, 2),
+            "average_order_value": round(revenue / order_count, 2) if order_count else 0.0,
+            "revenue_by_day": [
+                {"date": str(day), "orders": int(count), "revenue": round(float(amount), 2)}
+                for day, count, amount in zip(days, orders_by_day, revenue_by_day)
+            ],
+            "top_products": [
+                {
+                    "product_id": int(products[i]),
+                    "title": self.titles.get(int(products[i])),
+                    "quantity": int(product_quantity[i]),
+                    "revenue": round(float(product_revenue[i]), 2),
+                }
+                for i in top
+            ],
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        self._flush()
+        arrays = (self.order_id, self.created_at, self.total, self.line_order, self.product_id, self.quantity, self.price)
+        return {
+            "orders": len(self.order_id),
+            "line_items": len(self.line_order),
+            "bytes": int(sum(array.nbytes for array in arrays)),
+            "age": round(time.time() - self.refreshed_at, 1),
+        }
+
+
+def _log_load_failure(store: str, load: "asyncio.Future") -> None:
+    # 待っているリクエストがなくても失敗を記録する（次のリクエストで読み込み直す）
+    if not load.cancelled() and load.exception() is not None:
+        logging.error(f"Failed to load sales columns for {store}: {load.exception()}")
+
+
+class SalesColumnStore:
+    """ストアごとの列データ。前回のカーソル以降の注文だけをバックグラウンドで読み込んで追加する。
+    Webhookが届かなかった変更を取りこぼさないよう、rebuild_interval ごとに全注文から作り直す"""
+
+    def __init__(self, refresh_interval: float = 60.0, rebuild_interval: float = 3600.0):
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self._columns: Dict[str, SalesColumns] = {}
+        # 作り直し中の列データ（読み込み中に届いたWebhookも反映する）
+        self._building: Dict[str, SalesColumns] = {}
+        self._loads: Dict[str, "asyncio.Future"] = {}
+
+    async def get(self, client) -> SalesColumns:
+        """今の列データを返す。読み込みはリクエストの期限と切り離してバックグラウンドで行い、
+        初回（まだ列データがない場合）だけその完了を待つ"""
+        key = store_key(client.store)
+        columns = self._columns.get(key)
+        if columns is not None and time.time() - columns.refreshed_at < self.refresh_interval:
+            return columns
+        # 同じストアの読み込みは1つだけ実行する
+        load = self._loads.get(key)
+        if load is None or load.done():
+            load = self._loads[key] = detach(self._refresh(key, client, columns))
+            load.add_done_callback(partial(_log_load_failure, client.store))
+        if columns is not None:
+            return columns
+        # 期限を過ぎても読み込みは続け、次のリクエストで使う
+        left = remaining()
+        try:
+            await (asyncio.wait_for(asyncio.shield(load), max(left, 0)) if left is not None else asyncio.shield(load))
+        except asyncio.TimeoutError:
+            raise ShopifyDeadlineExceeded(f"Request deadline exceeded while loading sales columns for {client.store}")
+        return self._columns[key]
+
+    async def _refresh(self, key: str, client, columns: Optional[SalesColumns]) -> None:
+        if columns is not None and time.time() - columns.built_at < self.rebuild_interval:
+            await self._load_new_orders(client, columns)
+            return
+        # 初回と作り直しは新しい列データに読み込み、終わってから差し替える（それまでは今の列データで集計する）
+        rebuilt = self._building[key] = SalesColumns()
+        try:
+            await self._load_new_orders(client, rebuilt)
+            self._columns[key] = rebuilt
+        finally:
+            self._building.pop(key, None)
+
+    async def _load_new_orders(self, client, columns: SalesColumns) -> None:
+        started = time.perf_counter()
+        loaded = 0
+        async for rows in client.iter_orders(after=columns.cursor):
+            columns.upsert(order for _, order in rows)
+            # ページごとにカーソルを進め、途中で失敗しても読み込んだ分は残す
+            columns.cursor = rows[-1][0]
+            loaded += len(rows)
+        columns.refreshed_at = time.time()
+        if loaded:
+            logging.info(f"Loaded {loaded} orders into sales columns for {client.store} in {time.perf_counter() - started:.2f}s")
+
+    def upsert(self, store: str, orders: List[Dict[str, Any]]) -> None:
+        # 読み込み済み・作り直し中の列データにだけ反映する（未読み込みなら初回の読み込みで最新の注文から作られる）
+        key = store_key(store)
+        for columns in (self._columns.get(key), self._building.get(key)):
+            if columns is not None:
+                columns.upsert(orders)
+
+    def stats(self) -> Dict[str, Any]:
+        return {store: columns.stats() for store, columns in self._columns.items()}
+
+
+_sales_columns: Optional[SalesColumnStore] = None
+
+
+def get_sales_columns() -> SalesColumnStore:
+    global _sales_columns
+    if _sales_columns is None:
+        _sales_columns = SalesColumnStore(
+            refresh_interval=float(os.getenv("SALES_ANALYTICS_REFRESH_INTERVAL", "60")),
+            rebuild_interval=float(os.getenv("SALES_ANALYTICS_REBUILD_INTERVAL", "3600")),
+        )
+    return _sales_columns
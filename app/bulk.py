@@ -0,0 +1,199 @@
+import asyncio
+import json
+import logging
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+
+import httpx
+
+from app.graphql_query import (
+    m_bulk_operation_run_query,
+    q_get_bulk_operation,
+    q_bulk_orders,
+    q_bulk_products,
+    q_bulk_customers,
+)
+from app.mirror import MAX_BATCH_WRITES, store_key, write_records
+from app.parsers import parse_order, parse_product, parse_customer_profile
+from app.shopify import ShopifyClient
+
+# ジョブの進捗: shopify-bulk-jobs/{job_id}
+BULK_JOBS_COLLECTION = "shopify-bulk-jobs"
+
+POLL_INTERVAL = 2.0
+MAX_POLL_INTERVAL = 30.0
+POLL_TIMEOUT = 60 * 60
+DOWNLOAD_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+
+# resource -> (Bulkクエリ, 子ノードのGID種別 -> 親に戻すコネクション名, パーサ)
+BULK_RESOURCES: Dict[str, Tuple[str, Dict[str, str], Callable[[Dict[str, Any]], Dict[str, Any]]]] = {
+    "orders": (q_bulk_orders, {"LineItem": "lineItems"}, parse_order),
+    "products": (q_bulk_products, {"ProductVariant": "variants", "ProductImage": "images"}, parse_product),
+    "customers": (q_bulk_customers, {}, parse_customer_profile),
+}
+
+RUNNING_STATUSES = {"CREATED", "RUNNING", "CANCELING"}
+
+
+class BulkOperationError(Exception):
+    pass
+
+
+def _gid_type(gid: str) -> str:
+    # gid://shopify/LineItem/123 -> LineItem
+    return gid.split('/')[-2]
+
+
+async def assemble_records(
+    lines: AsyncIterator[str],
+    children: Dict[str, str],
+    skip_lines: int = 0,
+) -> AsyncIterator[Tuple[Dict[str, Any], int]]:
+    """JSONLを1行ずつ読み、__parentId で子ノードを親に戻したレコードを返す。
+    子は必ず親の後に出力されるため、次の親が現れた時点で前の親は完成している。
+    保持するのは組み立て中の親1件のみ。
+    (親ノード, 次の親の行番号) を返す。次の親の行番号は再開時にスキップする行数として使える"""
+    parent: Optional[Dict[str, Any]] = None
+    line_no = -1
+    async for line in lines:
+        if not line.strip():
+            continue
+        line_no += 1
+        if line_no < skip_lines:
+            continue
+        node = json.loads(line)
+        parent_id = node.pop("__parentId", None)
+        if parent_id is None:
+            if parent is not None:
+                yield parent, line_no
+            parent = node
+            for connection in children.values():
+                parent.setdefault(connection, {"edges": []})
+            continue
+        if parent is None or parent.get("id") != parent_id:
+            # 途中から再開した場合など、親が手元にない子は読み捨てる
+            logging.warning(f"Skipping orphan bulk row for parent {parent_id}")
+            continue
+        connection = children.get(_gid_type(node.get("id", "")))
+        if connection:
+            parent[connection]["edges"].append({"node": node})
+    if parent is not None:
+        yield parent, line_no + 1
+
+
+class BulkExportJob:
+    """bulkOperationRunQuery を投げ、完了を待ってJSONLをストリームで取り込み、
+    Firestoreのミラーへバッチ書き込みする。進捗はデータと同じバッチでチェックポイントとして保存し、
+    失敗した場合は同じ job_id で再実行すると続きから取り込む"""
+
+    def __init__(self, db, client: ShopifyClient, resource: str, job_id: Optional[str] = None):
+        if resource not in BULK_RESOURCES:
+            raise ValueError(f"Unsupported bulk resource: {resource}")
+        self.db = db
+        self.client = client
+        self.resource = resource
+        self.job_id = job_id or f"{store_key(client.store)}_{resource}"
+        self.job_ref = db.collection(BULK_JOBS_COLLECTION).document(self.job_id)
+
+    async def run(self, restart: bool = False) -> Dict[str, Any]:
+        state = await self._load_state()
+        # job_id は呼び出し元が指定できるため、他のストアのジョブ（署名付きURLを含む）を再開させない
+        if state and (store_key(state.get("store") or "") != self.client.store or state.get("resource") != self.resource):
+            raise ValueError(f"Job {self.job_id} belongs to another store or resource")
+        if restart or state.get("status") in (None, "completed", "failed"):
+            state = await self._submit()
+
+        if state["status"] == "submitted":
+            state = await self._wait_for_completion(state)
+
+        if state["status"] == "importing":
+            state = await self._import(state)
+        return state
+
+    async def _load_state(self) -> Dict[str, Any]:
+        snapshot = await asyncio.to_thread(self.job_ref.get)
+        return snapshot.to_dict() if snapshot.exists else {}
+
+    async def _save_state(self, **fields) -> Dict[str, Any]:
+        fields["updated_at"] = datetime.now(timezone.utc).isoformat()
+        await asyncio.to_thread(self.job_ref.set, fields, merge=True)
+        return (await self._load_state())
+
+    async def _submit(self) -> Dict[str, Any]:
+        query = BULK_RESOURCES[self.resource][0]
+        result = await self.client.execute_query(m_bulk_operation_run_query, {"query": query})
+        payload = (result.get("data") or {}).get("bulkOperationRunQuery") or {}
+        errors = payload.get("userErrors") or result.get("errors")
+        if errors or not payload.get("bulkOperation"):
+            raise BulkOperationError(f"Failed to submit bulk operation: {errors}")
+        operation = payload["bulkOperation"]
+        logging.info(f"Submitted bulk operation {operation['id']} for {self.client.store} {self.resource}")
+        return await self._save_state(
+            store=self.client.store,
+            resource=self.resource,
+            status="submitted",
+            bulk_operation_id=operation["id"],
+            url=None,
+            lines_committed=0,
+            records_written=0,
+            error=None,
+        )
+
+    async def _wait_for_completion(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        interval = POLL_INTERVAL
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + POLL_TIMEOUT
+        while True:
+            result = await self.client.execute_query(q_get_bulk_operation, {"id": state["bulk_operation_id"]})
+            operation = (result.get("data") or {}).get("node") or {}
+            status = operation.get("status")
+            if status == "COMPLETED":
+                if not operation.get("url"):
+                    # 対象が0件の場合はURLが返らない
+                    return await self._save_state(status="completed", object_count=0)
+                return await self._save_state(
+                    status="importing",
+                    url=operation["url"],
+                    object_count=int(operation.get("objectCount") or 0),
+                )
+            if status not in RUNNING_STATUSES:
+                await self._save_state(status="failed", error=f"{status}: {operation.get('errorCode')}")
+                raise BulkOperationError(f"Bulk operation {state['bulk_operation_id']} ended with {status}")
+            if loop.time() > deadline:
+                raise BulkOperationError(f"Timed out waiting for bulk operation {state['bulk_operation_id']}")
+            await asyncio.sleep(interval)
+            interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+
+    async def _import(self, state: Dict[str, Any]) -> Dict[str, Any]:
+        _, children, parse = BULK_RESOURCES[self.resource]
+        lines_committed = int(state.get("lines_committed") or 0)
+        records_written = int(state.get("records_written") or 0)
+        batch = []
+
+        async def commit(next_line: int) -> None:
+            nonlocal records_written, lines_committed
+            checkpoint = {
+                "lines_committed": next_line,
+                "records_written": records_written + len(batch),
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }
+            await asyncio.to_thread(
+                write_records, self.db, self.client.store, self.resource, batch, (self.job_ref, checkpoint)
+            )
+            records_written += len(batch)
+            lines_committed = next_line
+            batch.clear()
+
+        async with httpx.AsyncClient(timeout=DOWNLOAD_TIMEOUT) as http:
+            async with http.stream("GET", state["url"]) as response:
+                response.raise_for_status()
+                async for node, next_line in assemble_records(response.aiter_lines(), children, lines_committed):
+                    batch.append(parse(node))
+                    # チェックポイント用の1件を残して、1コミット500件以内に収める
+                    if len(batch) >= MAX_BATCH_WRITES - 1:
+                        await commit(next_line)
+                if batch:
+                    await commit(next_line)
+
+        logging.info(f"Imported {records_written} {self.resource} for {self.client.store}")
+        return await self._save_state(status="completed", lines_committed=lines_committed, records_written=records_written)
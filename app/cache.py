@@ -0,0 +1,251 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+
+from app.resilience import detach
+
+CACHE_PREFIX = "shopify-dify-tool:cache"
+
+# (値, 鮮度の期限, stale許容の期限, バイト数)
+_Entry = Tuple[Any, float, float, int]
+
+
+class LocalLRUCache:
+    """プロセス内のTTL付きLRU。件数とおおよそのバイト数の両方で上限を設ける"""
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[2] <= time.time():
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: str, entry: _Entry) -> None:
+        self.delete(key)
+        self._entries[key] = entry
+        self.total_bytes += entry[3]
+        while self._entries and (len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted[3]
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[3]
+
+    def delete_prefix(self, prefix: str) -> int:
+        keys = [key for key in self._entries if key.startswith(prefix)]
+        for key in keys:
+            self.delete(key)
+        return len(keys)
+
+
+class ResponseCache:
+    """Shopifyの読み取り結果のキャッシュ。
+    プロセス内LRU → Redis（全インスタンスで共有）の順に参照し、
+    鮮度切れでもstale期間内であれば古い値を返しつつバックグラウンドで更新する"""
+
+    def __init__(
+        self,
+        ttl: float = 60.0,
+        stale_ttl: float = 300.0,
+        max_entries: int = 1024,
+        max_bytes: int = 64 * 1024 * 1024,
+        redis_client: Any = None,
+        prefix: str = CACHE_PREFIX,
+    ):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.prefix = prefix
+        self.redis = redis_client
+        self.local = LocalLRUCache(max_entries=max_entries, max_bytes=max_bytes)
+        self._refreshing: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.redis_errors = 0
+
+    def make_key(self, store: str, query: str, variables: Optional[Dict[str, Any]] = None, scope: str = "") -> str:
+        # scope（アクセストークンの指紋など）を含め、別の認証情報のリクエストにキャッシュを返さない
+        digest = hashlib.sha256(
+            (scope + query + json.dumps(variables or {}, sort_keys=True, separators=(",", ":"))).encode("utf-8")
+        ).hexdigest()
+        return f"{self.prefix}:{store}:{digest}"
+
+    async def get_or_fetch(
+        self,
+        store: str,
+        query: str,
+        variables: Optional[Dict[str, Any]],
+        fetch: Callable[[], Awaitable[Any]],
+        cacheable: Callable[[Any], bool] = lambda value: True,
+        scope: str = "",
+    ) -> Any:
+        key = self.make_key(store, query, variables, scope)
+        now = time.time()
+
+        entry = self.local.get(key)
+        if entry is not None and entry[1] > now:
+            self.local_hits += 1
+            return entry[0]
+
+        if entry is None:
+            entry = await self._redis_get(key)
+            if entry is not None:
+                self.local.set(key, entry)
+                if entry[1] > now:
+                    self.redis_hits += 1
+                    return entry[0]
+
+        if entry is not None:
+            # stale-while-revalidate: 古い値を返し、更新は1件だけバックグラウンドで走らせる
+            self.stale_hits += 1
+            self._schedule_refresh(key, fetch, cacheable)
+            return entry[0]
+
+        self.misses += 1
+        value = await fetch()
+        if cacheable(value):
+            await self.set(key, value)
+        return value
+
+    async def set(self, key: str, value: Any) -> None:
+        raw = json.dumps(value, separators=(",", ":"))
+        now = time.time()
+        entry = (value, now + self.ttl, now + self.ttl + self.stale_ttl, len(raw))
+        self.local.set(key, entry)
+        if self.redis is not None:
+            try:
+                payload = json.dumps({"f": entry[1], "s": entry[2], "v": raw})
+                await self.redis.set(key, payload, ex=int(self.ttl + self.stale_ttl) + 1)
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"Redis cache write failed: {e}")
+
+    async def invalidate(self, store: Optional[str] = None) -> int:
+        """ストア単位（store=Noneなら全体）でキャッシュを破棄する"""
+        prefix = f"{self.prefix}:{store}:" if store else f"{self.prefix}:"
+        removed = self.local.delete_prefix(prefix)
+        if self.redis is not None:
+            try:
+                keys = []
+                async for key in self.redis.scan_iter(match=f"{prefix}*", count=500):
+                    keys.append(key)
+                    if len(keys) >= 500:
+                        removed += await self.redis.delete(*keys)
+                        keys = []
+                if keys:
+                    removed += await self.redis.delete(*keys)
+            except Exception as e:
+                self.redis_errors += 1
+                logging.warning(f"Redis cache invalidation failed: {e}")
+        return removed
+
+    async def _redis_get(self, key: str) -> Optional[_Entry]:
+        if self.redis is None:
+            return None
+        try:
+            payload = await self.redis.get(key)
+        except Exception as e:
+            self.redis_errors += 1
+            logging.warning(f"Redis cache read failed: {e}")
+            return None
+        if payload is None:
+            return None
+        data = json.loads(payload)
+        if data["s"] <= time.time():
+            return None
+        return (json.loads(data["v"]), data["f"], data["s"], len(data["v"]))
+
+    def _schedule_refresh(self, key: str, fetch: Callable[[], Awaitable[Any]], cacheable: Callable[[Any], bool]) -> None:
+        if key in self._refreshing:
+            return
+        self._refreshing.add(key)
+        task = detach(self._refresh(key, fetch, cacheable))
+        # タスクがGCされないよう参照を保持する
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, key: str, fetch: Callable[[], Awaitable[Any]], cacheable: Callable[[Any], bool]) -> None:
+        try:
+            value = await fetch()
+            if cacheable(value):
+                await self.set(key, value)
+                self.refreshes += 1
+        except Exception as e:
+            logging.warning(f"Background cache refresh failed: {e}")
+        finally:
+            self._refreshing.discard(key)
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.local_hits + self.redis_hits + self.stale_hits
+        lookups = hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "refreshes": self.refreshes,
+            "evictions": self.local.evictions,
+            "entries": len(self.local),
+            "bytes": self.local.total_bytes,
+            "redis_enabled": self.redis is not None,
+            "redis_errors": self.redis_errors,
+        }
+
+
+_response_cache: Optional[ResponseCache] = None
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        redis_url = os.getenv("REDIS_URL")
+        redis_client = None
+        if redis_url:
+            # redis の読み込みは起動時間に響くため、使う場合だけ読み込む
+            try:
+                import redis.asyncio as aioredis
+            except ImportError:
+                logging.warning("REDIS_URL is set but the redis package is not installed; using in-process cache only")
+            else:
+                redis_client = aioredis.from_url(redis_url)
+        _response_cache = ResponseCache(
+            ttl=float(os.getenv("SHOPIFY_CACHE_TTL", "60")),
+            stale_ttl=float(os.getenv("SHOPIFY_CACHE_STALE_TTL", "300")),
+            max_entries=int(os.getenv("SHOPIFY_CACHE_MAX_ENTRIES", "1024")),
+            max_bytes=int(os.getenv("SHOPIFY_CACHE_MAX_BYTES", str(64 * 1024 * 1024))),
+            redis_client=redis_client,
+        )
+    return _response_cache
+
+
+async def close_response_cache() -> None:
+    global _response_cache
+    cache, _response_cache = _response_cache, None
+    if cache is not None and cache.redis is not None:
+        await cache.redis.aclose()
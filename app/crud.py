@@ -1,47 +1,392 @@
-from fastapi import FastAPI, HTTPException, Query
-from app.models import Item, ItemCreate, Product, ShopifyCredentials, Order, Customer
-from app.database import get_firestore_client
-from typing import List, Optional, Dict, Any
-from datetime import datetime, timezone
-import json
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from app.models import (
+    Item,
+    ItemCreate,
+    ItemBatchCreate,
+    ItemBatchUpdate,
+    ItemBatchIds,
+    ItemBatchResponse,
+    Product,
+    ProductSearchResponse,
+    SalesAnalytics,
+    CustomerSummary,
+    FanoutRequest,
+    ShopifyCredentials,
+    Order,
+    Customer,
+)
+from app.database import get_db
+from typing import List, Literal, Optional, Dict, Any
+from datetime import date, datetime, timezone
+import asyncio
+import httpx
 import logging
-from app.shopify import ShopifyClient
+import time
+from contextlib import asynccontextmanager
+from app.shopify import (
+    ShopifyDeadlineExceeded,
+    ShopifyQueryError,
+    ShopifyThrottledError,
+    ShopifyUnavailableError,
+    get_shopify_client,
+    close_http_clients,
+    coalescing_stats,
+)
+from app.resilience import DEFAULT_DEADLINE, MAX_DEADLINE, detach, remaining, reset_deadline, resilience_stats, set_deadline
+from app.mirror import mirror_collection, read_records
+from app.parsers import epoch_seconds
+from app.rfm import SUMMARY_RESOURCE
+from app.search import get_search_indexes
+from app.analytics import get_sales_columns
+from app.fanout import fan_out
+from app.kb_export import DEFAULT_CHUNK_CHARS, MAX_CHUNK_CHARS, MIN_CHUNK_CHARS, KnowledgeBaseExport
+from app.pagination import decode_cursor, encode_cursor, ndjson_rows
+from app import metrics
+from app.request_log import configure_logging, request_id_from_headers, reset_request_id, set_request_id
+from app.responses import VALIDATE_RESPONSES, FastJSONResponse, dumps
+from app.startup import mark_ready, mark_response, startup_report, warm_up, warmup_enabled
+from app.query_builder import parse_fields_param
+from app.throttle import throttle_stats
+from app.cache import get_response_cache, close_response_cache
+from app.tasks import router as tasks_router
+from app.webhooks import close_webhook_queue, router as webhooks_router
 
-# FirestoreとRedisの初期化
-db = get_firestore_client()
+# Firestoreは最初に使うときに初期化する（get_db）。Shopifyだけを使うリクエストは google-cloud を読み込まない
+# RedisはShopifyレスポンスキャッシュ側で遅延初期化する: app/cache.py
 collection_name = "shopify-dify-tool"
+# /items のページサイズ上限と、射影で指定できるフィールド
+MAX_ITEMS_PAGE_SIZE = 1000
+ITEM_FIELDS = {"name", "description", "created_at", "updated_at"}
+# バッチ系エンドポイントの1リクエストあたりの上限と、Firestoreのバッチ書き込み上限
+MAX_ITEM_BATCH = 5000
+FIRESTORE_BATCH_LIMIT = 500
 
 app_name = "Shopify Dify Tool API"
 version = "1.0.0"
 
+# Shopify GraphQLの1ページあたりの上限
+MAX_PAGE_SIZE = 250
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+# バッチ取得で一度に指定できるIDの数
+MAX_BATCH_IDS = 250
+# 複数ストアへのファンアウトで全ストアの結果を待つ期限（秒）
+DEFAULT_FANOUT_TIMEOUT = 10.0
+MAX_FANOUT_TIMEOUT = 60.0
+# 全件を辿るため、X-Request-Timeout がなければ期限を設けないパス
+UNBOUNDED_PATHS = ("/tasks", "/shopify/kb/")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 接続の準備はバックグラウンドで行い、最初のリクエストを待たせない
+    warmup = detach(warm_up()) if warmup_enabled() else None
+    mark_ready()
+    yield
+    if warmup is not None and not warmup.done():
+        warmup.cancel()
+    # 未処理のWebhookを書き込んでから、ストアごとのShopifyコネクションプールとキャッシュ用のRedis接続を閉じる
+    await close_webhook_queue()
+    await close_http_clients()
+    await close_response_cache()
+
+def _decode_cursor(resource: str, cursor: Optional[str]) -> Optional[str]:
+    try:
+        return decode_cursor(resource, cursor)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+def _chunks(values: List[Any], size: int = FIRESTORE_BATCH_LIMIT):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def _check_batch_size(count: int):
+    if count == 0:
+        raise HTTPException(status_code=400, detail="No items specified.")
+    if count > MAX_ITEM_BATCH:
+        raise HTTPException(status_code=400, detail=f"Too many items (max {MAX_ITEM_BATCH}).")
+
+def _get_existing(refs) -> Dict[str, Any]:
+    # get_allで500件ずつまとめて取得し、存在するドキュメントだけをID -> データで返す
+    existing = {}
+    for chunk in _chunks(refs):
+        for snapshot in get_db().get_all(chunk):
+            if snapshot.exists:
+                existing[snapshot.id] = snapshot.to_dict()
+    return existing
+
+def _commit_in_chunks(operations, apply) -> Dict[str, str]:
+    """(ID, 操作対象) のリストを500件ずつのバッチ書き込みで反映する。
+    失敗したバッチに含まれるIDはエラー内容を返す"""
+    errors = {}
+    for chunk in _chunks(operations):
+        batch = get_db().batch()
+        for operation in chunk:
+            apply(batch, operation)
+        try:
+            batch.commit()
+        except Exception as e:
+            logging.error(f"Error committing item batch: {e}")
+            for operation in chunk:
+                errors[operation[0]] = str(e)
+    return errors
+
+def _parse_fields(resource: str, fields: Optional[str]):
+    try:
+        return parse_fields_param(resource, fields)
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+def _respond(data: Any, fields: Optional[tuple] = None):
+    # ShopifyClient が組み立てたdictはresponse_modelで検証し直さず、そのままorjsonで返す（件数が多いと検証の方が遅い）
+    # フィールドを絞った場合はレスポンスモデルの必須項目が欠けるため、検証しない
+    if fields is None and VALIDATE_RESPONSES:
+        return data
+    return FastJSONResponse(content=data)
+
+async def _verify_access(shopify_client):
+    # ミラーや検索インデックスはストア単位で保存しているため、このトークンがストアに対して有効な場合だけ返す
+    try:
+        await shopify_client.verify_access()
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code in (401, 403):
+            raise HTTPException(status_code=401, detail="Invalid Shopify credentials.")
+        raise
+    except ShopifyQueryError:
+        raise HTTPException(status_code=401, detail="Invalid Shopify credentials.")
+
+async def _read_mirror(shopify_client, resource: str, limit: int, fields: Optional[tuple], stream: bool):
+    if stream:
+        raise HTTPException(status_code=400, detail="stream is not supported with source=mirror.")
+    await _verify_access(shopify_client)
+    # Firestoreの読み取りは同期APIのため、イベントループを止めないようスレッドで実行する
+    return await asyncio.to_thread(lambda: read_records(get_db(), shopify_client.store, resource, limit, fields))
+
+def _request_deadline(request: Request) -> Optional[float]:
+    """X-Request-Timeout（秒）からShopify呼び出しの期限を決める。
+    /tasks・ナレッジベースの書き出しは長時間かかるため、ヘッダーがなければ期限を設けない
+    （ストリーミングはルートの依存関係 _stream_deadline で外す）"""
+    header = request.headers.get("X-Request-Timeout")
+    if header is None:
+        if request.url.path.startswith(UNBOUNDED_PATHS):
+            return None
+        return DEFAULT_DEADLINE
+    timeout = float(header)
+    if timeout <= 0:
+        raise ValueError("X-Request-Timeout must be positive")
+    return min(timeout, MAX_DEADLINE)
+
+async def _stream_deadline(request: Request, stream: bool = False) -> None:
+    # ストリーミングは全ページを辿るため、X-Request-Timeout がなければ期限を設けない。
+    # stream はFastAPIが解釈した値（1・yes・on なども真）で判定する。
+    # エンドポイントと同じコンテキストで期限を変えるため、async の依存関係にする
+    if stream and request.headers.get("X-Request-Timeout") is None:
+        set_deadline(None)
+
+def _shopify_error(e: Exception, detail: str) -> HTTPException:
+    # 再送しても解消しなかったShopify側の状態は、呼び出し元が判断できるステータスで返す
+    if isinstance(e, ShopifyThrottledError):
+        return HTTPException(status_code=429, detail=detail, headers={"Retry-After": "1"})
+    if isinstance(e, ShopifyUnavailableError):
+        return HTTPException(status_code=503, detail=detail, headers={"Retry-After": "5"})
+    if isinstance(e, ShopifyDeadlineExceeded):
+        return HTTPException(status_code=504, detail=detail)
+    return HTTPException(status_code=500, detail=detail)
+
+def _etag(update_time) -> str:
+    # ドキュメントの更新時刻（ナノ秒精度）をそのままETagにする
+    timestamp = update_time.timestamp_pb()
+    return f'"{timestamp.seconds}.{timestamp.nanos:09d}"'
+
+def _parse_etags(header: str) -> List[str]:
+    return [tag.strip().removeprefix("W/") for tag in header.split(",") if tag.strip()]
+
+def _write_precondition(if_match: Optional[str]):
+    # If-Matchがなければ存在することだけを前提条件にする
+    if not if_match or if_match.strip() == "*":
+        return get_db().write_option(exists=True)
+    tags = _parse_etags(if_match)
+    if len(tags) != 1:
+        raise HTTPException(status_code=400, detail="If-Match must contain a single ETag.")
+    from google.protobuf.timestamp_pb2 import Timestamp
+    try:
+        seconds, nanos = tags[0].strip('"').split(".")
+        return get_db().write_option(last_update_time=Timestamp(seconds=int(seconds), nanos=int(nanos)))
+    except ValueError:
+        raise HTTPException(status_code=412, detail="Invalid ETag")
+
 def create_app() -> FastAPI:
-    app = FastAPI(title=app_name, version=version)
+    app = FastAPI(title=app_name, version=version, lifespan=lifespan, default_response_class=FastJSONResponse)
+
+    configure_logging(logging.INFO)
 
-    logging.basicConfig(level=logging.INFO)
+    app.include_router(tasks_router)
+    app.include_router(webhooks_router)
+
+    @app.middleware("http")
+    async def apply_request_deadline(request: Request, call_next):
+        # リクエストの期限を設定し、以降のShopify呼び出し（接続・読み取り・レート制限の待ち）に引き継ぐ
+        try:
+            timeout = _request_deadline(request)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"detail": "Invalid X-Request-Timeout header."})
+        token = set_deadline(timeout)
+        try:
+            return await call_next(request)
+        finally:
+            reset_deadline(token)
+            mark_response()
+
+    @app.middleware("http")
+    async def observe_request(request: Request, call_next):
+        # 最も外側で、リクエストIDの付与とルートごとのレイテンシ・段階ごとの時間・レスポンスサイズを記録する
+        request_id = request_id_from_headers(request.headers)
+        id_token = set_request_id(request_id)
+        phases_token = metrics.start_request()
+        started = time.perf_counter()
+        status = 500
+        size = None
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            length = response.headers.get("content-length")
+            size = int(length) if length is not None else None
+            response.headers["X-Request-ID"] = request_id
+            return response
+        finally:
+            # パスパラメータごとに分かれないよう、ルートのテンプレートで集計する
+            route = request.scope.get("route")
+            metrics.finish_request(
+                phases_token,
+                getattr(route, "path", "unmatched"),
+                request.method,
+                status,
+                time.perf_counter() - started,
+                size,
+            )
+            reset_request_id(id_token)
+
+    @app.get("/metrics", include_in_schema=False)
+    def get_metrics():
+        # Prometheusのテキスト形式
+        return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
+
+    @app.get("/startup")
+    def get_startup_report():
+        # インポート・アプリ生成・ウォームアップの所要時間と、最初のレスポンスまでの時間（ミリ秒）
+        return startup_report()
 
     @app.post("/items", response_model=Item)
-    def create_item(item: ItemCreate):
+    def create_item(item: ItemCreate, response: Response):
         try:
             # Firestoreにデータを保存
-            doc_ref = db.collection(collection_name).document()
+            doc_ref = get_db().collection(collection_name).document()
             data = item.dict()
             created_at = datetime.now(timezone.utc)
             data["created_at"] = created_at.isoformat() 
-            doc_ref.set(data)
+            write_result = doc_ref.set(data)
+            response.headers["ETag"] = _etag(write_result.update_time)
 
             return {"id": doc_ref.id, **data}
         except Exception as e:
             logging.error(f"Error creating item: {e}")
             raise HTTPException(status_code=500, detail="Failed to create item.")
 
+    @app.post("/items:batchCreate", response_model=ItemBatchResponse)
+    def batch_create_items(request: ItemBatchCreate):
+        _check_batch_size(len(request.items))
+        try:
+            created_at = datetime.now(timezone.utc).isoformat()
+            collection = get_db().collection(collection_name)
+            operations = []
+            for item in request.items:
+                doc_ref = collection.document()
+                operations.append((doc_ref.id, doc_ref, {**item.dict(), "created_at": created_at}))
+            errors = _commit_in_chunks(operations, lambda batch, op: batch.create(op[1], op[2]))
+            return {"results": [
+                {"id": doc_id, "status": "error", "error": errors[doc_id]} if doc_id in errors
+                else {"id": doc_id, "status": "ok", "item": {"id": doc_id, **data}}
+                for doc_id, _, data in operations
+            ]}
+        except Exception as e:
+            logging.error(f"Error batch creating items: {e}")
+            raise HTTPException(status_code=500, detail="Failed to create items.")
+
+    @app.post("/items:batchGet", response_model=ItemBatchResponse)
+    def batch_get_items(request: ItemBatchIds):
+        _check_batch_size(len(request.ids))
+        try:
+            collection = get_db().collection(collection_name)
+            existing = _get_existing([collection.document(item_id) for item_id in dict.fromkeys(request.ids)])
+            return {"results": [
+                {"id": item_id, "status": "ok", "item": {"id": item_id, **existing[item_id]}} if item_id in existing
+                else {"id": item_id, "status": "not_found"}
+                for item_id in request.ids
+            ]}
+        except Exception as e:
+            logging.error(f"Error batch retrieving items: {e}")
+            raise HTTPException(status_code=500, detail="Failed to retrieve items.")
+
+    @app.post("/items:batchUpdate", response_model=ItemBatchResponse)
+    def batch_update_items(request: ItemBatchUpdate):
+        _check_batch_size(len(request.items))
+        try:
+            updated_at = datetime.now(timezone.utc).isoformat()
+            collection = get_db().collection(collection_name)
+            # 存在確認をget_allでまとめて行い、存在するものだけを更新する
+            existing = _get_existing([collection.document(entry.id) for entry in request.items])
+            # 同じIDが複数回指定された場合は最後の内容を採用する
+            updated = {
+                entry.id: {**entry.dict(exclude={"id"}), "updated_at": updated_at}
+                for entry in request.items if entry.id in existing
+            }
+            operations = [(doc_id, collection.document(doc_id), data) for doc_id, data in updated.items()]
+            errors = _commit_in_chunks(operations, lambda batch, op: batch.update(op[1], op[2]))
+            results = []
+            for entry in request.items:
+                if entry.id not in existing:
+                    results.append({"id": entry.id, "status": "not_found"})
+                elif entry.id in errors:
+                    results.append({"id": entry.id, "status": "error", "error": errors[entry.id]})
+                else:
+                    item = {"id": entry.id, "created_at": existing[entry.id].get("created_at"), **updated[entry.id]}
+                    results.append({"id": entry.id, "status": "ok", "item": item})
+            return {"results": results}
+        except Exception as e:
+            logging.error(f"Error batch updating items: {e}")
+            raise HTTPException(status_code=500, detail="Failed to update items.")
+
+    @app.post("/items:batchDelete", response_model=ItemBatchResponse)
+    def batch_delete_items(request: ItemBatchIds):
+        _check_batch_size(len(request.ids))
+        try:
+            collection = get_db().collection(collection_name)
+            ids = list(dict.fromkeys(request.ids))
+            existing = _get_existing([collection.document(item_id) for item_id in ids])
+            operations = [(item_id, collection.document(item_id)) for item_id in ids if item_id in existing]
+            errors = _commit_in_chunks(operations, lambda batch, op: batch.delete(op[1]))
+            return {"results": [
+                {"id": item_id, "status": "not_found"} if item_id not in existing
+                else {"id": item_id, "status": "error", "error": errors[item_id]} if item_id in errors
+                else {"id": item_id, "status": "ok"}
+                for item_id in request.ids
+            ]}
+        except Exception as e:
+            logging.error(f"Error batch deleting items: {e}")
+            raise HTTPException(status_code=500, detail="Failed to delete items.")
+
     @app.get("/items/{item_id}", response_model=Item)
-    def get_item(item_id: str):
+    def get_item(item_id: str, response: Response, if_none_match: Optional[str] = Header(default=None)):
         try:
             # Firestoreからデータを取得
-            doc = db.collection(collection_name).document(item_id).get()
+            doc = get_db().collection(collection_name).document(item_id).get()
             if not doc.exists:
                 raise HTTPException(status_code=404, detail="Item not found")
 
+            etag = _etag(doc.update_time)
+            if if_none_match and (if_none_match.strip() == "*" or etag in _parse_etags(if_none_match)):
+                return Response(status_code=304, headers={"ETag": etag})
+            response.headers["ETag"] = etag
+
             data = doc.to_dict()
             return {"id": doc.id, **data}
         except HTTPException as he:
@@ -51,32 +396,83 @@ def create_app() -> FastAPI:
             raise HTTPException(status_code=500, detail="Failed to retrieve item.")
 
     @app.get("/items", response_model=List[Item])
-    def list_items():
+    def list_items(
+        response: Response,
+        limit: int = Query(default=100, ge=1, le=MAX_ITEMS_PAGE_SIZE),
+        start_after: Optional[str] = Query(default=None, description="前ページのレスポンスヘッダ X-Next-Cursor の値"),
+        order_by: Literal["name", "created_at", "updated_at"] = Query(default="created_at", description="updated_atで並べた場合、未更新のアイテムは含まれません"),
+        direction: Literal["asc", "desc"] = Query(default="asc"),
+        name: Optional[str] = Query(default=None),
+        created_after: Optional[str] = Query(default=None),
+        created_before: Optional[str] = Query(default=None),
+        updated_after: Optional[str] = Query(default=None),
+        updated_before: Optional[str] = Query(default=None),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: name,created_at）"),
+    ):
+        # 範囲条件はFirestoreの制約上、並び順と同じフィールドにのみ指定できる
+        ranges = {
+            "created_at": (created_after, created_before),
+            "updated_at": (updated_after, updated_before),
+        }
+        range_fields = [field for field, bounds in ranges.items() if any(bounds)]
+        if range_fields and range_fields != [order_by]:
+            raise HTTPException(status_code=400, detail="Range filters must be on the order_by field.")
+
+        cursor_scope = f"items:{order_by}:{direction}"
+        cursor = _decode_cursor(cursor_scope, start_after)
+        from google.cloud.firestore_v1.base_query import FieldFilter
         try:
-            # Firestoreからデータを取得
-            docs = db.collection(collection_name).stream()
-            items = [{"id": doc.id, **doc.to_dict()} for doc in docs]
+            firestore_direction = "DESCENDING" if direction == "desc" else "ASCENDING"
+            query = get_db().collection(collection_name)
+            if name is not None:
+                query = query.where(filter=FieldFilter("name", "==", name))
+            lower, upper = ranges.get(order_by, (None, None))
+            if lower is not None:
+                query = query.where(filter=FieldFilter(order_by, ">", lower))
+            if upper is not None:
+                query = query.where(filter=FieldFilter(order_by, "<", upper))
+            # 同じ値のアイテムがページ境界で欠けないよう、ドキュメントIDを第2キーにする
+            query = query.order_by(order_by, direction=firestore_direction).order_by("__name__", direction=firestore_direction)
+            if cursor:
+                query = query.start_after({order_by: cursor[0], "__name__": cursor[1]})
+            if fields:
+                selected = {field.strip() for field in fields.split(",") if field.strip()}
+                unknown = selected - ITEM_FIELDS
+                if unknown:
+                    raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}")
+                # nameはレスポンスモデルの必須項目、order_byのフィールドは次ページのカーソルに必要
+                query = query.select(sorted(selected | {"name", order_by}))
+            query = query.limit(limit)
+
+            items = [{"id": doc.id, **doc.to_dict()} for doc in query.stream()]
+            if len(items) == limit:
+                last = items[-1]
+                response.headers["X-Next-Cursor"] = encode_cursor(cursor_scope, [last.get(order_by), last["id"]])
             return items
+        except HTTPException as he:
+            raise he
         except Exception as e:
             logging.error(f"Error listing items: {e}")
             raise HTTPException(status_code=500, detail="Failed to list items.")
 
     @app.put("/items/{item_id}", response_model=Item)
-    def update_item(item_id: str, item: ItemCreate):
+    def update_item(item_id: str, item: ItemCreate, response: Response, if_match: Optional[str] = Header(default=None)):
+        # google-cloud は起動を遅くするため、Firestoreを使うルートで読み込む
+        from google.api_core.exceptions import FailedPrecondition, NotFound
         try:
-            # Firestoreドキュメントを更新
-            doc_ref = db.collection(collection_name).document(item_id)
-            if not doc_ref.get().exists:
-                raise HTTPException(status_code=404, detail="Item not found")
-    
+            # 存在確認と競合検出は書き込みの前提条件で行い、1回のRPCで更新する
+            doc_ref = get_db().collection(collection_name).document(item_id)
             data = item.dict()
             updated_at = datetime.now(timezone.utc)
             data["updated_at"] = updated_at.isoformat() 
-            doc_ref.update(data)
-            # 更新前のcreated_atを取得
-            doc = doc_ref.get()
-            created_at = doc.to_dict().get("created_at")
-            return {"id": item_id, "created_at": created_at, **data}
+            write_result = doc_ref.update(data, option=_write_precondition(if_match))
+            response.headers["ETag"] = _etag(write_result.update_time)
+            # created_atは読み直さない（必要な場合はGETで取得する）
+            return {"id": item_id, **data}
+        except NotFound:
+            raise HTTPException(status_code=404, detail="Item not found")
+        except FailedPrecondition:
+            raise HTTPException(status_code=412, detail="Item has been modified")
         except HTTPException as he:
             raise he
         except Exception as e:
@@ -84,96 +480,379 @@ def create_app() -> FastAPI:
             raise HTTPException(status_code=500, detail="Failed to update item.")
 
     @app.delete("/items/{item_id}")
-    def delete_item(item_id: str):
+    def delete_item(item_id: str, if_match: Optional[str] = Header(default=None)):
+        from google.api_core.exceptions import FailedPrecondition, NotFound
         try:
-            # Firestoreのドキュメントを削除
-            doc_ref = db.collection(collection_name).document(item_id)
-            if not doc_ref.get().exists:
-                raise HTTPException(status_code=404, detail="Item not found")
-            doc_ref.delete()
+            # Firestoreのドキュメントを削除（存在しない場合は前提条件エラーになる）
+            doc_ref = get_db().collection(collection_name).document(item_id)
+            doc_ref.delete(option=_write_precondition(if_match))
 
             return {"message": "Item deleted successfully"}
+        except NotFound:
+            raise HTTPException(status_code=404, detail="Item not found")
+        except FailedPrecondition:
+            raise HTTPException(status_code=412, detail="Item has been modified")
         except HTTPException as he:
             raise he
         except Exception as e:
             logging.error(f"Error deleting item {item_id}: {e}")
             raise HTTPException(status_code=500, detail="Failed to delete item.")
 
-    @app.post("/shopify/products", response_model=List[Product])
-    def list_shopify_products(credentials: ShopifyCredentials, limit: Optional[int] = Query(default=10)):
+    @app.post("/shopify/products", response_model=List[Product], dependencies=[Depends(_stream_deadline)])
+    async def list_shopify_products(
+        credentials: ShopifyCredentials,
+        limit: Optional[int] = Query(default=10),
+        stream: bool = Query(default=False, description="trueの場合、カーソルで全ページを辿りNDJSONで返す"),
+        cursor: Optional[str] = Query(default=None, description="stream時の再開カーソル（前回の行のcursor）"),
+        page_size: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        max_rows: Optional[int] = Query(default=None, ge=1),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: id,name,price）。指定したフィールドだけをShopifyから取得する"),
+        source: Literal["live", "mirror"] = Query(default="live", description="mirrorの場合、差分同期済みのFirestoreのミラーから返す"),
+    ):
+        selected = _parse_fields("products", fields)
         try:
-            shopify_client = ShopifyClient(
+            shopify_client = get_shopify_client(
                 access_token=credentials.access_token,
                 store_url=credentials.store_url
             )
-            products = shopify_client.get_products(first=limit)
-            return products
+            if source == "mirror":
+                return _respond(await _read_mirror(shopify_client, "products", limit, selected, stream), selected)
+            if stream:
+                after = _decode_cursor("products", cursor)
+                return StreamingResponse(
+                    ndjson_rows("products", shopify_client.iter_products(page_size=page_size, after=after, fields=selected), max_rows),
+                    media_type=NDJSON_MEDIA_TYPE,
+                )
+            products = await shopify_client.get_products(first=limit, fields=selected)
+            return _respond(products, selected)
+        except HTTPException as he:
+            raise he
         except Exception as e:
             logging.error(f"Error listing Shopify products: {e}")
-            raise HTTPException(status_code=500, detail="Failed to list products.")
+            raise _shopify_error(e, "Failed to list products.")
+
+    @app.post("/shopify/products:batchGet", response_model=List[Optional[Product]])
+    async def batch_get_shopify_products(
+        credentials: ShopifyCredentials,
+        ids: List[int] = Body(..., min_length=1, max_length=MAX_BATCH_IDS),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: id,name,price）。指定したフィールドだけをShopifyから取得する"),
+    ):
+        # 指定したIDの順に返す。存在しない商品はnull
+        selected = _parse_fields("products", fields)
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
+            )
+            return _respond(await shopify_client.get_products_by_ids(ids, fields=selected), selected)
+        except Exception as e:
+            logging.error(f"Error batch retrieving Shopify products: {e}")
+            raise _shopify_error(e, f"Failed to retrieve products: {str(e)}")
+
+    @app.post("/shopify/products/search", response_model=ProductSearchResponse)
+    async def search_shopify_products(
+        credentials: ShopifyCredentials,
+        q: str = Query(..., min_length=1, description="検索語（商品名・ハンドル・説明・価格が対象。日本語はbigramで部分一致）"),
+        limit: int = Query(default=10, ge=1, le=100),
+        offset: int = Query(default=0, ge=0),
+        min_price: Optional[float] = Query(default=None, ge=0),
+        max_price: Optional[float] = Query(default=None, ge=0),
+    ):
+        # /shopify/products/{product_id} より先に定義する
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
+            )
+            # インデックスはストア単位で共有するため、トークンを確認してから返す
+            await _verify_access(shopify_client)
+            index = await get_search_indexes().get(shopify_client)
+            total, hits = index.search(q, offset=offset, limit=limit, min_price=min_price, max_price=max_price)
+            return _respond({
+                "total": total,
+                "next_offset": offset + limit if offset + limit < total else None,
+                "results": [{"score": score, "product": product} for score, product in hits],
+            })
+        except HTTPException as he:
+            raise he
+        except Exception as e:
+            logging.error(f"Error searching Shopify products: {e}")
+            raise _shopify_error(e, "Failed to search products.")
+
+    @app.get("/shopify/products/search/stats")
+    async def get_search_index_stats():
+        return get_search_indexes().stats()
 
     @app.post("/shopify/products/{product_id}", response_model=Product)
-    def get_shopify_product(product_id: int, credentials: ShopifyCredentials):
+    async def get_shopify_product(
+        product_id: int,
+        credentials: ShopifyCredentials,
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: id,name,price）。指定したフィールドだけをShopifyから取得する"),
+    ):
+        selected = _parse_fields("products", fields)
         try:
-            shopify_client = ShopifyClient(
+            shopify_client = get_shopify_client(
                 access_token=credentials.access_token,
                 store_url=credentials.store_url
             )
-            product = shopify_client.get_product(product_id)
+            product = await shopify_client.get_product(product_id, fields=selected)
             if not product:
                 raise HTTPException(status_code=404, detail="Product not found")
-            return {"id": product.id, "name": product.title, "description": product.body_html}
+            return _respond(product, selected)
         except HTTPException as he:
             raise he
         except Exception as e:
             logging.error(f"Error retrieving Shopify product {product_id}: {e}")
-            raise HTTPException(status_code=500, detail="Failed to retrieve product.")
+            raise _shopify_error(e, "Failed to retrieve product.")
 
-    @app.post("/shopify/orders", response_model=List[Order])
+    @app.post("/shopify/orders", response_model=List[Order], dependencies=[Depends(_stream_deadline)])
     async def list_shopify_orders(
         credentials: ShopifyCredentials,
         first: Optional[int] = Query(default=100),
+        stream: bool = Query(default=False, description="trueの場合、カーソルで全ページを辿りNDJSONで返す"),
+        cursor: Optional[str] = Query(default=None, description="stream時の再開カーソル（前回の行のcursor）"),
+        page_size: int = Query(default=MAX_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        max_rows: Optional[int] = Query(default=None, ge=1),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: id,total_price）。指定したフィールドだけをShopifyから取得する"),
+        source: Literal["live", "mirror"] = Query(default="live", description="mirrorの場合、差分同期済みのFirestoreのミラーから返す"),
     ):
+        selected = _parse_fields("orders", fields)
         try:
-            shopify_client = ShopifyClient(
+            shopify_client = get_shopify_client(
                 access_token=credentials.access_token,
                 store_url=credentials.store_url
             )
+
+            if source == "mirror":
+                return _respond(await _read_mirror(shopify_client, "orders", first, selected, stream), selected)
+
+            if stream:
+                after = _decode_cursor("orders", cursor)
+                return StreamingResponse(
+                    ndjson_rows("orders", shopify_client.iter_orders(page_size=page_size, after=after, fields=selected), max_rows),
+                    media_type=NDJSON_MEDIA_TYPE,
+                )
             
-            orders = shopify_client.get_orders(first=first)
+            orders = await shopify_client.get_orders(first=first, fields=selected)
             
             # GraphQL APIからの応答をパース
-            return orders  # ShopifyClientクラスで既に正しい形式に変換されています
+            return _respond(orders, selected)  # ShopifyClientクラスで既に正しい形式に変換されています
+        except HTTPException as he:
+            raise he
         except Exception as e:
             logging.error(f"Error listing Shopify orders: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to list orders: {str(e)}"
+            raise _shopify_error(e, f"Failed to list orders: {str(e)}")
+
+    @app.post("/shopify/kb/export")
+    async def export_knowledge_base(
+        credentials: ShopifyCredentials,
+        resource: Literal["products", "orders"] = Query(default="products"),
+        dataset: str = Query(default="default", description="書き出し先のナレッジベース名。前回からの差分はデータセットごとに管理する"),
+        full: bool = Query(default=False, description="trueの場合、変更の有無にかかわらず全チャンクを返す"),
+        max_chars: int = Query(default=DEFAULT_CHUNK_CHARS, ge=MIN_CHUNK_CHARS, le=MAX_CHUNK_CHARS, description="1チャンクの最大文字数"),
+    ):
+        # 前回から追加・変更されたチャンクだけを gzip の NDJSON で返す（Difyのナレッジベースへの差分投入用）
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
             )
+            # マニフェストはストア単位で保存しているため、トークンが有効な場合だけ書き出す
+            await _verify_access(shopify_client)
+            export = KnowledgeBaseExport(get_db(), shopify_client, resource, dataset=dataset, max_chars=max_chars, full=full)
+            return StreamingResponse(
+                export.stream(),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers={"Content-Encoding": "gzip"},
+            )
+        except HTTPException as he:
+            raise he
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
+        except Exception as e:
+            logging.error(f"Error exporting knowledge base: {e}")
+            raise _shopify_error(e, "Failed to export knowledge base.")
+
+    @app.post("/shopify/analytics/sales", response_model=SalesAnalytics)
+    async def get_sales_analytics(
+        credentials: ShopifyCredentials,
+        start: Optional[date] = Query(default=None, description="集計開始日（この日を含む）"),
+        end: Optional[date] = Query(default=None, description="集計終了日（この日を含む）"),
+        utc_offset_minutes: int = Query(default=0, ge=-720, le=840, description="日付の区切りに使うUTCからの差（日本時間なら540）"),
+        top_n: int = Query(default=10, ge=1, le=100),
+    ):
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
+            )
+            # 列データはストア単位で共有するため、トークンを確認してから返す
+            await _verify_access(shopify_client)
+            columns = await get_sales_columns().get(shopify_client)
+            return _respond(columns.summarize(
+                start=start,
+                end=end,
+                utc_offset_minutes=utc_offset_minutes,
+                top_n=top_n,
+            ))
+        except HTTPException as he:
+            raise he
+        except Exception as e:
+            logging.error(f"Error computing sales analytics: {e}")
+            raise _shopify_error(e, "Failed to compute sales analytics.")
+
+    @app.get("/shopify/analytics/stats")
+    async def get_sales_analytics_stats():
+        return get_sales_columns().stats()
+
+    @app.post("/shopify/customers:batchGet", response_model=List[Optional[Customer]])
+    async def batch_get_customer_orders(
+        credentials: ShopifyCredentials,
+        ids: List[str] = Body(..., min_length=1, max_length=MAX_BATCH_IDS),
+        first: Optional[int] = Query(default=10),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: display_name,email）。指定したフィールドだけをShopifyから取得する"),
+    ):
+        # 指定したIDの順に返す。存在しない顧客はnull
+        selected = _parse_fields("customers", fields)
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
+            )
+            return _respond(await shopify_client.get_customers_by_ids(ids, first=first, fields=selected), selected)
+        except Exception as e:
+            logging.error(f"Error batch retrieving customer orders: {e}")
+            raise _shopify_error(e, f"Failed to retrieve customers: {str(e)}")
+
+    @app.post("/shopify/customers/{customer_id}/summary", response_model=CustomerSummary)
+    async def get_customer_summary(customer_id: int, credentials: ShopifyCredentials):
+        # バッチで集計済みのRFM・LTVを1ドキュメントの読み取りで返す
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
+            )
+            await _verify_access(shopify_client)
+            doc = await asyncio.to_thread(
+                lambda: mirror_collection(get_db(), shopify_client.store, SUMMARY_RESOURCE).document(str(customer_id)).get()
+            )
+            if not doc.exists:
+                raise HTTPException(status_code=404, detail="Customer summary not found")
+            summary = doc.to_dict()
+            # 最終購入からの日数は読み取り時点で計算し直す
+            summary["recency_days"] = round((time.time() - epoch_seconds(summary["last_order_at"])) / 86400, 1)
+            return summary
+        except HTTPException as he:
+            raise he
+        except Exception as e:
+            logging.error(f"Error retrieving customer summary {customer_id}: {e}")
+            raise _shopify_error(e, "Failed to retrieve customer summary.")
 
     @app.post("/shopify/customers/{customer_id}/orders", response_model=Customer)
     async def get_customer_orders(
         customer_id: str,
         credentials: ShopifyCredentials,
-        first: Optional[int] = Query(default=10)
+        first: Optional[int] = Query(default=10),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定（例: display_name,email）。指定したフィールドだけをShopifyから取得する"),
     ):
+        selected = _parse_fields("customers", fields)
         try:
-            shopify_client = ShopifyClient(
+            shopify_client = get_shopify_client(
                 access_token=credentials.access_token,
                 store_url=credentials.store_url
             )
             
-            orders = shopify_client.get_customer_orders(
+            orders = await shopify_client.get_customer_orders(
                 customer_id=customer_id,
-                first=first
+                first=first,
+                fields=selected
             )
             
-            return orders
+            return _respond(orders, selected)
         except Exception as e:
             logging.error(f"Error retrieving customer orders: {e}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Failed to retrieve customer orders: {str(e)}"
+            raise _shopify_error(e, f"Failed to retrieve customer orders: {str(e)}")
+
+    @app.post("/shopify/fanout/{resource}", dependencies=[Depends(_stream_deadline)])
+    async def fan_out_shopify_query(
+        resource: Literal["orders", "products", "customers"],
+        request: FanoutRequest,
+        first: int = Query(default=10, ge=1, le=MAX_PAGE_SIZE),
+        fields: Optional[str] = Query(default=None, description="返すフィールドをカンマ区切りで指定"),
+        timeout: float = Query(default=DEFAULT_FANOUT_TIMEOUT, gt=0, le=MAX_FANOUT_TIMEOUT, description="全ストアの結果を待つ期限（秒）。リクエストの期限より長くはならない"),
+        stream: bool = Query(default=False, description="trueの場合、ストアごとの結果を終わった順にNDJSONで返す"),
+    ):
+        # 複数ストアに同じクエリを並行して実行し、ストアごとの結果とエラーをまとめて返す
+        selected = _parse_fields(resource, fields)
+        if not request.stores:
+            raise HTTPException(status_code=400, detail="No stores specified.")
+        if len({store.store_url for store in request.stores}) != len(request.stores):
+            raise HTTPException(status_code=400, detail="Duplicate store_url in stores.")
+        if resource == "customers" and not request.ids:
+            raise HTTPException(status_code=400, detail="ids is required for customers.")
+        if request.ids and len(request.ids) > MAX_BATCH_IDS:
+            raise HTTPException(status_code=400, detail=f"Too many ids (max {MAX_BATCH_IDS}).")
+
+        async def call(shopify_client):
+            if resource == "orders":
+                return await shopify_client.get_orders(first=first, fields=selected)
+            if resource == "products":
+                return await shopify_client.get_products(first=first, fields=selected)
+            return await shopify_client.get_customers_by_ids(request.ids, first=first, fields=selected)
+
+        # リクエストの期限（X-Request-Timeout）を過ぎてから集めた結果は返せないため、期限の内側に収める
+        left = remaining()
+        if left is not None:
+            timeout = round(max(min(timeout, left), 0.0), 3)
+
+        if stream:
+            async def rows():
+                async for store, result in fan_out(request.stores, call, timeout):
+                    yield dumps({"store": store, **result}) + b"\n"
+            return StreamingResponse(rows(), media_type=NDJSON_MEDIA_TYPE)
+
+        started = time.perf_counter()
+        results = {store: result async for store, result in fan_out(request.stores, call, timeout)}
+        return FastJSONResponse(content={
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            # リクエストで指定したストアの順に並べる
+            "stores": {store.store_url: results[store.store_url] for store in request.stores},
+        })
+
+    @app.get("/shopify/throttle")
+    def get_shopify_throttle_stats():
+        # ストアごとのコストバケット残量・待ち行列・待ち時間・消費コスト
+        return throttle_stats()
+
+    @app.get("/shopify/coalescing")
+    def get_shopify_coalescing_stats():
+        # 実行中の同一クエリにまとめられたリクエスト数
+        return coalescing_stats()
+
+    @app.get("/shopify/resilience")
+    def get_shopify_resilience_stats():
+        # ストアごとの再送の予算とサーキットブレーカーの状態
+        return resilience_stats()
+
+    @app.get("/shopify/cache")
+    def get_shopify_cache_stats():
+        return get_response_cache().stats()
+
+    @app.post("/shopify/cache/invalidate")
+    async def invalidate_shopify_cache(credentials: ShopifyCredentials):
+        try:
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
             )
+            # キャッシュはストア単位で共有するため、トークンが有効な場合だけ破棄する
+            await _verify_access(shopify_client)
+            removed = await shopify_client.invalidate_cache()
+            return {"message": "Cache invalidated successfully", "removed": removed}
+        except HTTPException as he:
+            raise he
+        except Exception as e:
+            logging.error(f"Error invalidating Shopify cache: {e}")
+            raise _shopify_error(e, "Failed to invalidate cache.")
 
     return app
@@ -1,12 +1,21 @@
-from google.cloud import firestore
-from google.oauth2 import service_account
 import os
-from dotenv import load_dotenv
+from functools import lru_cache
 
-# .env ファイルをロード
-load_dotenv()
+# .env ファイルをロード（ローカル開発のみ。Cloud Run では環境変数が直接設定される）
+# 他のモジュールが読み込み時に環境変数を参照するため、ここでは遅延させない
+if os.getenv("ENVIRONMENT", "development") == "development":
+    from dotenv import load_dotenv
+    load_dotenv()
 
 def get_firestore_client():
+    # google-cloud の読み込みとgRPCチャネルの準備は重いため、最初に使うときまで遅らせる
+    from google.cloud import firestore
+    from google.oauth2 import service_account
+
+    # Firestoreエミュレータ（FIRESTORE_EMULATOR_HOST）を使う場合は認証情報が不要
+    if os.getenv("FIRESTORE_EMULATOR_HOST"):
+        return firestore.Client(project=os.getenv("GOOGLE_CLOUD_PROJECT", "demo-shopify-dify-tool"))
+
     # 環境変数から環境を取得（デフォルトは "development"）
     environment = os.getenv("ENVIRONMENT", "development")
     
@@ -23,3 +32,14 @@ def get_firestore_client():
     
     # 本番環境（Cloud Run）ではデフォルト認証を使用
     return firestore.Client()
+
+
+@lru_cache(maxsize=None)
+def get_db():
+    # アプリ全体で1つのFirestoreクライアント（gRPCチャネル）を共有する
+    # RPCの回数と時間を GET /metrics で見られるよう、GAPICクライアントを計測用のラッパーで包む
+    from app.metrics import instrument_firestore
+
+    client = get_firestore_client()
+    instrument_firestore(client)
+    return client
@@ -0,0 +1,70 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Tuple
+
+from app.models import ShopifyCredentials
+from app.shopify import ShopifyClient, get_shopify_client
+
+# 同じストアに対して同時に実行するファンアウトのクエリ数（複数のリクエストをまたいで制限する）
+PER_STORE_CONCURRENCY = int(os.getenv("SHOPIFY_FANOUT_PER_STORE_CONCURRENCY", "2"))
+# 1リクエストで同時に問い合わせるストア数
+MAX_CONCURRENT_STORES = int(os.getenv("SHOPIFY_FANOUT_MAX_CONCURRENT_STORES", "20"))
+
+_store_semaphores: Dict[str, asyncio.Semaphore] = {}
+
+
+def _store_semaphore(store: str) -> asyncio.Semaphore:
+    semaphore = _store_semaphores.get(store)
+    if semaphore is None:
+        semaphore = _store_semaphores[store] = asyncio.Semaphore(PER_STORE_CONCURRENCY)
+    return semaphore
+
+
+async def fan_out(
+    stores: List[ShopifyCredentials],
+    call: Callable[[ShopifyClient], Awaitable[Any]],
+    timeout: float,
+) -> AsyncIterator[Tuple[str, Dict[str, Any]]]:
+    """全ストアに同じ問い合わせを並行して実行し、終わった順に (ストア, 結果) を返す。
+    結果は {"status": "ok", "data": ...} か {"status": "error", "error": ...}。
+    期限までに終わらなかったストアはキャンセルし、タイムアウトのエラーとして返す"""
+    started = time.perf_counter()
+    limit = asyncio.Semaphore(MAX_CONCURRENT_STORES)
+
+    async def run(credentials: ShopifyCredentials) -> Tuple[str, Dict[str, Any]]:
+        async with limit, _store_semaphore(credentials.store_url):
+            shopify_client = get_shopify_client(
+                access_token=credentials.access_token,
+                store_url=credentials.store_url
+            )
+            try:
+                data = await call(shopify_client)
+                result = {"status": "ok", "data": data}
+            except Exception as e:
+                logging.error(f"Fan-out query failed for {credentials.store_url}: {e}")
+                result = {"status": "error", "error": str(e)}
+        result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        return credentials.store_url, result
+
+    tasks = {asyncio.ensure_future(run(store)): store.store_url for store in stores}
+    deadline = asyncio.get_running_loop().time() + timeout
+    pending = set(tasks)
+    try:
+        while pending:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+    for task in pending:
+        yield tasks[task], {
+            "status": "error",
+            "error": f"Deadline of {timeout}s exceeded",
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        }
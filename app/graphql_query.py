@@ -1,7 +1,12 @@
 q_get_products = """
-query GetProducts($first: Int!) {
-    products(first: $first) {
+query GetProducts($first: Int!, $after: String) {
+    products(first: $first, after: $after) {
+        pageInfo {
+            hasNextPage
+            endCursor
+        }
         edges {
+            cursor
             node {
                 id
                 title
@@ -61,9 +66,14 @@ q_get_product = """
 """
 
 q_get_orders = """
-query GetOrders($first: Int!) {
-    orders(first: $first) {
+query GetOrders($first: Int!, $after: String) {
+    orders(first: $first, after: $after) {
+        pageInfo {
+            hasNextPage
+            endCursor
+        }
         edges {
+            cursor
             node {
                 id
                 name
@@ -73,7 +83,12 @@ query GetOrders($first: Int!) {
                   }
                 }
                 createdAt
+                updatedAt
                 lineItems(first: 10) {
+                  pageInfo {
+                    hasNextPage
+                    endCursor
+                  }
                   edges {
                     node {
                       product {
@@ -104,7 +119,12 @@ query GetCustomerOrders($customerId: ID!, $first: Int!) {
     tags
     productSubscriberStatus
     lastOrder {
+      id
       lineItems(first: 10) {
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
         edges {
           node {
             product {
@@ -140,6 +160,10 @@ query GetCustomerOrders($customerId: ID!, $first: Int!) {
             }
           }
           lineItems(first: 10) {
+            pageInfo {
+              hasNextPage
+              endCursor
+            }
             edges {
               node {
                 product {
@@ -159,4 +183,333 @@ query GetCustomerOrders($customerId: ID!, $first: Int!) {
     }
   }
 }
-"""
\ No newline at end of file
+"""
+
+# Bulk Operations: 件数指定なしで全件をJSONLとして出力させる。
+# ネストしたコネクション（lineItems等）は __parentId 付きの別行として出力される
+m_bulk_operation_run_query = """
+mutation BulkOperationRunQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation {
+      id
+      status
+    }
+    userErrors {
+      field
+      message
+    }
+  }
+}
+"""
+
+q_get_bulk_operation = """
+query GetBulkOperation($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation {
+      id
+      status
+      errorCode
+      objectCount
+      url
+      partialDataUrl
+    }
+  }
+}
+"""
+
+q_bulk_orders = """
+{
+  orders {
+    edges {
+      node {
+        id
+        name
+        totalPriceSet {
+          shopMoney {
+            amount
+          }
+        }
+        createdAt
+        updatedAt
+        lineItems {
+          edges {
+            node {
+              id
+              product {
+                id
+              }
+              variant {
+                id
+              }
+              title
+              quantity
+              originalUnitPrice
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+q_bulk_products = """
+{
+  products {
+    edges {
+      node {
+        id
+        title
+        description
+        handle
+        createdAt
+        updatedAt
+        variants {
+          edges {
+            node {
+              id
+              price
+              compareAtPrice
+            }
+          }
+        }
+        images {
+          edges {
+            node {
+              id
+              url
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+q_bulk_customers = """
+{
+  customers {
+    edges {
+      node {
+        id
+        createdAt
+        updatedAt
+        displayName
+        email
+        phone
+        tags
+        productSubscriberStatus
+        defaultAddress {
+          address1
+          address2
+          city
+          country
+          province
+          zip
+        }
+      }
+    }
+  }
+}
+"""
+
+q_get_products_by_ids = """
+query GetProductsByIds($ids: [ID!]!) {
+  nodes(ids: $ids) {
+    ... on Product {
+      id
+      title
+      description
+      handle
+      createdAt
+      updatedAt
+      variants(first: 1) {
+        edges {
+          node {
+            id
+            price
+            compareAtPrice
+          }
+        }
+      }
+      images(first: 1) {
+        edges {
+          node {
+            url
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+q_get_customers_by_ids = """
+query GetCustomersByIds($ids: [ID!]!, $first: Int!) {
+  nodes(ids: $ids) {
+    ... on Customer {
+      id
+      createdAt
+      displayName
+      email
+      phone
+      tags
+      productSubscriberStatus
+      lastOrder {
+        id
+        lineItems(first: 10) {
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+          edges {
+            node {
+              product {
+                id
+              }
+              variant {
+                id
+              }
+              title
+              quantity
+              originalUnitPrice
+            }
+          }
+        }
+      }
+      defaultAddress {
+        address1
+        address2
+        city
+        country
+        province
+        zip
+      }
+      orders(first: $first) {
+        edges {
+          node {
+            id
+            createdAt
+            name
+            totalPriceSet {
+              shopMoney {
+                amount
+              }
+            }
+            lineItems(first: 10) {
+              pageInfo {
+                hasNextPage
+                endCursor
+              }
+              edges {
+                node {
+                  product {
+                    id
+                  }
+                  variant {
+                    id
+                  }
+                  title
+                  quantity
+                  originalUnitPrice
+                }
+              }
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# 差分同期: updated_at の昇順に取得し、ページごとに高水位点（最後の updatedAt）を進める
+q_sync_orders = """
+query SyncOrders($first: Int!, $after: String, $query: String) {
+  orders(first: $first, after: $after, query: $query, sortKey: UPDATED_AT) {
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+    edges {
+      node {
+        id
+        name
+        totalPriceSet {
+          shopMoney {
+            amount
+          }
+        }
+        createdAt
+        updatedAt
+        lineItems(first: 10) {
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+          edges {
+            node {
+              product {
+                id
+              }
+              variant {
+                id
+              }
+              title
+              quantity
+              originalUnitPrice
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+q_sync_products = """
+query SyncProducts($first: Int!, $after: String, $query: String) {
+  products(first: $first, after: $after, query: $query, sortKey: UPDATED_AT) {
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+    edges {
+      node {
+        id
+        title
+        description
+        handle
+        createdAt
+        updatedAt
+        variants(first: 1) {
+          edges {
+            node {
+              id
+              price
+              compareAtPrice
+            }
+          }
+        }
+        images(first: 1) {
+          edges {
+            node {
+              url
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# ミラーから返す前に、アクセストークンがそのストアで有効かを確認する
+q_get_shop = """
+query GetShop {
+  shop {
+    id
+  }
+}
+"""
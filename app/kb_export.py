@@ -0,0 +1,263 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import zlib
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from app.mirror import MAX_BATCH_WRITES, store_key
+from app.responses import dumps
+from app.shopify import ShopifyClient
+
+# 前回までに書き出したチャンクのハッシュ:
+# shopify-kb-manifest/{store}/datasets/{dataset}/{products|orders}/{id} の {"hashes": [...], "exported_at": ...}
+KB_MANIFEST_COLLECTION = "shopify-kb-manifest"
+
+# 1チャンクの文字数の上限（見出しを含む）
+DEFAULT_CHUNK_CHARS = int(os.getenv("KB_CHUNK_MAX_CHARS", "1500"))
+MIN_CHUNK_CHARS = 200
+MAX_CHUNK_CHARS = 8000
+# テキストの組み立て方を変えた場合は上げる（全チャンクのハッシュが変わり、次回は全件が書き出される）
+RENDER_VERSION = 1
+
+_DATASET_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+# 句点などの直後で文を区切る（"1.5" のような小数は区切らない）
+_SENTENCE_RE = re.compile(r"(?<=[。．！？!?])|(?<=\.)\s+")
+
+
+def render_product(product: Dict[str, Any]) -> Tuple[str, str, Dict[str, Any]]:
+    """(見出し, 本文, メタデータ) を返す。見出しは分割した各チャンクの先頭に付ける"""
+    lines = []
+    if product.get("handle"):
+        lines.append(f"ハンドル: {product['handle']}")
+    if product.get("price") is not None:
+        lines.append(f"価格: {product['price']}")
+    if product.get("image_url"):
+        lines.append(f"画像: {product['image_url']}")
+    if product.get("description"):
+        lines.append(product["description"])
+    metadata = {"resource": "products", "id": product["id"], "name": product.get("name"), "handle": product.get("handle")}
+    return f"商品: {product.get('name') or product['id']}", "\n".join(lines), metadata
+
+
+def render_order(order: Dict[str, Any]) -> Tuple[str, str, Dict[str, Any]]:
+    lines = [f"合計金額: {order['total_price']}", "明細:"]
+    for item in order.get("items") or []:
+        lines.append(f"- {item['title']} × {item['quantity']}（単価 {item['price']}）")
+    metadata = {"resource": "orders", "id": order["id"], "order_number": order.get("order_number"), "created_at": order.get("created_at")}
+    return f"注文 {order.get('order_number') or order['id']}（{order.get('created_at')}）", "\n".join(lines), metadata
+
+
+# resource -> レコードをテキストにする関数
+KB_RESOURCES: Dict[str, Callable[[Dict[str, Any]], Tuple[str, str, Dict[str, Any]]]] = {
+    "products": render_product,
+    "orders": render_order,
+}
+
+
+def _pieces(text: str, max_chars: int) -> Iterable[Tuple[str, str]]:
+    """(直前の断片との区切り, 断片) を返す。行 -> 文 -> 固定長の順に、max_chars に収まる単位まで分ける"""
+    for line in text.split("\n"):
+        line = line.strip()
+        if len(line) <= max_chars:
+            if line:
+                yield "\n", line
+            continue
+        separator = "\n"
+        for sentence in _SENTENCE_RE.split(line):
+            sentence = sentence.strip()
+            while len(sentence) > max_chars:
+                yield separator, sentence[:max_chars]
+                separator, sentence = "", sentence[max_chars:]
+            if sentence:
+                yield separator, sentence
+                # 英文はピリオドの後の空白で区切っているため、つなげるときに戻す
+                separator = " " if sentence.endswith(".") else ""
+
+
+def split_text(text: str, max_chars: int) -> List[str]:
+    """テキストを max_chars 以内のチャンクに詰める。行や文の途中ではなるべく切らない"""
+    chunks: List[str] = []
+    current = ""
+    for separator, piece in _pieces(text, max_chars):
+        candidate = f"{current}{separator}{piece}" if current else piece
+        if len(candidate) <= max_chars:
+            current = candidate
+            continue
+        chunks.append(current)
+        current = piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_id(resource: str, record_id: Any, index: int) -> str:
+    return f"{resource}-{record_id}-{index}"
+
+
+def content_hash(text: str, metadata: Dict[str, Any]) -> str:
+    payload = json.dumps({"v": RENDER_VERSION, "text": text, "metadata": metadata}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def build_chunks(resource: str, record: Dict[str, Any], max_chars: int = DEFAULT_CHUNK_CHARS) -> List[Dict[str, Any]]:
+    """1レコードをLLM向けのテキストチャンクにする。各チャンクは見出しから始まり、単独で意味が通るようにする"""
+    header, body, metadata = KB_RESOURCES[resource](record)
+    header = header[:max_chars // 2]
+    parts = split_text(body, max_chars - len(header) - 1) or [""]
+    chunks = []
+    for index, part in enumerate(parts):
+        text = f"{header}\n{part}" if part else header
+        chunks.append({
+            "id": chunk_id(resource, record["id"], index),
+            "record_id": record["id"],
+            "chunk_index": index,
+            "hash": content_hash(text, metadata),
+            "text": text,
+            "metadata": metadata,
+        })
+    return chunks
+
+
+def validate_dataset(dataset: str) -> str:
+    if not _DATASET_RE.match(dataset):
+        raise ValueError("dataset must be 1-64 characters of letters, digits, '-' or '_'")
+    return dataset
+
+
+class KnowledgeBaseExport:
+    """商品・注文をページごとにチャンクへ変換し、前回の書き出しから追加・変更されたチャンクだけを返す。
+    出力は1行1JSONで、{"op": "upsert", チャンク} / {"op": "delete", "id": チャンクID} / 最後に {"op": "summary", ...}。
+    マニフェストはページを送り出した後に更新するため、途中で切断された場合は次回その続きから差分が出る"""
+
+    def __init__(
+        self,
+        db,
+        client: ShopifyClient,
+        resource: str,
+        dataset: str = "default",
+        max_chars: int = DEFAULT_CHUNK_CHARS,
+        full: bool = False,
+    ):
+        if resource not in KB_RESOURCES:
+            raise ValueError(f"Unsupported knowledge base resource: {resource}")
+        self.db = db
+        self.client = client
+        self.resource = resource
+        self.max_chars = max_chars
+        # full=True の場合はマニフェストに関係なく全チャンクを書き出す（データセットを作り直すとき）
+        self.full = full
+        self.manifest = (
+            db.collection(KB_MANIFEST_COLLECTION)
+            .document(store_key(client.store))
+            .collection("datasets")
+            .document(validate_dataset(dataset))
+            .collection(resource)
+        )
+        self.stats = {"records": 0, "chunks": 0, "upserted": 0, "deleted": 0, "unchanged": 0}
+
+    def _pages(self) -> AsyncIterator[List[Tuple[str, Dict[str, Any]]]]:
+        if self.resource == "products":
+            return self.client.iter_products()
+        return self.client.iter_orders()
+
+    def _read_manifest(self, record_ids: List[str]) -> Dict[str, List[str]]:
+        refs = [self.manifest.document(record_id) for record_id in record_ids]
+        return {
+            snapshot.id: (snapshot.to_dict() or {}).get("hashes") or []
+            for snapshot in self.db.get_all(refs)
+            if snapshot.exists
+        }
+
+    def _write_manifest(self, updates: Dict[str, Optional[List[str]]]) -> None:
+        # None は削除（Shopifyから消えたレコード）
+        exported_at = datetime.now(timezone.utc).isoformat()
+        items = list(updates.items())
+        for start in range(0, len(items), MAX_BATCH_WRITES):
+            batch = self.db.batch()
+            for record_id, hashes in items[start:start + MAX_BATCH_WRITES]:
+                ref = self.manifest.document(record_id)
+                if hashes is None:
+                    batch.delete(ref)
+                else:
+                    batch.set(ref, {"hashes": hashes, "exported_at": exported_at})
+            batch.commit()
+
+    def _stale_records(self, seen: set) -> Dict[str, List[str]]:
+        return {
+            snapshot.id: (snapshot.to_dict() or {}).get("hashes") or []
+            for snapshot in self.manifest.select(["hashes"]).stream()
+            if snapshot.id not in seen
+        }
+
+    def diff_page(self, records: List[Dict[str, Any]], manifest: Dict[str, List[str]]) -> Tuple[List[Dict[str, Any]], Dict[str, List[str]]]:
+        """1ページ分の (出力する行, マニフェストの更新) を返す"""
+        lines: List[Dict[str, Any]] = []
+        updates: Dict[str, List[str]] = {}
+        for record in records:
+            record_id = str(record["id"])
+            previous = manifest.get(record_id, [])
+            chunks = build_chunks(self.resource, record, self.max_chars)
+            hashes = [chunk["hash"] for chunk in chunks]
+            for chunk in chunks:
+                index = chunk["chunk_index"]
+                if self.full or index >= len(previous) or previous[index] != chunk["hash"]:
+                    lines.append({"op": "upsert", **chunk})
+                    self.stats["upserted"] += 1
+                else:
+                    self.stats["unchanged"] += 1
+            # チャンク数が減った場合は、余ったチャンクを削除させる
+            for index in range(len(hashes), len(previous)):
+                lines.append({"op": "delete", "id": chunk_id(self.resource, record["id"], index)})
+                self.stats["deleted"] += 1
+            if hashes != previous:
+                updates[record_id] = hashes
+            self.stats["records"] += 1
+            self.stats["chunks"] += len(chunks)
+        return lines, updates
+
+    async def rows(self) -> AsyncIterator[List[Dict[str, Any]]]:
+        seen: set = set()
+        pages = self._pages()
+        try:
+            async for rows in pages:
+                records = [record for _, record in rows]
+                record_ids = [str(record["id"]) for record in records]
+                seen.update(record_ids)
+                manifest = await asyncio.to_thread(self._read_manifest, record_ids)
+                lines, updates = self.diff_page(records, manifest)
+                if lines:
+                    yield lines
+                if updates:
+                    await asyncio.to_thread(self._write_manifest, updates)
+        finally:
+            await pages.aclose()
+
+        # 全件を辿り終えた場合だけ、マニフェストにあってShopifyから消えたレコードのチャンクを削除させる
+        stale = await asyncio.to_thread(self._stale_records, seen)
+        lines = [
+            {"op": "delete", "id": chunk_id(self.resource, record_id, index)}
+            for record_id, hashes in stale.items()
+            for index in range(len(hashes))
+        ]
+        self.stats["deleted"] += len(lines)
+        if lines:
+            yield lines
+            await asyncio.to_thread(self._write_manifest, {record_id: None for record_id in stale})
+        yield [{"op": "summary", "resource": self.resource, **self.stats}]
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """gzipで圧縮したNDJSON。ページごとにフラッシュし、受信側が逐次展開できるようにする"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+        try:
+            async for lines in self.rows():
+                data = b"".join(dumps(line) + b"\n" for line in lines)
+                yield compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        except Exception as e:
+            # ストリーム開始後はステータスコードを変えられないため、エラー行を出して終了する
+            logging.error(f"Error exporting {self.resource} knowledge base for {self.client.store}: {e}")
+            yield compressor.compress(dumps({"error": str(e)}) + b"\n")
+        yield compressor.flush()
@@ -1,3 +1,8 @@
-from app.crud import create_app
+from app.startup import phase
 
-app = create_app()
+# 起動時間の内訳（GET /startup）
+with phase("import"):
+    from app.crud import create_app
+
+with phase("create_app"):
+    app = create_app()
@@ -0,0 +1,336 @@
+"""リクエスト処理の計測（GET /metrics、Prometheusのテキスト形式）。
+
+ルートごとのレイテンシ、段階（Shopifyのコスト待ち・通信・JSONのデコード・パース・シリアライズ・Firestore）ごとの時間、
+ストアごとのShopifyのクエリコストとバケット残量、Firestoreの操作ごとのRPC回数と時間、レスポンスサイズを集計する。
+OpenTelemetry がインストールされていれば、各段階をスパンとしても記録する（SDKとエクスポーターの設定は環境側で行う）。
+"""
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    from opentelemetry import trace
+    OTEL_AVAILABLE = True
+except ImportError:
+    OTEL_AVAILABLE = False
+
+TRACING_ENABLED = OTEL_AVAILABLE and os.getenv("OTEL_SDK_DISABLED", "false").lower() not in ("1", "true", "yes")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 秒
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+# バイト
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+COST_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        # ルート・ストア等の組み合わせ -> 値（同期エンドポイントはスレッドプールで動くためロックで守る）
+        self._values: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = float(value)
+
+    def value(self, **labels: str) -> Optional[float]:
+        return self._values.get(self._key(labels))
+
+    def _samples(self) -> Iterable[str]:
+        for key, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # [各バケットの件数..., +Infの件数], 合計, 件数
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def snapshot(self, **labels: str) -> Dict[str, Any]:
+        entry = self._values.get(self._key(labels))
+        if entry is None:
+            return {"count": 0, "sum": 0.0}
+        return {"count": entry[2], "sum": entry[1]}
+
+    def _samples(self) -> Iterable[str]:
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.label_names, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.label_names, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "http_request_duration_seconds", "Latency of HTTP requests by route template.", ("route", "method", "status")))
+HTTP_RESPONSE_SIZE = REGISTRY.register(Histogram(
+    "http_response_size_bytes", "Size of HTTP response bodies (Content-Length).", ("route",), SIZE_BUCKETS))
+HTTP_PHASE_DURATION = REGISTRY.register(Histogram(
+    "http_request_phase_duration_seconds",
+    "Time spent per request in each phase (cost_wait, upstream, decode, parse, serialize, firestore). Concurrent calls are summed.",
+    ("route", "phase")))
+
+SHOPIFY_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "shopify_request_duration_seconds", "Latency of a single Shopify GraphQL POST.", ("store", "status")))
+SHOPIFY_RESPONSE_SIZE = REGISTRY.register(Histogram(
+    "shopify_response_size_bytes", "Size of Shopify GraphQL response bodies.", ("store",), SIZE_BUCKETS))
+SHOPIFY_QUERY_COST = REGISTRY.register(Histogram(
+    "shopify_query_cost", "Query cost reported by Shopify (requested / actual).", ("store", "type"), COST_BUCKETS))
+SHOPIFY_THROTTLED = REGISTRY.register(Counter(
+    "shopify_throttled_total", "Responses rejected by Shopify rate limiting (THROTTLED or 429).", ("store",)))
+SHOPIFY_THROTTLE_AVAILABLE = REGISTRY.register(Gauge(
+    "shopify_throttle_currently_available", "Cost bucket currently available, as last reported by Shopify.", ("store",)))
+SHOPIFY_THROTTLE_MAXIMUM = REGISTRY.register(Gauge(
+    "shopify_throttle_maximum_available", "Cost bucket size, as last reported by Shopify.", ("store",)))
+SHOPIFY_THROTTLE_RESTORE_RATE = REGISTRY.register(Gauge(
+    "shopify_throttle_restore_rate", "Cost bucket restore rate per second, as last reported by Shopify.", ("store",)))
+
+FIRESTORE_RPC_DURATION = REGISTRY.register(Histogram(
+    "firestore_rpc_duration_seconds",
+    "Latency of Firestore RPCs by method (streaming RPCs: time to the first response).", ("method",)))
+FIRESTORE_RPC_ERRORS = REGISTRY.register(Counter(
+    "firestore_rpc_errors_total", "Firestore RPCs that raised an error.", ("method",)))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+# リクエスト中の段階ごとの累積時間（ミドルウェアがリクエストごとに空の辞書を設定する）
+# 並行して実行されたタスクやスレッドプールにも同じ辞書が引き継がれ、時間が合算される
+_phases: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_phases", default=None)
+_tracer = trace.get_tracer("shopify-dify-tool") if TRACING_ENABLED else None
+
+
+def start_request():
+    return _phases.set({})
+
+
+def finish_request(token, route: str, method: str, status: int, elapsed: float, size: Optional[int]) -> None:
+    phases = _phases.get() or {}
+    _phases.reset(token)
+    HTTP_REQUEST_DURATION.observe(elapsed, route=route, method=method, status=str(status))
+    if size is not None:
+        HTTP_RESPONSE_SIZE.observe(size, route=route)
+    for name, seconds in phases.items():
+        HTTP_PHASE_DURATION.observe(seconds, route=route, phase=name)
+
+
+@contextmanager
+def phase(name: str, **attributes: Any):
+    """処理の段階の時間をリクエストに加算し、OpenTelemetryがあればスパンにする"""
+    span = _tracer.start_as_current_span(name, attributes=attributes) if _tracer is not None else None
+    if span is not None:
+        span.__enter__()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_phase_time(name, time.perf_counter() - started)
+        if span is not None:
+            span.__exit__(None, None, None)
+
+
+def add_phase_time(name: str, seconds: float) -> None:
+    phases = _phases.get()
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
+
+
+def record_shopify_response(store: str, status: int, elapsed: float, size: int, cost_info: Optional[Dict[str, Any]], throttled: bool) -> None:
+    SHOPIFY_REQUEST_DURATION.observe(elapsed, store=store, status=str(status))
+    SHOPIFY_RESPONSE_SIZE.observe(size, store=store)
+    if throttled:
+        SHOPIFY_THROTTLED.inc(store=store)
+    if not cost_info:
+        return
+    if cost_info.get('requestedQueryCost') is not None:
+        SHOPIFY_QUERY_COST.observe(float(cost_info['requestedQueryCost']), store=store, type="requested")
+    if cost_info.get('actualQueryCost') is not None:
+        SHOPIFY_QUERY_COST.observe(float(cost_info['actualQueryCost']), store=store, type="actual")
+    status_info = cost_info.get('throttleStatus') or {}
+    if status_info.get('currentlyAvailable') is not None:
+        SHOPIFY_THROTTLE_AVAILABLE.set(status_info['currentlyAvailable'], store=store)
+    if status_info.get('maximumAvailable') is not None:
+        SHOPIFY_THROTTLE_MAXIMUM.set(status_info['maximumAvailable'], store=store)
+    if status_info.get('restoreRate') is not None:
+        SHOPIFY_THROTTLE_RESTORE_RATE.set(status_info['restoreRate'], store=store)
+
+
+# Firestore（GAPIC）クライアントのRPCのうち計測するもの。ストリーミングのRPCは最初の応答までの時間を記録する
+# （DocumentReference.get は最初の応答だけを読んで打ち切るため、読み切るまでは待たない）
+FIRESTORE_UNARY_METHODS = {"commit", "begin_transaction", "rollback", "batch_write", "list_documents", "list_collection_ids", "partition_query"}
+FIRESTORE_STREAMING_METHODS = {"batch_get_documents", "run_query", "run_aggregation_query"}
+
+
+class _TimedStream:
+    def __init__(self, stream, method: str, started: float):
+        self._stream = stream
+        self._method = method
+        self._started = started
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            response = next(self._stream)
+        except StopIteration:
+            self._record(False)
+            raise
+        except Exception:
+            self._record(True)
+            raise
+        self._record(False)
+        return response
+
+    def _record(self, failed: bool) -> None:
+        if self._started is None:
+            return
+        elapsed = time.perf_counter() - self._started
+        FIRESTORE_RPC_DURATION.observe(elapsed, method=self._method)
+        add_phase_time("firestore", elapsed)
+        if failed:
+            FIRESTORE_RPC_ERRORS.inc(method=self._method)
+        self._started = None
+
+    def __getattr__(self, name: str):
+        return getattr(self._stream, name)
+
+
+class _InstrumentedFirestoreAPI:
+    def __init__(self, api):
+        self._api = api
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._api, name)
+        if name in FIRESTORE_UNARY_METHODS:
+            return lambda *args, **kwargs: self._call(name, attribute, args, kwargs)
+        if name in FIRESTORE_STREAMING_METHODS:
+            return lambda *args, **kwargs: self._stream(name, attribute, args, kwargs)
+        return attribute
+
+    @staticmethod
+    def _call(name: str, method, args, kwargs):
+        with phase("firestore", method=name):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            except Exception:
+                FIRESTORE_RPC_ERRORS.inc(method=name)
+                raise
+            finally:
+                FIRESTORE_RPC_DURATION.observe(time.perf_counter() - started, method=name)
+
+    @staticmethod
+    def _stream(name: str, method, args, kwargs):
+        started = time.perf_counter()
+        try:
+            return _TimedStream(iter(method(*args, **kwargs)), name, started)
+        except Exception:
+            elapsed = time.perf_counter() - started
+            FIRESTORE_RPC_ERRORS.inc(method=name)
+            FIRESTORE_RPC_DURATION.observe(elapsed, method=name)
+            add_phase_time("firestore", elapsed)
+            raise
+
+
+def instrument_firestore(client) -> None:
+    """FirestoreクライアントのGAPICクライアントを、RPCを計測するラッパーに置き換える"""
+    api = client._firestore_api
+    if not isinstance(api, _InstrumentedFirestoreAPI):
+        client._firestore_api_internal = _InstrumentedFirestoreAPI(api)
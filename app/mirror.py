@@ -0,0 +1,66 @@
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Shopifyデータのミラー: shopify-mirror/{store}/{orders|products|customers}/{id}
+MIRROR_COLLECTION = "shopify-mirror"
+# Firestoreのバッチ書き込みの上限
+MAX_BATCH_WRITES = 500
+
+
+def store_key(store: str) -> str:
+    # 大文字小文字・スキーム・末尾の "/" が違っても同じストアとして扱う。ドキュメントIDに "/" は使えないため置き換える
+    store = store.strip().lower().split("://", 1)[-1].rstrip("/")
+    return store.replace("/", "_")
+
+
+def mirror_collection(db, store: str, resource: str):
+    return db.collection(MIRROR_COLLECTION).document(store_key(store)).collection(resource)
+
+
+def write_records(
+    db,
+    store: str,
+    resource: str,
+    records: Iterable[Dict[str, Any]],
+    checkpoint: Optional[Tuple[Any, Dict[str, Any]]] = None,
+    merge: bool = False,
+) -> int:
+    """レコードをIDごとにupsertする。checkpoint (ドキュメント参照, データ) を渡すと
+    最後のバッチに同梱し、データと進捗を同じコミットで反映する。
+    merge=True の場合はレコードに含まれないフィールドを既存の値のまま残す"""
+    collection = mirror_collection(db, store, resource)
+    synced_at = datetime.now(timezone.utc).isoformat()
+    written = 0
+    batch = db.batch()
+    pending = 0
+    reserved = 1 if checkpoint else 0
+    for record in records:
+        batch.set(collection.document(str(record["id"])), {**record, "synced_at": synced_at}, merge=merge)
+        pending += 1
+        if pending >= MAX_BATCH_WRITES - reserved:
+            batch.commit()
+            written += pending
+            batch = db.batch()
+            pending = 0
+    if checkpoint:
+        ref, data = checkpoint
+        batch.set(ref, data, merge=True)
+    if pending or checkpoint:
+        batch.commit()
+    return written + pending
+
+
+def read_records(db, store: str, resource: str, limit: int, fields: Optional[Iterable[str]] = None) -> List[Dict[str, Any]]:
+    """ミラーからID順（Shopifyの既定の並び順）にレコードを読む。fieldsを指定すると射影して返す"""
+    query = mirror_collection(db, store, resource).order_by("id").limit(limit)
+    if fields is not None:
+        fields = list(fields)
+        query = query.select(fields)
+    records = []
+    for doc in query.stream():
+        record = doc.to_dict()
+        record.pop("synced_at", None)
+        if fields is not None:
+            record = {field: record.get(field) for field in fields}
+        records.append(record)
+    return records
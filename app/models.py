@@ -14,10 +14,45 @@ class Item(ItemBase):
     created_at: Optional[str] = None
     updated_at: Optional[str] = None
 
+class ItemBatchCreate(BaseModel):
+    items: List[ItemCreate]
+
+class ItemBatchUpdateEntry(ItemCreate):
+    id: str
+
+class ItemBatchUpdate(BaseModel):
+    items: List[ItemBatchUpdateEntry]
+
+class ItemBatchIds(BaseModel):
+    ids: List[str]
+
+class ItemBatchResult(BaseModel):
+    id: str
+    status: str  # "ok" | "not_found" | "error"
+    error: Optional[str] = None
+    item: Optional[Item] = None
+
+class ItemBatchResponse(BaseModel):
+    results: List[ItemBatchResult]
+
 class ShopifyCredentials(BaseModel):
     access_token: str
     store_url: str
 
+class FanoutRequest(BaseModel):
+    stores: List[ShopifyCredentials]
+    # customers の場合に各ストアで取得する顧客ID
+    ids: Optional[List[str]] = None
+
+class TaskRequest(BaseModel):
+    task: str
+    credentials: Optional[ShopifyCredentials] = None
+    resource: Optional[str] = None
+    job_id: Optional[str] = None
+    restart: bool = False
+    # delta_sync: 複数ストアをまとめて同期する場合に指定する
+    stores: Optional[List[ShopifyCredentials]] = None
+
 class Product(BaseModel):
     id: int
     name: str
@@ -28,6 +63,15 @@ class Product(BaseModel):
     price: Optional[str] = None
     image_url: Optional[str] = None
 
+class ProductSearchHit(BaseModel):
+    score: float
+    product: Product
+
+class ProductSearchResponse(BaseModel):
+    total: int
+    next_offset: Optional[int] = None
+    results: List[ProductSearchHit]
+
 class OrderItem(BaseModel):
     product_id: Optional[int] = None
     variant_id: Optional[int] = None
@@ -40,6 +84,7 @@ class Order(BaseModel):
     order_number: str
     total_price: float
     created_at: str
+    updated_at: Optional[str] = None
     items: List[OrderItem]
 
 class Address(BaseModel):
@@ -68,3 +113,41 @@ class Customer(BaseModel):
     last_order: Optional[LastOrder] = None
     default_address: Optional[Address] = None
     orders: List[Order]
+
+class DailySales(BaseModel):
+    date: str
+    orders: int
+    revenue: float
+
+class ProductSales(BaseModel):
+    product_id: int
+    title: Optional[str] = None
+    quantity: int
+    revenue: float
+
+class SalesAnalytics(BaseModel):
+    orders: int
+    revenue: float
+    average_order_value: float
+    revenue_by_day: List[DailySales]
+    top_products: List[ProductSales]
+
+class PurchasedProduct(BaseModel):
+    product_id: int
+    title: Optional[str] = None
+
+class CustomerSummary(BaseModel):
+    id: int
+    orders: int
+    total_spent: float
+    lifetime_value: float
+    average_order_value: float
+    first_order_at: Optional[str] = None
+    last_order_at: Optional[str] = None
+    recency_days: float
+    r: int
+    f: int
+    m: int
+    rfm: str
+    recent_products: List[PurchasedProduct]
+    scored_at: Optional[str] = None
@@ -0,0 +1,52 @@
+import base64
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from app.responses import dumps
+
+
+def encode_cursor(resource: str, position: Any) -> str:
+    # 内部のカーソル（Shopifyのカーソルなど）を呼び出し元には不透明な文字列として渡す
+    raw = json.dumps({"r": resource, "p": position}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(resource: str, cursor: Optional[str]) -> Any:
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(payload, dict) or payload.get("r") != resource:
+        raise ValueError(f"Cursor does not belong to {resource}")
+    return payload.get("p")
+
+
+async def ndjson_rows(
+    resource: str,
+    pages: AsyncIterator[List[Tuple[str, Dict[str, Any]]]],
+    max_rows: Optional[int] = None,
+) -> AsyncIterator[bytes]:
+    # 1行 = {"cursor": 再開用カーソル, "node": レコード}。ページ単位で受け取り、そのまま書き出す
+    emitted = 0
+    try:
+        async for rows in pages:
+            chunk = []
+            for cursor, row in rows:
+                if max_rows is not None and emitted >= max_rows:
+                    break
+                chunk.append(dumps({"cursor": encode_cursor(resource, cursor), "node": row}))
+                emitted += 1
+            if chunk:
+                yield b"\n".join(chunk) + b"\n"
+            if max_rows is not None and emitted >= max_rows:
+                break
+    except Exception as e:
+        # ストリーム開始後はステータスコードを変えられないため、エラー行を出して終了する
+        logging.error(f"Error streaming {resource}: {e}")
+        yield dumps({"error": str(e)}) + b"\n"
+    finally:
+        await pages.aclose()
@@ -0,0 +1,92 @@
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Dict, Optional
+
+
+@lru_cache(maxsize=65536)
+def parse_gid(gid: str) -> int:
+    """gid://shopify/Product/123 -> 123。明細の商品・バリアントIDは何度も現れるため結果をキャッシュする"""
+    return int(gid[gid.rfind('/') + 1:])
+
+
+def epoch_seconds(timestamp: str) -> int:
+    # ShopifyのISO 8601の日時（末尾Z）をエポック秒にする
+    return int(datetime.fromisoformat(timestamp.replace("Z", "+00:00")).timestamp())
+
+
+def parse_line_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "product_id": parse_gid(item['product']['id']) if item['product'] else None,
+        "variant_id": parse_gid(item['variant']['id']) if item['variant'] else None,
+        "title": item['title'],
+        "quantity": item['quantity'],
+        "price": float(item['originalUnitPrice'])
+    }
+
+
+def parse_address(address: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    if not address:
+        return None
+    return {
+        "address1": address['address1'],
+        "address2": address['address2'],
+        "city": address['city'],
+        "country": address['country'],
+        "province": address['province'],
+        "zip": address['zip']
+    }
+
+
+def parse_product(node: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": parse_gid(node['id']),
+        "name": node['title'],
+        "description": node['description'],
+        "handle": node['handle'],
+        "created_at": node['createdAt'],
+        "updated_at": node['updatedAt'],
+        "price": node['variants']['edges'][0]['node']['price'] if node['variants']['edges'] else None,
+        "image_url": node['images']['edges'][0]['node']['url'] if node['images']['edges'] else None
+    }
+
+
+def parse_order(node: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "id": parse_gid(node['id']),
+        "order_number": node['name'],
+        "total_price": float(node['totalPriceSet']['shopMoney']['amount']),
+        "created_at": node['createdAt'],
+        "updated_at": node.get('updatedAt'),
+        "items": [parse_line_item(item['node']) for item in node['lineItems']['edges']]
+    }
+
+
+def parse_customer(customer: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "created_at": customer['createdAt'],
+        "display_name": customer['displayName'],
+        "email": customer['email'],
+        "phone": customer['phone'],
+        "tags": customer['tags'],
+        "product_subscriber_status": customer['productSubscriberStatus'],
+        "last_order": {
+            "items": [parse_line_item(item['node']) for item in customer['lastOrder']['lineItems']['edges']]
+        } if customer.get('lastOrder') else None,
+        "default_address": parse_address(customer.get('defaultAddress')),
+        "orders": [parse_order(edge['node']) for edge in customer['orders']['edges']]
+    }
+
+
+def parse_customer_profile(customer: Dict[str, Any]) -> Dict[str, Any]:
+    # 注文を含まない顧客情報（Bulk Operationsのエクスポート用）
+    return {
+        "id": parse_gid(customer['id']),
+        "created_at": customer['createdAt'],
+        "updated_at": customer.get('updatedAt'),
+        "display_name": customer['displayName'],
+        "email": customer['email'],
+        "phone": customer['phone'],
+        "tags": customer['tags'],
+        "product_subscriber_status": customer['productSubscriberStatus'],
+        "default_address": parse_address(customer.get('defaultAddress'))
+    }
@@ -0,0 +1,167 @@
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from app.parsers import parse_address, parse_gid, parse_line_item, parse_order
+
+# 出力フィールド -> (GraphQLの選択セット, ノードから値を取り出す関数)
+FieldSpec = Dict[str, Tuple[str, Callable[[Dict[str, Any]], Any]]]
+
+_LINE_ITEM_NODE = "product { id } variant { id } title quantity originalUnitPrice"
+
+# 10件を超える分は pageInfo を見て追加取得する（ShopifyClient.complete_line_items）
+_LINE_ITEMS_SELECTION = (
+    "lineItems(first: 10) { pageInfo { hasNextPage endCursor } edges { node { " + _LINE_ITEM_NODE + " } } }"
+)
+
+PRODUCT_FIELDS: FieldSpec = {
+    "id": ("id", lambda node: parse_gid(node['id'])),
+    "name": ("title", lambda node: node['title']),
+    "description": ("description", lambda node: node['description']),
+    "handle": ("handle", lambda node: node['handle']),
+    "created_at": ("createdAt", lambda node: node['createdAt']),
+    "updated_at": ("updatedAt", lambda node: node['updatedAt']),
+    "price": (
+        "variants(first: 1) { edges { node { price } } }",
+        lambda node: node['variants']['edges'][0]['node']['price'] if node['variants']['edges'] else None,
+    ),
+    "image_url": (
+        "images(first: 1) { edges { node { url } } }",
+        lambda node: node['images']['edges'][0]['node']['url'] if node['images']['edges'] else None,
+    ),
+}
+
+ORDER_FIELDS: FieldSpec = {
+    "id": ("id", lambda node: parse_gid(node['id'])),
+    "order_number": ("name", lambda node: node['name']),
+    "total_price": (
+        "totalPriceSet { shopMoney { amount } }",
+        lambda node: float(node['totalPriceSet']['shopMoney']['amount']),
+    ),
+    "created_at": ("createdAt", lambda node: node['createdAt']),
+    "updated_at": ("updatedAt", lambda node: node['updatedAt']),
+    "customer_id": ("customer { id }", lambda node: parse_gid(node['customer']['id']) if node.get('customer') else None),
+    "items": (_LINE_ITEMS_SELECTION, lambda node: [parse_line_item(item['node']) for item in node['lineItems']['edges']]),
+}
+
+# 顧客の orders の中では注文者は顧客自身なので customer_id は選択しない
+_CUSTOMER_ORDER_SELECTION = " ".join(
+    selection for field, (selection, _) in ORDER_FIELDS.items() if field != "customer_id"
+)
+
+CUSTOMER_FIELDS: FieldSpec = {
+    "created_at": ("createdAt", lambda node: node['createdAt']),
+    "display_name": ("displayName", lambda node: node['displayName']),
+    "email": ("email", lambda node: node['email']),
+    "phone": ("phone", lambda node: node['phone']),
+    "tags": ("tags", lambda node: node['tags']),
+    "product_subscriber_status": ("productSubscriberStatus", lambda node: node['productSubscriberStatus']),
+    "last_order": (
+        "lastOrder { id " + _LINE_ITEMS_SELECTION + " }",
+        lambda node: {
+            "items": [parse_line_item(item['node']) for item in node['lastOrder']['lineItems']['edges']]
+        } if node.get('lastOrder') else None,
+    ),
+    "default_address": (
+        "defaultAddress { address1 address2 city country province zip }",
+        lambda node: parse_address(node.get('defaultAddress')),
+    ),
+    "orders": (
+        "orders(first: $first) { edges { node { " + _CUSTOMER_ORDER_SELECTION + " } } }",
+        lambda node: [parse_order(edge['node']) for edge in node['orders']['edges']],
+    ),
+}
+
+RESOURCE_FIELDS: Dict[str, FieldSpec] = {
+    "products": PRODUCT_FIELDS,
+    "orders": ORDER_FIELDS,
+    "customers": CUSTOMER_FIELDS,
+}
+
+# 必ず含めるフィールド（レスポンスの識別に必要）
+REQUIRED_FIELDS = {
+    "products": ("id",),
+    "orders": ("id",),
+    "customers": (),
+}
+
+_TEMPLATES = {
+    "products": (
+        "products",
+        "query GetProducts($first: Int!, $after: String) { products(first: $first, after: $after) "
+        "{ pageInfo { hasNextPage endCursor } edges { cursor node { %s } } } }",
+    ),
+    "product": ("products", "query GetProduct($id: ID!) { product(id: $id) { %s } }"),
+    "products_by_ids": (
+        "products",
+        "query GetProductsByIds($ids: [ID!]!) { nodes(ids: $ids) { ... on Product { %s } } }",
+    ),
+    "orders": (
+        "orders",
+        "query GetOrders($first: Int!, $after: String) { orders(first: $first, after: $after) "
+        "{ pageInfo { hasNextPage endCursor } edges { cursor node { %s } } } }",
+    ),
+    "customer": (
+        "customers",
+        "query GetCustomerOrders($customerId: ID!%s) { customer(id: $customerId) { %s } }",
+    ),
+    "customers_by_ids": (
+        "customers",
+        "query GetCustomersByIds($ids: [ID!]!%s) { nodes(ids: $ids) { ... on Customer { id %s } } }",
+    ),
+}
+
+
+def normalize_fields(resource: str, fields: Iterable[str]) -> Tuple[str, ...]:
+    """指定フィールドを検証し、定義順に並べたタプルにする（メモ化のキーになる）"""
+    spec = RESOURCE_FIELDS[resource]
+    requested = {field.strip() for field in fields if field.strip()}
+    unknown = requested - spec.keys()
+    if unknown:
+        raise ValueError(f"Unknown {resource} fields: {', '.join(sorted(unknown))}")
+    requested.update(REQUIRED_FIELDS[resource])
+    if not requested:
+        # 選択セットが空のクエリはShopifyでエラーになる（顧客には必須フィールドがない）
+        raise ValueError(f"No {resource} fields specified")
+    return tuple(field for field in spec if field in requested)
+
+
+def parse_fields_param(resource: str, fields: Optional[str]) -> Optional[Tuple[str, ...]]:
+    # クエリパラメータ "name,price" を正規化する。未指定ならNone（従来の全フィールド）
+    if not fields:
+        return None
+    return normalize_fields(resource, fields.split(","))
+
+
+@lru_cache(maxsize=256)
+def build_query(kind: str, fields: Tuple[str, ...]) -> str:
+    """必要なフィールドだけを選択するGraphQLドキュメントを生成する（フィールドの組み合わせごとにキャッシュ）"""
+    resource, template = _TEMPLATES[kind]
+    spec = RESOURCE_FIELDS[resource]
+    selection = " ".join(spec[field][0] for field in fields)
+    if resource == "customers":
+        # $first は orders を選択した場合のみ宣言する（未使用の変数はエラーになる）
+        return template % (", $first: Int!" if "orders" in fields else "", selection)
+    return template % selection
+
+
+@lru_cache(maxsize=64)
+def build_line_items_query(orders: int, page_size: int) -> str:
+    """複数の注文の続きのlineItemsをエイリアス (o0, o1, ...) で1回のクエリにまとめる"""
+    declarations = ", ".join(f"$id{i}: ID!, $after{i}: String" for i in range(orders))
+    selections = " ".join(
+        f"o{i}: order(id: $id{i}) {{ lineItems(first: {page_size}, after: $after{i}) "
+        f"{{ pageInfo {{ hasNextPage endCursor }} edges {{ node {{ {_LINE_ITEM_NODE} }} }} }} }}"
+        for i in range(orders)
+    )
+    return f"query GetOrderLineItems({declarations}) {{ {selections} }}"
+
+
+def uses_variable(query: str, name: str) -> bool:
+    return f"${name}:" in query
+
+
+def project(resource: str, node: Dict[str, Any], fields: Tuple[str, ...]) -> Dict[str, Any]:
+    # 生成したクエリに対応する、指定フィールドだけのレスポンスを組み立てる
+    spec = RESOURCE_FIELDS[resource]
+    return {field: spec[field][1](node) for field in fields}
+
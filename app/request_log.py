@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import uuid
+from contextvars import ContextVar
+from typing import Optional
+
+# LOG_FORMAT=json の場合、Cloud Logging が解釈できる1行1JSONで出力する
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+TEXT_FORMAT = "%(levelname)s:%(name)s:[%(request_id)s] %(message)s"
+# 呼び出し元が付けたIDが長すぎる場合は使わない
+MAX_REQUEST_ID_LENGTH = 128
+
+_request_id: ContextVar[str] = ContextVar("request_id", default="-")
+
+
+def request_id_from_headers(headers) -> str:
+    # X-Request-ID がなければ Cloud Run のトレースID（X-Cloud-Trace-Context: TRACE_ID/SPAN_ID;o=1）を使う
+    request_id = headers.get("X-Request-ID") or (headers.get("X-Cloud-Trace-Context") or "").split("/")[0]
+    if not request_id or len(request_id) > MAX_REQUEST_ID_LENGTH:
+        return uuid.uuid4().hex
+    return request_id
+
+
+def set_request_id(request_id: str):
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token) -> None:
+    _request_id.reset(token)
+
+
+def current_request_id() -> str:
+    return _request_id.get()
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = _request_id.get()
+        return True
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", _request_id.get()),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(level: int = logging.INFO, log_format: Optional[str] = None) -> None:
+    """ルートロガーの出力にリクエストIDを付ける（バックグラウンドの処理は "-"）"""
+    logging.basicConfig(level=level, format=TEXT_FORMAT)
+    formatter = JSONFormatter() if (log_format or LOG_FORMAT) == "json" else None
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, RequestIdFilter) for f in handler.filters):
+            handler.addFilter(RequestIdFilter())
+        if formatter is not None:
+            handler.setFormatter(formatter)
@@ -0,0 +1,157 @@
+import asyncio
+import contextvars
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Any, Dict, Optional
+
+# リクエストの期限（time.monotonic() 基準の絶対時刻）。ミドルウェアがリクエストごとに設定する
+_deadline: ContextVar[Optional[float]] = ContextVar("shopify_deadline", default=None)
+
+# 呼び出し元が期限を指定しない場合のリクエスト全体の期限（秒）と上限
+DEFAULT_DEADLINE = float(os.getenv("SHOPIFY_REQUEST_DEADLINE", "25"))
+MAX_DEADLINE = float(os.getenv("SHOPIFY_MAX_REQUEST_DEADLINE", "300"))
+
+# 5xx・通信エラーの再送: 指数バックオフ（full jitter）
+MAX_RETRIES = 3
+BACKOFF_BASE = 0.2
+BACKOFF_CAP = 5.0
+
+
+def set_deadline(timeout: Optional[float]):
+    """現在のコンテキストに期限を設定し、reset に渡すトークンを返す"""
+    return _deadline.set(time.monotonic() + timeout if timeout is not None else None)
+
+
+def reset_deadline(token) -> None:
+    _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """期限までの残り秒数。期限が設定されていなければNone"""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def detach(coro) -> "asyncio.Future":
+    """期限を引き継がずにタスクを開始する（リクエストが終わった後も動き続ける処理用）"""
+    context = contextvars.copy_context()
+    context.run(_deadline.set, None)
+    return context.run(asyncio.ensure_future, coro)
+
+
+def backoff_delay(attempt: int) -> float:
+    # 同時に失敗したリクエストの再送が揃わないよう、0〜上限の一様乱数で待つ
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+class RetryBudget:
+    """ストアごとの再送の予算。失敗でトークンを1減らし、成功で token_ratio 回復する。
+    トークンが半分を下回ると再送しない（障害時に再送で負荷を増やさない）"""
+
+    def __init__(self, max_tokens: float = 10.0, token_ratio: float = 0.1):
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self.tokens = max_tokens
+        self.retries = 0
+        self.denied = 0
+
+    def record_success(self) -> None:
+        self.tokens = min(self.max_tokens, self.tokens + self.token_ratio)
+
+    def record_failure(self) -> None:
+        self.tokens = max(0.0, self.tokens - 1)
+
+    def allow_retry(self) -> bool:
+        if self.tokens > self.max_tokens / 2:
+            self.retries += 1
+            return True
+        self.denied += 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"tokens": round(self.tokens, 2), "retries": self.retries, "denied": self.denied}
+
+
+class CircuitBreaker:
+    """連続して失敗したストアへの送信を一定時間止め、すぐにエラーを返す。
+    停止時間が過ぎたら1件だけ試し（half-open）、成功すれば再開する。
+    試行中のリクエストが結果を返さずに終わった場合に備え、試行は reset_timeout で失効する"""
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_started: Optional[float] = None
+        self.rejected = 0
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half_open":
+            now = time.monotonic()
+            if self._probe_started is None or now - self._probe_started >= self.reset_timeout:
+                self._probe_started = now
+                return True
+        self.rejected += 1
+        return False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self._probe_started = None
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self._probe_started is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None or self._probe_started is not None:
+                self.opened += 1
+            self.opened_at = time.monotonic()
+        self._probe_started = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "failures": self.failures, "opened": self.opened, "rejected": self.rejected}
+
+
+_retry_budgets: Dict[str, RetryBudget] = {}
+_circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_retry_budget(store: str) -> RetryBudget:
+    budget = _retry_budgets.get(store)
+    if budget is None:
+        budget = _retry_budgets[store] = RetryBudget()
+    return budget
+
+
+def get_circuit_breaker(store: str) -> CircuitBreaker:
+    breaker = _circuit_breakers.get(store)
+    if breaker is None:
+        breaker = _circuit_breakers[store] = CircuitBreaker(
+            failure_threshold=int(os.getenv("SHOPIFY_CIRCUIT_FAILURE_THRESHOLD", "5")),
+            reset_timeout=float(os.getenv("SHOPIFY_CIRCUIT_RESET_TIMEOUT", "30")),
+        )
+    return breaker
+
+
+def resilience_stats() -> Dict[str, Dict[str, Any]]:
+    stores = set(_retry_budgets) | set(_circuit_breakers)
+    return {
+        store: {
+            "retry_budget": get_retry_budget(store).stats(),
+            "circuit_breaker": get_circuit_breaker(store).stats(),
+        }
+        for store in stores
+    }
@@ -0,0 +1,41 @@
+import json
+import os
+from datetime import date, datetime
+from typing import Any
+
+from fastapi.responses import JSONResponse
+
+from app.metrics import phase
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# trueの場合、Shopifyのレスポンスもresponse_modelで検証してから返す（開発用。件数が多いと遅い）
+VALIDATE_RESPONSES = os.getenv("SHOPIFY_VALIDATE_RESPONSES", os.getenv("DEBUG", "")).lower() in ("1", "true", "yes")
+
+
+def _default(value: Any) -> Any:
+    # Firestoreの日時（datetimeのサブクラス）など
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def dumps(content: Any) -> bytes:
+    """UTF-8のJSONにする。orjsonがあれば使う"""
+    if ORJSON_AVAILABLE:
+        return orjson.dumps(content, default=_default, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """dictやlistをそのままJSONにするレスポンス。モデルを経由しないため、
+    ShopifyClient が組み立てた信頼できるデータだけを渡すこと"""
+
+    def render(self, content: Any) -> bytes:
+        with phase("serialize"):
+            return dumps(content)
+
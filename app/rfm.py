@@ -0,0 +1,238 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional
+
+from app.mirror import MAX_BATCH_WRITES, mirror_collection, store_key, write_records
+from app.parsers import epoch_seconds
+from app.shopify import ShopifyClient
+from app.sync import SYNC_STATE_COLLECTION
+
+# 顧客サマリー: shopify-mirror/{store}/customer_summaries/{customer_id}
+SUMMARY_RESOURCE = "customer_summaries"
+# 全件集計の後にサマリーへ反映した注文の目印: shopify-mirror/{store}/customer_summary_orders/{order_id}
+APPLIED_ORDERS_RESOURCE = "customer_summary_orders"
+# 集計に必要な注文のフィールド（query_builder で選択セットを絞る）
+SUMMARY_ORDER_FIELDS = ("id", "customer_id", "total_price", "created_at", "items")
+# 直近に購入した商品として保持する数
+RECENT_PRODUCTS = 10
+# RFMの各スコアは1〜5（五分位）
+SCORE_LEVELS = 5
+# 同じ顧客のサマリーへの書き込みが競合した場合に読み直す回数
+MAX_SUMMARY_RETRIES = 5
+
+
+def _empty_summary(customer_id: int) -> Dict[str, Any]:
+    return {
+        "id": customer_id,
+        "orders": 0,
+        "total_spent": 0.0,
+        "first_order_at": None,
+        "last_order_at": None,
+        "recent_products": [],
+    }
+
+
+def accumulate(summary: Dict[str, Any], order: Dict[str, Any]) -> None:
+    """注文1件をサマリーに加える。同じ注文を二重に加えないことは呼び出し元（apply_orders）が保証する"""
+    summary["orders"] += 1
+    summary["total_spent"] = round(summary["total_spent"] + (order["total_price"] or 0.0), 2)
+    # UTCオフセットが混在しても正しく比べられるよう、エポック秒で比較する
+    created_at = epoch_seconds(order["created_at"])
+    if summary["first_order_at"] is None or created_at < epoch_seconds(summary["first_order_at"]):
+        summary["first_order_at"] = order["created_at"]
+    latest = summary["last_order_at"] is None or created_at >= epoch_seconds(summary["last_order_at"])
+    if latest:
+        summary["last_order_at"] = order["created_at"]
+
+    # 新しく購入した商品を先頭にし、重複を除いて一定数だけ残す（過去の注文が後から届いた場合は末尾に加える）
+    purchased = [
+        {"product_id": item["product_id"], "title": item["title"]}
+        for item in order["items"] if item["product_id"] is not None
+    ]
+    seen = set()
+    recent = []
+    for product in (purchased + summary["recent_products"] if latest else summary["recent_products"] + purchased):
+        if product["product_id"] not in seen:
+            seen.add(product["product_id"])
+            recent.append(product)
+    summary["recent_products"] = recent[:RECENT_PRODUCTS]
+
+
+def _recency_days(summary: Dict[str, Any], now: float) -> float:
+    return (now - epoch_seconds(summary["last_order_at"])) / 86400
+
+
+def compute_breakpoints(summaries: Iterable[Dict[str, Any]], now: float) -> Dict[str, List[float]]:
+    """全顧客の分布から五分位の境界を求める。差分更新ではこの境界を使ってスコアを付ける"""
+    # numpy は読み込みに時間がかかるため、起動時ではなく集計するときに読み込む
+    import numpy as np
+
+    rows = [summary for summary in summaries if summary["orders"]]
+    if not rows:
+        return {"recency": [], "frequency": [], "monetary": []}
+    quantiles = np.linspace(0, 1, SCORE_LEVELS + 1)[1:-1]
+    columns = {
+        "recency": np.fromiter((_recency_days(summary, now) for summary in rows), np.float64, len(rows)),
+        "frequency": np.fromiter((summary["orders"] for summary in rows), np.float64, len(rows)),
+        "monetary": np.fromiter((summary["total_spent"] for summary in rows), np.float64, len(rows)),
+    }
+    return {name: [float(value) for value in np.quantile(values, quantiles)] for name, values in columns.items()}
+
+
+def apply_scores(summary: Dict[str, Any], breakpoints: Dict[str, List[float]], now: float) -> Dict[str, Any]:
+    import numpy as np
+
+    def level(value: float, cuts: List[float]) -> int:
+        return 1 + int(np.searchsorted(cuts, value, side="right"))
+
+    recency = _recency_days(summary, now)
+    # 最終購入が新しいほどRが高い
+    r = SCORE_LEVELS + 1 - level(recency, breakpoints["recency"]) if breakpoints["recency"] else SCORE_LEVELS
+    f = level(summary["orders"], breakpoints["frequency"]) if breakpoints["frequency"] else 1
+    m = level(summary["total_spent"], breakpoints["monetary"]) if breakpoints["monetary"] else 1
+    summary.update({
+        "recency_days": round(recency, 1),
+        "average_order_value": round(summary["total_spent"] / summary["orders"], 2),
+        "lifetime_value": summary["total_spent"],
+        "r": r,
+        "f": f,
+        "m": m,
+        "rfm": f"{r}{f}{m}",
+        "scored_at": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+    })
+    return summary
+
+
+def _state_ref(db, store: str):
+    return db.collection(SYNC_STATE_COLLECTION).document(store_key(store))
+
+
+def _commit_summaries(db, store: str, orders: List[Dict[str, Any]], breakpoints: Dict[str, List[float]]) -> int:
+    """目印のない注文だけを顧客サマリーに反映し、サマリーと目印を1回のコミットで書く。
+    サマリーは読んだ時点から変わっていないことを前提条件にし、目印は新規作成にする。
+    他のワーカーが先に同じ顧客や注文を書いていた場合は FailedPrecondition か AlreadyExists になる"""
+    markers = mirror_collection(db, store, APPLIED_ORDERS_RESOURCE)
+    marker_refs = {order["id"]: markers.document(str(order["id"])) for order in orders}
+    applied = {int(snapshot.id) for snapshot in db.get_all(list(marker_refs.values())) if snapshot.exists}
+    by_customer: Dict[int, List[Dict[str, Any]]] = {}
+    for order in orders:
+        if order["id"] not in applied:
+            by_customer.setdefault(order["customer_id"], []).append(order)
+    if not by_customer:
+        return 0
+
+    collection = mirror_collection(db, store, SUMMARY_RESOURCE)
+    refs = {customer_id: collection.document(str(customer_id)) for customer_id in by_customer}
+    snapshots = {int(snapshot.id): snapshot for snapshot in db.get_all(list(refs.values())) if snapshot.exists}
+    now = datetime.now(timezone.utc).timestamp()
+    synced_at = datetime.fromtimestamp(now, timezone.utc).isoformat()
+    batch = db.batch()
+    for customer_id, customer_orders in by_customer.items():
+        snapshot = snapshots.get(customer_id)
+        summary = snapshot.to_dict() if snapshot else _empty_summary(customer_id)
+        summary.pop("synced_at", None)
+        for order in customer_orders:
+            accumulate(summary, order)
+            batch.create(marker_refs[order["id"]], {"customer_id": customer_id, "applied_at": synced_at})
+        record = {**apply_scores(summary, breakpoints, now), "synced_at": synced_at}
+        if snapshot:
+            option = db.write_option(last_update_time=snapshot.update_time.timestamp_pb())
+            batch.update(refs[customer_id], record, option=option)
+        else:
+            batch.create(refs[customer_id], record)
+    batch.commit()
+    return len(by_customer)
+
+
+def apply_orders(db, store: str, orders: List[Dict[str, Any]]) -> int:
+    """新しい注文を既存のサマリーに反映する（Webhook・差分実行用）。更新した顧客数を返す。
+    スコアの境界は前回の全件集計で求めたものを使う。全件集計で数えた注文（high_water_order_id 以下）は除き、
+    それより新しい注文は目印のドキュメントで、Webhookとバッチの両方から届いても1回だけ数える"""
+    # google-cloud は起動を遅くするため、使うときに読み込む
+    from google.api_core.exceptions import Conflict, FailedPrecondition
+
+    state_snapshot = _state_ref(db, store).get()
+    state = ((state_snapshot.to_dict() or {}).get(SUMMARY_RESOURCE) or {}) if state_snapshot.exists else {}
+    if not state.get("breakpoints") or "high_water_order_id" not in state:
+        # 全件集計が未実行の場合は、次の全件集計で作られる
+        return 0
+    # 同じ注文が複数回含まれていても1件として扱う
+    orders = list({
+        order["id"]: order
+        for order in sorted(orders, key=lambda order: order["id"])
+        if order.get("customer_id") is not None and order["id"] > state["high_water_order_id"]
+    }.values())
+
+    updated = 0
+    # 1注文につき目印とサマリーの最大2件を書くため、バッチの上限の半分ずつ反映する
+    chunk_size = MAX_BATCH_WRITES // 2
+    for start in range(0, len(orders), chunk_size):
+        chunk = orders[start:start + chunk_size]
+        # 同じ顧客や注文を別のワーカー（Webhookは注文IDで振り分けている）や差分実行が同時に反映した場合は、
+        # 読み直して反映し直す。反映済みの注文は目印で除かれる
+        for attempt in range(MAX_SUMMARY_RETRIES):
+            try:
+                updated += _commit_summaries(db, store, chunk, state["breakpoints"])
+                break
+            except (Conflict, FailedPrecondition):
+                if attempt == MAX_SUMMARY_RETRIES - 1:
+                    raise
+                logging.info(f"Customer summaries for {store} were updated concurrently; retrying ({attempt + 1})")
+    return updated
+
+
+class CustomerSummaryJob:
+    """全注文を1回走査して顧客ごとのRFM・LTV・直近の購入商品を集計し、Firestoreに保存する。
+    2回目以降は前回のカーソル以降の注文（新しい注文）だけを読み、既存のサマリーに反映する。
+    サマリーは注文IDの一覧を持たず、全件集計で数えた最大の注文IDと、それ以降の注文の目印で二重計上を防ぐ"""
+
+    def __init__(self, db, client: ShopifyClient):
+        self.db = db
+        self.client = client
+        self.state_ref = _state_ref(db, client.store)
+
+    async def run(self, full: bool = False) -> Dict[str, Any]:
+        snapshot = await asyncio.to_thread(self.state_ref.get)
+        state = ((snapshot.to_dict() if snapshot.exists else {}) or {}).get(SUMMARY_RESOURCE) or {}
+        # 目印で二重計上を防ぐ前の集計しかない場合も、全件集計からやり直す
+        if full or not state.get("cursor") or "high_water_order_id" not in state:
+            return await self._full()
+        return await self._incremental(state["cursor"])
+
+    async def _full(self) -> Dict[str, Any]:
+        summaries: Dict[int, Dict[str, Any]] = {}
+        cursor = None
+        high_water = 0
+        async for rows in self.client.iter_orders(fields=SUMMARY_ORDER_FIELDS):
+            for _, order in rows:
+                high_water = max(high_water, order["id"])
+                if order["customer_id"] is not None:
+                    accumulate(summaries.setdefault(order["customer_id"], _empty_summary(order["customer_id"])), order)
+            cursor = rows[-1][0]
+
+        now = datetime.now(timezone.utc).timestamp()
+        breakpoints = compute_breakpoints(summaries.values(), now)
+        records = [apply_scores(summary, breakpoints, now) for summary in summaries.values()]
+        checkpoint = {
+            SUMMARY_RESOURCE: {
+                "cursor": cursor,
+                "high_water_order_id": high_water,
+                "breakpoints": breakpoints,
+                "computed_at": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            }
+        }
+        written = await asyncio.to_thread(
+            write_records, self.db, self.client.store, SUMMARY_RESOURCE, records, (self.state_ref, checkpoint)
+        )
+        logging.info(f"Computed {written} customer summaries for {self.client.store}")
+        return {"mode": "full", "customers": written}
+
+    async def _incremental(self, cursor: Optional[str]) -> Dict[str, Any]:
+        updated = 0
+        async for rows in self.client.iter_orders(after=cursor, fields=SUMMARY_ORDER_FIELDS):
+            updated += await asyncio.to_thread(apply_orders, self.db, self.client.store, [order for _, order in rows])
+            cursor = rows[-1][0]
+            # 境界値を残したままカーソルだけを進める
+            await asyncio.to_thread(self.state_ref.update, {f"{SUMMARY_RESOURCE}.cursor": cursor})
+        return {"mode": "incremental", "customers": updated}
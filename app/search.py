@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+import unicodedata
+from collections import Counter
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from app.mirror import store_key
+from app.resilience import detach
+
+# フィールドごとの重み（タイトルに一致した商品を上位にする）
+FIELD_WEIGHTS = {
+    "name": 3.0,
+    "handle": 2.0,
+    "price": 1.0,
+    "description": 1.0,
+}
+
+# 英数字は単語単位、それ以外（日本語など分かち書きしない文字）は文字bigramでトークン化する
+_WORD_RE = re.compile(r"[0-9a-z]+(?:[._][0-9a-z]+)*|[^\s0-9a-z\W_]+")
+
+
+def normalize(text: str) -> str:
+    # 全角英数・半角カナの揺れを吸収する
+    return unicodedata.normalize("NFKC", text).lower()
+
+
+def tokenize(text: Optional[str], unigrams: bool = False) -> List[str]:
+    """unigrams=True（インデックス側）の場合は1文字のトークンも含め、1文字のクエリにも一致させる"""
+    if not text:
+        return []
+    tokens = []
+    for run in _WORD_RE.findall(normalize(text)):
+        if run.isascii() or len(run) == 1:
+            tokens.append(run)
+            continue
+        tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        if unigrams:
+            tokens.extend(run)
+    return tokens
+
+
+def _price(product: Dict[str, Any]) -> Optional[float]:
+    try:
+        return float(product["price"]) if product.get("price") is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+class ProductSearchIndex:
+    """1ストア分の商品の転置インデックス。トークン -> {商品ID: 重み付きの出現数}"""
+
+    def __init__(self):
+        self.products: Dict[int, Dict[str, Any]] = {}
+        self.postings: Dict[str, Dict[int, float]] = {}
+        self._terms: Dict[int, Dict[str, float]] = {}
+        self.built_at = time.time()
+
+    def __len__(self) -> int:
+        return len(self.products)
+
+    def upsert(self, products: Iterable[Dict[str, Any]]) -> None:
+        for product in products:
+            self.remove([product["id"]])
+            terms: Counter = Counter()
+            for field, weight in FIELD_WEIGHTS.items():
+                for token in tokenize(str(product[field]) if product.get(field) is not None else None, unigrams=True):
+                    terms[token] += weight
+            self.products[product["id"]] = product
+            self._terms[product["id"]] = dict(terms)
+            for token, weight in terms.items():
+                self.postings.setdefault(token, {})[product["id"]] = weight
+
+    def remove(self, product_ids: Iterable[int]) -> None:
+        for product_id in product_ids:
+            for token in self._terms.pop(product_id, {}):
+                posting = self.postings.get(token)
+                if posting is not None:
+                    posting.pop(product_id, None)
+                    if not posting:
+                        del self.postings[token]
+            self.products.pop(product_id, None)
+
+    def search(
+        self,
+        query: str,
+        offset: int = 0,
+        limit: int = 10,
+        min_price: Optional[float] = None,
+        max_price: Optional[float] = None,
+    ) -> Tuple[int, List[Tuple[float, Dict[str, Any]]]]:
+        """(一致件数, [(スコア, 商品)]) を返す。一致したクエリトークンの数、TF-IDFの順に並べる"""
+        tokens = set(tokenize(query))
+        total_docs = len(self.products) or 1
+        matched: Dict[int, int] = {}
+        scores: Dict[int, float] = {}
+        for token in tokens:
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + total_docs / len(posting))
+            for product_id, weight in posting.items():
+                matched[product_id] = matched.get(product_id, 0) + 1
+                scores[product_id] = scores.get(product_id, 0.0) + (1 + math.log(weight)) * idf
+
+        hits = []
+        for product_id, score in scores.items():
+            product = self.products[product_id]
+            if min_price is not None or max_price is not None:
+                price = _price(product)
+                if price is None or (min_price is not None and price < min_price) or (max_price is not None and price > max_price):
+                    continue
+            hits.append((matched[product_id], score, product_id))
+        hits.sort(key=lambda hit: (-hit[0], -hit[1], hit[2]))
+        page = hits[offset:offset + limit]
+        return len(hits), [(round(score / len(tokens), 4), self.products[product_id]) for _, score, product_id in page]
+
+
+class SearchIndexRegistry:
+    """ストアごとのインデックス。初回の検索時に商品一覧から構築し、同期・Webhookで差分を反映する"""
+
+    def __init__(self, max_age: float = 3600.0):
+        self.max_age = max_age
+        self._indexes: Dict[str, ProductSearchIndex] = {}
+        self._builds: Dict[str, "asyncio.Future[ProductSearchIndex]"] = {}
+
+    async def get(self, client) -> ProductSearchIndex:
+        key = store_key(client.store)
+        index = self._indexes.get(key)
+        if index is not None:
+            # 古くなったインデックスはそのまま使い、再構築はバックグラウンドで行う
+            if time.time() - index.built_at >= self.max_age:
+                self._start_build(key, client)
+            return index
+        # 同じストアの構築が実行中であれば、その完了を待つ
+        return await asyncio.shield(self._start_build(key, client))
+
+    def _start_build(self, key: str, client) -> "asyncio.Future[ProductSearchIndex]":
+        build = self._builds.get(key)
+        if build is None:
+            # 構築は複数のリクエストで共有するため、最初のリクエストの期限を引き継がない
+            build = detach(self._build(client))
+            self._builds[key] = build
+            build.add_done_callback(lambda done: self._finish_build(key, done))
+        return build
+
+    def _finish_build(self, key: str, build: "asyncio.Future[ProductSearchIndex]") -> None:
+        self._builds.pop(key, None)
+        if not build.cancelled() and build.exception() is not None:
+            logging.error(f"Failed to build product search index for {key}: {build.exception()}")
+
+    async def _build(self, client) -> ProductSearchIndex:
+        started = time.perf_counter()
+        index = ProductSearchIndex()
+        async for rows in client.iter_products():
+            index.upsert(product for _, product in rows)
+        self._indexes[store_key(client.store)] = index
+        logging.info(f"Built product search index for {client.store}: {len(index)} products in {time.perf_counter() - started:.2f}s")
+        return index
+
+    def upsert(self, store: str, products: List[Dict[str, Any]]) -> None:
+        # 構築済みのインデックスにだけ反映する（未構築なら初回検索時に最新の一覧から作られる）
+        index = self._indexes.get(store_key(store))
+        if index is not None:
+            index.upsert(products)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            store: {"products": len(index), "tokens": len(index.postings), "age": round(time.time() - index.built_at, 1)}
+            for store, index in self._indexes.items()
+        }
+
+
+_registry: Optional[SearchIndexRegistry] = None
+
+
+def get_search_indexes() -> SearchIndexRegistry:
+    global _registry
+    if _registry is None:
+        _registry = SearchIndexRegistry(max_age=float(os.getenv("PRODUCT_SEARCH_INDEX_MAX_AGE", "3600")))
+    return _registry
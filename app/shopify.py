@@ -1,154 +1,607 @@
-import requests
+import asyncio
+import hashlib
+import httpx
+import json
 import logging
-from typing import List, Optional, Dict, Any
-from app.graphql_query import q_get_products, q_get_orders, q_get_product, q_get_customer_orders
+import os
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import List, Optional, Dict, Any, Tuple, AsyncIterator, Callable
+from app.graphql_query import (
+    q_get_products,
+    q_get_orders,
+    q_get_product,
+    q_get_customer_orders,
+    q_get_products_by_ids,
+    q_get_customers_by_ids,
+    q_get_shop,
+)
+from app.throttle import CostBucket, MAX_QUERY_COST, estimate_query_cost, get_cost_bucket
+from app.cache import get_response_cache
+from app.metrics import phase, record_shopify_response
+from app.mirror import store_key
+from app.resilience import MAX_RETRIES, backoff_delay, detach, get_circuit_breaker, get_retry_budget, remaining
+from app.singleflight import SingleFlight
+from app.parsers import parse_customer, parse_order, parse_product
+from app.query_builder import build_line_items_query, build_query, project, uses_variable
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
 SHOPIFY_GRAPHQL_API_VERSION = "2024-10"
+# GraphQLエンドポイント。ベンチマークではローカルの偽Shopifyサーバーに向ける（bench/README.md）
+SHOPIFY_GRAPHQL_URL = os.getenv("SHOPIFY_GRAPHQL_URL", "https://{store}/admin/api/{version}/graphql.json")
+
+# THROTTLED / 429 を受け取った場合に、バケットの回復を待って再送する回数
+MAX_THROTTLE_RETRIES = 3
+# 送信1回あたりの読み取りタイムアウト（リクエストの期限が近ければさらに短くする）
+READ_TIMEOUT = 30.0
+CONNECT_TIMEOUT = 5.0
+
+# nodes(ids:) に渡せるIDの上限
+MAX_NODES_PER_QUERY = 250
+
+# lineItems の追加取得: 1ページの件数と、同時に実行するクエリ数
+LINE_ITEMS_PAGE_SIZE = 100
+LINE_ITEMS_CONCURRENCY = 4
+
+# ストアごとのコネクションプール設定
+DEFAULT_TIMEOUT = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+DEFAULT_LIMITS = httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60.0)
+
+# 保持するコネクションプールとクライアントの上限。呼び出し元が任意のストア・トークンを送れるため、
+# 上限を超えたら最も長く使われていないものから捨てる
+MAX_HTTP_CLIENTS = int(os.getenv("SHOPIFY_MAX_HTTP_CLIENTS", "200"))
+MAX_SHOPIFY_CLIENTS = int(os.getenv("SHOPIFY_MAX_CLIENTS", "1000"))
+
+# ストア -> 長寿命のAsyncClient（TLSセッションとkeep-alive接続を使い回す）。使った順に並べる
+_http_clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+# 上限から外れ、送信中のリクエストが終わるのを待って閉じるAsyncClient -> 閉じるタスク
+_retiring_http_clients: Dict[httpx.AsyncClient, "asyncio.Future"] = {}
+# (ストア, アクセストークン) -> ShopifyClient。一度でも成功したトークンだけを保持する
+_shopify_clients: "OrderedDict[Tuple[str, str], ShopifyClient]" = OrderedDict()
+
+
+def graphql_url(store_url: str) -> str:
+    return SHOPIFY_GRAPHQL_URL.format(store=store_url, version=SHOPIFY_GRAPHQL_API_VERSION)
+
+
+async def _retire_http_client(client: httpx.AsyncClient) -> None:
+    try:
+        await asyncio.sleep(READ_TIMEOUT + CONNECT_TIMEOUT)
+    finally:
+        _retiring_http_clients.pop(client, None)
+        await client.aclose()
+
+
+def get_http_client(store_url: str) -> httpx.AsyncClient:
+    client = _http_clients.get(store_url)
+    if client is not None and not client.is_closed:
+        _http_clients.move_to_end(store_url)
+        return client
+    client = _http_clients[store_url] = httpx.AsyncClient(
+        http2=HTTP2_AVAILABLE,
+        timeout=DEFAULT_TIMEOUT,
+        limits=DEFAULT_LIMITS,
+    )
+    _http_clients.move_to_end(store_url)
+    while len(_http_clients) > MAX_HTTP_CLIENTS:
+        _, evicted = _http_clients.popitem(last=False)
+        _retiring_http_clients[evicted] = detach(_retire_http_client(evicted))
+    return client
+
+
+def get_shopify_client(access_token: str, store_url: str) -> "ShopifyClient":
+    # リクエストごとに生成せず、ストアとトークンの組み合わせごとに使い回す。
+    # 未知のトークンは最初の呼び出しが成功するまで保持しない（_remember_client）
+    key = (store_key(store_url), access_token)
+    client = _shopify_clients.get(key)
+    if client is None:
+        return ShopifyClient(access_token=access_token, store_url=store_url)
+    _shopify_clients.move_to_end(key)
+    return client
+
+
+def _remember_client(client: "ShopifyClient") -> None:
+    key = (client.store, client.headers['X-Shopify-Access-Token'])
+    if key in _shopify_clients:
+        return
+    _shopify_clients[key] = client
+    while len(_shopify_clients) > MAX_SHOPIFY_CLIENTS:
+        _shopify_clients.popitem(last=False)
+
+
+def coalescing_stats() -> Dict[str, Dict[str, int]]:
+    # ストアごとに集計する（同じストアでもトークンごとに別々にまとめている）
+    stats: Dict[str, Dict[str, int]] = {}
+    for (store, _), client in _shopify_clients.items():
+        store_stats = stats.setdefault(store, {"executed": 0, "coalesced": 0, "in_flight": 0})
+        for name, value in client.singleflight.stats().items():
+            store_stats[name] += value
+    return stats
+
+
+async def close_http_clients() -> None:
+    # 閉じるのを待っているものも待たずに閉じる
+    clients = list(_http_clients.values()) + list(_retiring_http_clients)
+    for task in _retiring_http_clients.values():
+        task.cancel()
+    _http_clients.clear()
+    _retiring_http_clients.clear()
+    _shopify_clients.clear()
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
+
+
+class ShopifyThrottledError(Exception):
+    pass
+
+
+class ShopifyQueryError(Exception):
+    pass
+
+
+class ShopifyUnavailableError(Exception):
+    """5xx・通信エラーが再送しても解消しない、またはサーキットブレーカーが開いている"""
+    pass
+
+
+class ShopifyDeadlineExceeded(Exception):
+    """リクエストの期限までにShopifyの応答が得られなかった"""
+    pass
+
+
+# リクエストを送る前に失敗したことが確実な通信エラー（ミューテーションでも再送してよい）
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+def _attempt_timeout() -> httpx.Timeout:
+    # 期限の残りを超えて待たないよう、送信ごとにタイムアウトを切り詰める
+    left = remaining()
+    if left is None:
+        return DEFAULT_TIMEOUT
+    return httpx.Timeout(min(READ_TIMEOUT, left), connect=min(CONNECT_TIMEOUT, left))
+
+
+def _is_throttled(result: Dict[str, Any]) -> bool:
+    return any(
+        (error.get('extensions') or {}).get('code') == 'THROTTLED'
+        for error in result.get('errors') or []
+    )
+
 
 class ShopifyClient:
 
     def __init__(self, access_token: str, store_url: str):
-        self.store_url = f"https://{store_url}/admin/api/{SHOPIFY_GRAPHQL_API_VERSION}/graphql.json"
+        # キャッシュ・コストバケット・サーキットブレーカー・ミラーなど、ストア単位のキーはすべてこの値を使う
+        self.store = store_key(store_url)
+        # キャッシュ等で認証情報ごとに結果を分けるためのトークンの指紋
+        self.token_fingerprint = hashlib.sha256(access_token.encode("utf-8")).hexdigest()[:16]
+        self.store_url = graphql_url(self.store)
         self.headers = {
             'X-Shopify-Access-Token': access_token,
             'Content-Type': 'application/json'
         }
+        # 同一認証情報での同時リクエストをまとめる
+        self.singleflight = SingleFlight()
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        return get_http_client(self.store)
+
+    @property
+    def bucket(self) -> CostBucket:
+        return get_cost_bucket(self.store)
+
+    async def execute_query(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # 同じクエリ・変数のリクエストが実行中であれば、その結果を共有する（ミューテーションは除く）
+        # 共有された結果は複数の呼び出し元から参照されるため、変更しないこと
+        if query.lstrip().startswith("mutation"):
+            return await self._execute_query(query, variables, idempotent=False)
+        key = hashlib.sha256(
+            (query + json.dumps(variables or {}, sort_keys=True, separators=(",", ":"))).encode("utf-8")
+        ).hexdigest()
+        try:
+            return await self.singleflight.do(key, lambda: self._execute_query(query, variables))
+        except asyncio.TimeoutError:
+            # 共有の呼び出しは期限を持たないため、この呼び出し元の期限切れはここで判定される
+            raise ShopifyDeadlineExceeded(f"Request deadline exceeded while querying {self.store}")
+
+    async def _acquire(self, cost: float) -> None:
+        # バケットの回復待ちもリクエストの期限内に収める
+        left = remaining()
+        if left is not None and left <= 0:
+            raise ShopifyDeadlineExceeded(f"Request deadline exceeded before querying {self.store}")
+        with phase("cost_wait", store=self.store):
+            if left is None:
+                await self.bucket.acquire(cost)
+                return
+            try:
+                await asyncio.wait_for(self.bucket.acquire(cost), left)
+            except asyncio.TimeoutError:
+                raise ShopifyDeadlineExceeded(f"Request deadline exceeded while waiting for {self.store} rate limit")
 
-    def execute_query(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    async def _post(self, query: str, variables: Optional[Dict[str, Any]], cost: float) -> Tuple[httpx.Response, Optional[Dict[str, Any]]]:
+        """バケットから1回分を確保して送信する。確保したコストは結果にかかわらず必ず返却する。
+        429・5xx の場合はレスポンスだけを返し、結果はNone"""
+        await self._acquire(cost)
         try:
-            response = requests.post(
-                self.store_url,
-                headers=self.headers,
-                json={'query': query, 'variables': variables or {}}
-            )
-            response.raise_for_status()
-            return response.json()
+            started = time.perf_counter()
+            with phase("upstream", store=self.store):
+                response = await self.http.post(
+                    self.store_url,
+                    headers=self.headers,
+                    json={'query': query, 'variables': variables or {}},
+                    timeout=_attempt_timeout(),
+                )
+            elapsed = time.perf_counter() - started
+            if response.status_code == 429:
+                self.bucket.penalize()
+                record_shopify_response(self.store, 429, elapsed, len(response.content), None, throttled=True)
+                return response, None
+            if response.status_code >= 500:
+                self.bucket.update(None)
+                record_shopify_response(self.store, response.status_code, elapsed, len(response.content), None, throttled=False)
+                return response, None
+            if response.is_error:
+                record_shopify_response(self.store, response.status_code, elapsed, len(response.content), None, throttled=False)
+                response.raise_for_status()
+            with phase("decode", store=self.store):
+                result = response.json()
+        except BaseException:
+            self.bucket.update(None)
+            raise
+        cost_info = (result.get('extensions') or {}).get('cost')
+        throttled = _is_throttled(result)
+        if throttled:
+            self.bucket.penalize(cost_info)
+        else:
+            self.bucket.update(cost_info)
+        record_shopify_response(self.store, response.status_code, elapsed, len(response.content), cost_info, throttled)
+        return response, result
+
+    async def _execute_query(self, query: str, variables: Optional[Dict[str, Any]] = None, idempotent: bool = True) -> Dict[str, Any]:
+        """idempotent=False（ミューテーション）の場合、Shopifyが受け付けた可能性のある失敗
+        （読み取りのタイムアウト・切断・5xx）は二重に実行しないよう再送せずに返す。
+        接続前の失敗と 429・THROTTLED は実行されていないため再送する"""
+        # 送信前にコストを見積もり、バケットの残量が足りるまで待つ
+        cost = estimate_query_cost(query, variables)
+        breaker = get_circuit_breaker(self.store)
+        budget = get_retry_budget(self.store)
+        throttled = 0
+        failures = 0
+        try:
+            while True:
+                if not breaker.allow():
+                    raise ShopifyUnavailableError(f"Shopify API for {self.store} is failing; circuit is open")
+                try:
+                    response, result = await self._post(query, variables, cost)
+                except httpx.HTTPStatusError:
+                    # 4xx は再送しても変わらないため、そのまま返す（ストア自体は応答している）
+                    breaker.record_success()
+                    raise
+                except httpx.TransportError as e:
+                    left = remaining()
+                    if isinstance(e, httpx.TimeoutException) and left is not None and left <= 0:
+                        raise ShopifyDeadlineExceeded(f"Request deadline exceeded while querying {self.store}") from e
+                    failure = f"{type(e).__name__}: {e}"
+                    resendable = idempotent or isinstance(e, UNSENT_ERRORS)
+                else:
+                    if response.status_code < 500:
+                        breaker.record_success()
+                        if result is not None and not _is_throttled(result):
+                            budget.record_success()
+                            # トークンが通った時点でクライアントを使い回しの対象にする
+                            _remember_client(self)
+                            return result
+                        # THROTTLED / 429 はバケットの回復を待って再送する（再送の予算は使わない）
+                        throttled += 1
+                        if throttled > MAX_THROTTLE_RETRIES:
+                            raise ShopifyThrottledError(f"Shopify API throttled {self.store} after {MAX_THROTTLE_RETRIES} retries")
+                        continue
+                    failure = f"HTTP {response.status_code}"
+                    resendable = idempotent
+
+                # 5xx・通信エラー: 予算と期限の範囲で、ジッター付きの指数バックオフで再送する
+                breaker.record_failure()
+                budget.record_failure()
+                if not resendable:
+                    raise ShopifyUnavailableError(f"Shopify mutation for {self.store} may have been applied; not resending: {failure}")
+                delay = backoff_delay(failures)
+                failures += 1
+                left = remaining()
+                if failures > MAX_RETRIES or (left is not None and left <= delay) or not budget.allow_retry():
+                    raise ShopifyUnavailableError(f"Shopify API unavailable for {self.store} after {failures} attempts: {failure}")
+                logging.warning(f"Retrying Shopify query for {self.store} in {delay:.2f}s ({failure})")
+                await asyncio.sleep(delay)
         except Exception as e:
             logging.error(f"GraphQL query execution failed: {e}")
             raise
 
-    def get_products(self, first: int = 10) -> List[Dict[str, Any]]:
-       
-        variables = {"first": first}
-        result = self.execute_query(q_get_products, variables)
-        
-        if 'data' in result and 'products' in result['data']:
-            return [
-                {
-                    "id": int(node['id'].split('/')[-1]),
-                    "name": node['title'],
-                    "description": node['description'],
-                    "handle": node['handle'],
-                    "created_at": node['createdAt'],
-                    "updated_at": node['updatedAt'],
-                    "price": node['variants']['edges'][0]['node']['price'] if node['variants']['edges'] else None,
-                    "image_url": node['images']['edges'][0]['node']['url'] if node['images']['edges'] else None
-                }
-                for node in [edge['node'] for edge in result['data']['products']['edges']]
-            ]
-        return []
+    async def cached_query(self, query: str, variables: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        # エラーを含むレスポンスはキャッシュしない
+        return await get_response_cache().get_or_fetch(
+            self.store,
+            query,
+            variables,
+            lambda: self.execute_query(query, variables),
+            cacheable=lambda result: not result.get('errors'),
+            scope=self.token_fingerprint,
+        )
+
+    async def verify_access(self) -> None:
+        """アクセストークンがこのストアで有効かを確認する（結果はトークン単位でキャッシュされる）"""
+        result = await self.cached_query(q_get_shop)
+        if not (result.get('data') or {}).get('shop'):
+            raise ShopifyQueryError(f"Access check failed for {self.store}: {result.get('errors')}")
+
+    async def invalidate_cache(self) -> int:
+        return await get_response_cache().invalidate(self.store)
+
+    async def get_products(self, first: int = 10, fields: Optional[Tuple[str, ...]] = None) -> List[Dict[str, Any]]:
+        rows, _ = await self.get_products_page(first=first, cache=True, fields=fields)
+        return [row for _, row in rows]
+
+    async def get_products_page(
+        self,
+        first: int = 10,
+        after: Optional[str] = None,
+        cache: bool = False,
+        fields: Optional[Tuple[str, ...]] = None,
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+        # (エッジカーソル, 商品) のリストと次ページのカーソルを返す
+        query, parse = _query_and_parser("products", "products", q_get_products, parse_product, fields)
+        variables = {"first": first, "after": after}
+        if cache:
+            result = await self.cached_query(query, variables)
+        else:
+            result = await self.execute_query(query, variables)
 
-    def get_product(self, product_id: int) -> Optional[Dict[str, Any]]:
+        if 'data' in result and result['data'].get('products'):
+            connection = result['data']['products']
+            with phase("parse"):
+                rows = [(edge['cursor'], parse(edge['node'])) for edge in connection['edges']]
+            page_info = connection['pageInfo']
+            return rows, page_info['endCursor'] if page_info['hasNextPage'] else None
+        return [], None
+
+    def iter_products(
+        self,
+        page_size: int = 250,
+        after: Optional[str] = None,
+        fields: Optional[Tuple[str, ...]] = None,
+    ) -> AsyncIterator[List[Tuple[str, Dict[str, Any]]]]:
+        query, _ = _query_and_parser("products", "products", q_get_products, parse_product, fields)
+        return _iter_pages(partial(self.get_products_page, fields=fields), fit_page_size(query, page_size), after)
+
+    async def get_product(self, product_id: int, fields: Optional[Tuple[str, ...]] = None) -> Optional[Dict[str, Any]]:
        
+        query, parse = _query_and_parser("product", "products", q_get_product, parse_product, fields)
         variables = {"id": f"gid://shopify/Product/{product_id}"}
-        result = self.execute_query(q_get_product, variables)
+        result = await self.cached_query(query, variables)
         
         if 'data' in result and 'product' in result['data'] and result['data']['product']:
-            product = result['data']['product']
-            return {
-                "id": int(product['id'].split('/')[-1]),
-                "name": product['title'],
-                "description": product['description'],
-                "handle": product['handle'],
-                "created_at": product['createdAt'],
-                "updated_at": product['updatedAt'],
-                "price": product['variants']['edges'][0]['node']['price'] if product['variants']['edges'] else None,
-                "image_url": product['images']['edges'][0]['node']['url'] if product['images']['edges'] else None
-            }
+            with phase("parse"):
+                return parse(result['data']['product'])
         return None
 
-    def get_orders(self, first: int = 10) -> List[Dict[str, Any]]:
-       
-        variables = {"first": first}
-        result = self.execute_query(q_get_orders, variables)
-        
-        if 'data' in result and 'orders' in result['data']:
-            return [
-                {
-                    "id": int(node['id'].split('/')[-1]),
-                    "order_number": node['name'],
-                    "total_price": float(node['totalPriceSet']['shopMoney']['amount']),
-                    "created_at": node['createdAt'],
-                    "items": [
-                        {
-                            "product_id": int(item['node']['product']['id'].split('/')[-1]) if item['node']['product'] else None,
-                            "variant_id": int(item['node']['variant']['id'].split('/')[-1]) if item['node']['variant'] else None,
-                            "title": item['node']['title'],
-                            "quantity": item['node']['quantity'],
-                            "price": float(item['node']['originalUnitPrice'])
-                        }
-                        for item in node['lineItems']['edges']
-                    ]
-                }
-                for node in [edge['node'] for edge in result['data']['orders']['edges']]
-            ]
-        return []
-
-    def get_customer_orders(self, customer_id: str, first: int = 10) -> List[Dict[str, Any]]:
-        variables = {
-            "customerId": f"gid://shopify/Customer/{customer_id}",
-            "first": first
-        }
-        result = self.execute_query(q_get_customer_orders, variables)
+    async def get_products_by_ids(self, product_ids: List[int], fields: Optional[Tuple[str, ...]] = None) -> List[Optional[Dict[str, Any]]]:
+        # 指定順に並べ、存在しないIDはNoneとして返す
+        query, parse = _query_and_parser("products_by_ids", "products", q_get_products_by_ids, parse_product, fields)
+        gids = [f"gid://shopify/Product/{product_id}" for product_id in product_ids]
+        nodes = await self.get_nodes(query, gids)
+        with phase("parse"):
+            return [parse(nodes[gid]) if nodes.get(gid) else None for gid in gids]
+
+    async def get_customers_by_ids(
+        self,
+        customer_ids: List[str],
+        first: int = 10,
+        fields: Optional[Tuple[str, ...]] = None,
+    ) -> List[Optional[Dict[str, Any]]]:
+        query, parse = _query_and_parser("customers_by_ids", "customers", q_get_customers_by_ids, parse_customer, fields)
+        gids = [f"gid://shopify/Customer/{customer_id}" for customer_id in customer_ids]
+        variables = {"first": first} if uses_variable(query, "first") else {}
+        nodes = await self.get_nodes(query, gids, variables)
+        customers = await self._complete_customer_orders([nodes.get(gid) for gid in gids])
+        with phase("parse"):
+            return [parse(customer) if customer else None for customer in customers]
+
+    async def get_nodes(self, query: str, ids: List[str], variables: Optional[Dict[str, Any]] = None) -> Dict[str, Optional[Dict[str, Any]]]:
+        """nodes(ids:) クエリをコスト上限に収まるようにIDを分割し、並行して実行する。
+        GID -> ノード（該当なしはNone）の辞書を返す"""
+        variables = variables or {}
+        unique_ids = list(dict.fromkeys(ids))
+        if not unique_ids:
+            return {}
+        per_node_cost = estimate_query_cost(query, {**variables, "ids": unique_ids[:1]})
+        chunk_size = max(1, min(MAX_NODES_PER_QUERY, int(MAX_QUERY_COST // per_node_cost)))
+        chunks = [unique_ids[i:i + chunk_size] for i in range(0, len(unique_ids), chunk_size)]
+        results = await asyncio.gather(
+            *(self.execute_query(query, {**variables, "ids": chunk}) for chunk in chunks)
+        )
+
+        nodes: Dict[str, Optional[Dict[str, Any]]] = {}
+        for chunk, result in zip(chunks, results):
+            data = result.get('data') or {}
+            if data.get('nodes') is None:
+                raise ShopifyQueryError(f"nodes query failed: {result.get('errors')}")
+            for gid, node in zip(chunk, data['nodes']):
+                # 型が一致しないノードは空のオブジェクトで返ってくる
+                nodes[gid] = node or None
+        return nodes
+
+    async def get_orders(self, first: int = 10, fields: Optional[Tuple[str, ...]] = None) -> List[Dict[str, Any]]:
+        rows, _ = await self.get_orders_page(first=first, fields=fields)
+        return [row for _, row in rows]
+
+    async def get_orders_page(
+        self,
+        first: int = 10,
+        after: Optional[str] = None,
+        fields: Optional[Tuple[str, ...]] = None,
+    ) -> Tuple[List[Tuple[str, Dict[str, Any]]], Optional[str]]:
+        # (エッジカーソル, 注文) のリストと次ページのカーソルを返す
+        query, parse = _query_and_parser("orders", "orders", q_get_orders, parse_order, fields)
+        variables = {"first": first, "after": after}
+        result = await self.execute_query(query, variables)
+
+        if 'data' in result and result['data'].get('orders'):
+            connection = result['data']['orders']
+            orders = await self.complete_line_items([edge['node'] for edge in connection['edges']])
+            with phase("parse"):
+                rows = [(edge['cursor'], parse(order)) for edge, order in zip(connection['edges'], orders)]
+            page_info = connection['pageInfo']
+            return rows, page_info['endCursor'] if page_info['hasNextPage'] else None
+        return [], None
+
+    def iter_orders(
+        self,
+        page_size: int = 250,
+        after: Optional[str] = None,
+        fields: Optional[Tuple[str, ...]] = None,
+    ) -> AsyncIterator[List[Tuple[str, Dict[str, Any]]]]:
+        query, _ = _query_and_parser("orders", "orders", q_get_orders, parse_order, fields)
+        return _iter_pages(partial(self.get_orders_page, fields=fields), fit_page_size(query, page_size), after)
+
+    async def get_customer_orders(
+        self,
+        customer_id: str,
+        first: int = 10,
+        fields: Optional[Tuple[str, ...]] = None,
+    ) -> Optional[Dict[str, Any]]:
+        query, parse = _query_and_parser("customer", "customers", q_get_customer_orders, parse_customer, fields)
+        variables = {"customerId": f"gid://shopify/Customer/{customer_id}"}
+        if uses_variable(query, "first"):
+            variables["first"] = first
+        result = await self.execute_query(query, variables)
         
         if ('data' in result and 'customer' in result['data'] and 
             result['data']['customer']):
-            customer = result['data']['customer']
-            return {
-                "created_at": customer['createdAt'],
-                "display_name": customer['displayName'],
-                "email": customer['email'],
-                "phone": customer['phone'],
-                "tags": customer['tags'],
-                "product_subscriber_status": customer['productSubscriberStatus'],
-                "last_order": {
-                    "items": [
-                        {
-                            "product_id": int(item['node']['product']['id'].split('/')[-1]) if item['node']['product'] else None,
-                            "variant_id": int(item['node']['variant']['id'].split('/')[-1]) if item['node']['variant'] else None,
-                            "title": item['node']['title'],
-                            "quantity": item['node']['quantity'],
-                            "price": float(item['node']['originalUnitPrice'])
-                        }
-                        for item in customer['lastOrder']['lineItems']['edges']
-                    ]
-                } if customer.get('lastOrder') else None,
-                "default_address": {
-                    "address1": customer['defaultAddress']['address1'],
-                    "address2": customer['defaultAddress']['address2'],
-                    "city": customer['defaultAddress']['city'],
-                    "country": customer['defaultAddress']['country'],
-                    "province": customer['defaultAddress']['province'],
-                    "zip": customer['defaultAddress']['zip']
-                } if customer.get('defaultAddress') else None,
-                "orders": [
-                    {
-                        "id": int(node['id'].split('/')[-1]),
-                        "order_number": node['name'],
-                        "total_price": float(node['totalPriceSet']['shopMoney']['amount']),
-                        "created_at": node['createdAt'],
-                        "items": [
-                            {
-                                "product_id": int(item['node']['product']['id'].split('/')[-1]) if item['node']['product'] else None,
-                                "variant_id": int(item['node']['variant']['id'].split('/')[-1]) if item['node']['variant'] else None,
-                                "title": item['node']['title'],
-                                "quantity": item['node']['quantity'],
-                                "price": float(item['node']['originalUnitPrice'])
-                            }
-                            for item in node['lineItems']['edges']
-                        ]
-                    }
-                    for node in [edge['node'] for edge in customer['orders']['edges']]
-                ]
-            }
-        return None
\ No newline at end of file
+            customers = await self._complete_customer_orders([result['data']['customer']])
+            with phase("parse"):
+                return parse(customers[0])
+        return None
+
+    async def complete_line_items(self, orders: List[Optional[Dict[str, Any]]]) -> List[Optional[Dict[str, Any]]]:
+        """lineItems の hasNextPage が true の注文について残りのページを取得し、
+        全明細を持つ新しいノードに置き換えたリストを返す。
+        複数の注文の続きはエイリアスで1クエリにまとめ、同時実行数を制限して取得する。
+        取得結果は同時リクエストと共有されるため、元のノードは変更しない"""
+        cursors: Dict[str, Optional[str]] = {}
+        for order in orders:
+            page_info = ((order or {}).get('lineItems') or {}).get('pageInfo') or {}
+            if page_info.get('hasNextPage') and order.get('id'):
+                cursors[order['id']] = page_info['endCursor']
+        if not cursors:
+            return orders
+
+        per_order_cost = estimate_query_cost(build_line_items_query(1, LINE_ITEMS_PAGE_SIZE))
+        orders_per_query = max(1, int(MAX_QUERY_COST // per_order_cost))
+        semaphore = asyncio.Semaphore(LINE_ITEMS_CONCURRENCY)
+        extra_edges: Dict[str, List[Dict[str, Any]]] = {order_id: [] for order_id in cursors}
+
+        async def fetch(chunk: List[Tuple[str, Optional[str]]]) -> Dict[str, Any]:
+            query = build_line_items_query(len(chunk), LINE_ITEMS_PAGE_SIZE)
+            variables = {}
+            for i, (order_id, after) in enumerate(chunk):
+                variables[f"id{i}"] = order_id
+                variables[f"after{i}"] = after
+            async with semaphore:
+                result = await self.execute_query(query, variables)
+            if not result.get('data'):
+                raise ShopifyQueryError(f"line items query failed: {result.get('errors')}")
+            return result['data']
+
+        # ページごとに、まだ続きがある注文だけを次のラウンドで取得する
+        while cursors:
+            pending = list(cursors.items())
+            chunks = [pending[i:i + orders_per_query] for i in range(0, len(pending), orders_per_query)]
+            results = await asyncio.gather(*(fetch(chunk) for chunk in chunks))
+            cursors = {}
+            for chunk, data in zip(chunks, results):
+                for i, (order_id, _) in enumerate(chunk):
+                    connection = (data.get(f"o{i}") or {}).get('lineItems')
+                    if not connection:
+                        continue
+                    extra_edges[order_id].extend(connection['edges'])
+                    if connection['pageInfo']['hasNextPage']:
+                        cursors[order_id] = connection['pageInfo']['endCursor']
+
+        completed: List[Optional[Dict[str, Any]]] = []
+        for order in orders:
+            if order and extra_edges.get(order.get('id')):
+                order = {
+                    **order,
+                    'lineItems': {
+                        'pageInfo': {'hasNextPage': False, 'endCursor': None},
+                        'edges': order['lineItems']['edges'] + extra_edges[order['id']],
+                    },
+                }
+            completed.append(order)
+        return completed
+
+    async def _complete_customer_orders(self, customers: List[Optional[Dict[str, Any]]]) -> List[Optional[Dict[str, Any]]]:
+        # 顧客の lastOrder と orders の明細をまとめて補完する
+        orders: List[Optional[Dict[str, Any]]] = []
+        for customer in customers:
+            if not customer:
+                continue
+            orders.append(customer.get('lastOrder'))
+            orders.extend(edge['node'] for edge in (customer.get('orders') or {}).get('edges', []))
+        completed = iter(await self.complete_line_items(orders))
+
+        results: List[Optional[Dict[str, Any]]] = []
+        for customer in customers:
+            if not customer:
+                results.append(customer)
+                continue
+            last_order = next(completed)
+            customer = dict(customer)
+            if customer.get('lastOrder') is not None:
+                customer['lastOrder'] = last_order
+            if customer.get('orders') is not None:
+                customer['orders'] = {
+                    **customer['orders'],
+                    'edges': [{**edge, 'node': next(completed)} for edge in customer['orders']['edges']],
+                }
+            results.append(customer)
+        return results
+
+
+def fit_page_size(query: str, page_size: int = MAX_NODES_PER_QUERY) -> int:
+    # 1ページのコストがクエリの上限を超えないよう件数を抑える（超えるとShopifyに拒否される）
+    per_node_cost = estimate_query_cost(query, {"first": 1})
+    return max(1, min(page_size, int(MAX_QUERY_COST // per_node_cost)))
+
+
+def _query_and_parser(
+    kind: str,
+    resource: str,
+    default_query: str,
+    default_parser: Callable[[Dict[str, Any]], Dict[str, Any]],
+    fields: Optional[Tuple[str, ...]],
+) -> Tuple[str, Callable[[Dict[str, Any]], Dict[str, Any]]]:
+    # fieldsが指定されていれば、必要なフィールドだけのクエリと対応するパーサを使う
+    if fields is None:
+        return default_query, default_parser
+    return build_query(kind, fields), partial(project, resource, fields=fields)
+
+
+async def _iter_pages(fetch_page, page_size: int, after: Optional[str]) -> AsyncIterator[List[Tuple[str, Dict[str, Any]]]]:
+    # 現在のページを返している間に次のページを先読みする（メモリ上は最大2ページ）
+    pending = asyncio.ensure_future(fetch_page(first=page_size, after=after))
+    try:
+        while pending is not None:
+            rows, next_cursor = await pending
+            pending = None
+            if next_cursor:
+                pending = asyncio.ensure_future(fetch_page(first=page_size, after=next_cursor))
+            if rows:
+                yield rows
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,63 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict
+
+from app.resilience import detach, remaining
+
+
+class _Call:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task: "asyncio.Future[Any]"):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """同じキーの呼び出しが実行中であれば、新たに実行せずその結果を待つ。
+    実行は最初の呼び出し元の期限を引き継がない独立したタスクで行い、各待機者は自分の期限（remaining()）まで待つ。
+    最初の呼び出し元がキャンセルされても他の待機者には影響せず、待機者が全員いなくなった時点で実行を止める"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self.executed = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """期限までに結果が得られなければ asyncio.TimeoutError を送出する"""
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+        else:
+            self.executed += 1
+            call = _Call(detach(fn()))
+            self._calls[key] = call
+            call.task.add_done_callback(lambda done: self._forget(key, done))
+        call.waiters += 1
+        try:
+            left = remaining()
+            if left is None:
+                return await asyncio.shield(call.task)
+            return await asyncio.wait_for(asyncio.shield(call.task), max(left, 0))
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _forget(self, key: str, task: "asyncio.Future[Any]") -> None:
+        call = self._calls.get(key)
+        if call is not None and call.task is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # 待機者が全員キャンセルされていても例外を回収済みにする
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "executed": self.executed,
+            "coalesced": self.coalesced,
+            "in_flight": self.in_flight,
+        }
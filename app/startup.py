@@ -0,0 +1,98 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# app/main.py が最初に読み込むため、ほぼインポート開始時刻になる
+_started = time.perf_counter()
+# 起動の各段階の所要時間（ミリ秒）
+_phases: Dict[str, float] = {}
+_ready_ms: Optional[float] = None
+_first_response_ms: Optional[float] = None
+
+# 起動直後にFirestoreのチャネルを接続しておくドキュメント（存在しなくてよい）
+WARMUP_COLLECTION = "shopify-dify-tool-warmup"
+
+
+def _elapsed_ms(since: float) -> float:
+    return round((time.perf_counter() - since) * 1000, 1)
+
+
+@contextmanager
+def phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = _elapsed_ms(started)
+
+
+def mark_ready() -> None:
+    global _ready_ms
+    _ready_ms = _elapsed_ms(_started)
+
+
+def mark_response() -> None:
+    global _first_response_ms
+    if _first_response_ms is None:
+        _first_response_ms = _elapsed_ms(_started)
+
+
+def startup_report() -> Dict[str, Any]:
+    return {
+        "phases_ms": dict(_phases),
+        "ready_ms": _ready_ms,
+        "first_response_ms": _first_response_ms,
+    }
+
+
+def warmup_enabled() -> bool:
+    return os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true", "yes")
+
+
+def warmup_stores() -> List[str]:
+    # SHOPIFY_WARMUP_STORES（カンマ区切り）がなければ、定期同期の対象ストア（SHOPIFY_SYNC_STORES）を使う
+    raw = os.getenv("SHOPIFY_WARMUP_STORES")
+    if raw:
+        return [store.strip() for store in raw.split(",") if store.strip()]
+    try:
+        return [store["store_url"] for store in json.loads(os.getenv("SHOPIFY_SYNC_STORES") or "[]")]
+    except (ValueError, KeyError, TypeError):
+        return []
+
+
+def _warm_firestore() -> None:
+    from app.database import get_db
+
+    with phase("warmup.firestore_client"):
+        db = get_db()
+    # 最初のRPCでgRPCチャネルの接続と認証トークンの取得が行われる
+    with phase("warmup.firestore_connect"):
+        db.collection(WARMUP_COLLECTION).document("warmup").get()
+
+
+async def _warm_store(store: str) -> None:
+    from app.mirror import store_key
+    from app.shopify import get_http_client, graphql_url
+
+    # DNS解決とTLSハンドシェイクを済ませ、接続をプールに残す（認証なしのため応答は401でよい）
+    store = store_key(store)
+    with phase(f"warmup.shopify.{store}"):
+        await get_http_client(store).head(graphql_url(store), timeout=5.0)
+
+
+async def warm_up() -> None:
+    """起動後にバックグラウンドでFirestoreとShopifyへの接続を準備する。失敗しても起動は止めない"""
+    stores = warmup_stores()
+    results = await asyncio.gather(
+        asyncio.to_thread(_warm_firestore),
+        *(_warm_store(store) for store in stores),
+        return_exceptions=True,
+    )
+    for name, result in zip(["firestore"] + stores, results):
+        if isinstance(result, Exception):
+            logging.warning(f"Warm-up failed for {name}: {result}")
+    logging.info(f"Startup report: {startup_report()}")
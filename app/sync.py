@@ -0,0 +1,87 @@
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+from app.graphql_query import q_sync_orders, q_sync_products
+from app.mirror import store_key, write_records
+from app.parsers import parse_order, parse_product
+from app.search import get_search_indexes
+from app.shopify import ShopifyClient, ShopifyQueryError, fit_page_size
+
+# ストアごとの同期状態: shopify-sync-state/{store} の {resource: {high_water_mark, ...}}
+SYNC_STATE_COLLECTION = "shopify-sync-state"
+
+# resource -> (差分取得クエリ, パーサ)
+SYNC_RESOURCES: Dict[str, Tuple[str, Callable[[Dict[str, Any]], Dict[str, Any]]]] = {
+    "orders": (q_sync_orders, parse_order),
+    "products": (q_sync_products, parse_product),
+}
+
+
+class DeltaSyncJob:
+    """updated_at の高水位点以降に更新された注文・商品を取得し、Firestoreのミラーへupsertする。
+    ページごとにデータと高水位点を同じバッチでコミットするため、途中で失敗しても次回はその続きから同期する"""
+
+    def __init__(self, db, client: ShopifyClient):
+        self.db = db
+        self.client = client
+        self.state_ref = db.collection(SYNC_STATE_COLLECTION).document(store_key(client.store))
+
+    async def run(self, resources: Optional[Iterable[str]] = None) -> Dict[str, Any]:
+        resources = list(resources or SYNC_RESOURCES)
+        unknown = [resource for resource in resources if resource not in SYNC_RESOURCES]
+        if unknown:
+            raise ValueError(f"Unsupported sync resource: {', '.join(unknown)}")
+        snapshot = await asyncio.to_thread(self.state_ref.get)
+        state = snapshot.to_dict() if snapshot.exists else {}
+        results = {}
+        for resource in resources:
+            results[resource] = await self._sync(resource, state.get(resource) or {})
+        return results
+
+    async def _sync(self, resource: str, state: Dict[str, Any]) -> Dict[str, Any]:
+        query, parse = SYNC_RESOURCES[resource]
+        high_water_mark = state.get("high_water_mark")
+        # 同じ時刻に更新されたレコードを取りこぼさないよう境界を含める（upsertなので重複しても問題ない）
+        search = f"updated_at:>='{high_water_mark}'" if high_water_mark else None
+        page_size = fit_page_size(query)
+        after = None
+        records_written = 0
+
+        while True:
+            result = await self.client.execute_query(query, {"first": page_size, "after": after, "query": search})
+            connection = (result.get("data") or {}).get(resource)
+            if connection is None:
+                raise ShopifyQueryError(f"{resource} sync query failed: {result.get('errors')}")
+            nodes = [edge["node"] for edge in connection["edges"]]
+            if resource == "orders":
+                nodes = await self.client.complete_line_items(nodes)
+
+            if nodes:
+                high_water_mark = nodes[-1]["updatedAt"]
+                checkpoint = {
+                    resource: {
+                        "high_water_mark": high_water_mark,
+                        "synced_at": datetime.now(timezone.utc).isoformat(),
+                    }
+                }
+                records = [parse(node) for node in nodes]
+                records_written += await asyncio.to_thread(
+                    write_records,
+                    self.db,
+                    self.client.store,
+                    resource,
+                    records,
+                    (self.state_ref, checkpoint),
+                )
+                if resource == "products":
+                    get_search_indexes().upsert(self.client.store, records)
+
+            page_info = connection["pageInfo"]
+            if not page_info["hasNextPage"]:
+                break
+            after = page_info["endCursor"]
+
+        logging.info(f"Synced {records_written} {resource} for {self.client.store} up to {high_water_mark}")
+        return {"records_written": records_written, "high_water_mark": high_water_mark}
@@ -1,8 +1,110 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+import asyncio
+import json
+import logging
+import os
+from app.bulk import BulkExportJob, BulkOperationError
+from app.database import get_db
+from app.models import ShopifyCredentials, TaskRequest
+from app.rfm import CustomerSummaryJob
+from app.shopify import ShopifyClient, get_shopify_client
+from app.sync import DeltaSyncJob
 
 router = APIRouter()
 
+def _configured_stores() -> List[ShopifyCredentials]:
+    # 定期実行（リクエストボディなし）で同期するストア: SHOPIFY_SYNC_STORES='[{"store_url": ..., "access_token": ...}]'
+    raw = os.getenv("SHOPIFY_SYNC_STORES")
+    if not raw:
+        return []
+    return [ShopifyCredentials(**store) for store in json.loads(raw)]
+
+def _request_stores(request: TaskRequest) -> List[ShopifyCredentials]:
+    return request.stores or ([request.credentials] if request.credentials else [])
+
+async def _run_per_store(
+    name: str,
+    stores: List[ShopifyCredentials],
+    run: Callable[[ShopifyClient], Awaitable[Dict[str, Any]]],
+) -> Dict[str, Any]:
+    # ストアごとに独立して実行し、1ストアの失敗で他のストアを止めない
+    async def run_store(credentials: ShopifyCredentials) -> Dict[str, Any]:
+        shopify_client = get_shopify_client(
+            access_token=credentials.access_token,
+            store_url=credentials.store_url
+        )
+        return await run(shopify_client)
+
+    results = await asyncio.gather(*(run_store(store) for store in stores), return_exceptions=True)
+    report = {}
+    for store, result in zip(stores, results):
+        if isinstance(result, ValueError):
+            raise result
+        if isinstance(result, Exception):
+            logging.error(f"{name} failed for {store.store_url}: {result}")
+            report[store.store_url] = {"error": str(result)}
+        else:
+            report[store.store_url] = result
+    failed = [store for store, result in report.items() if "error" in result]
+    if failed and len(failed) == len(report):
+        raise HTTPException(status_code=502, detail=f"{name} failed for all stores: {report}")
+    return report
+
 @router.post("/tasks/execute")
-def execute_task():
-    # Example of scheduled task logic
-    return {"message": "Scheduled task executed successfully"}
+async def execute_task(request: Optional[TaskRequest] = None):
+    if request is None or request.task == "delta_sync":
+        # Cloud Scheduler から定期的に呼ばれ、前回の高水位点以降の注文・商品をミラーへ反映する
+        if request is None:
+            stores = _configured_stores()
+        else:
+            stores = _request_stores(request)
+        if not stores:
+            if request is None:
+                return {"message": "No stores configured for delta sync"}
+            raise HTTPException(status_code=400, detail="delta_sync requires credentials or stores.")
+        resources = [request.resource] if request is not None and request.resource else None
+        try:
+            report = await _run_per_store(
+                "Delta sync", stores, lambda shopify_client: DeltaSyncJob(get_db(), shopify_client).run(resources)
+            )
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
+        return {"message": "Delta sync finished", "stores": report}
+
+    if request.task == "customer_summaries":
+        # 顧客ごとのRFM・LTVを集計する。restart=true で全件を再集計し、スコアの境界も更新する
+        stores = _request_stores(request)
+        if not stores:
+            raise HTTPException(status_code=400, detail="customer_summaries requires credentials or stores.")
+        report = await _run_per_store(
+            "Customer summaries",
+            stores,
+            lambda shopify_client: CustomerSummaryJob(get_db(), shopify_client).run(full=request.restart),
+        )
+        return {"message": "Customer summaries finished", "stores": report}
+
+    if request.task == "bulk_export":
+        # Cloud Scheduler / Cloud Tasks から呼ばれる想定。失敗時は同じリクエストの再送で続きから取り込む
+        if request.credentials is None or request.resource is None:
+            raise HTTPException(status_code=400, detail="bulk_export requires credentials and resource.")
+        try:
+            shopify_client = get_shopify_client(
+                access_token=request.credentials.access_token,
+                store_url=request.credentials.store_url
+            )
+            job = BulkExportJob(get_db(), shopify_client, request.resource, job_id=request.job_id)
+            state = await job.run(restart=request.restart)
+            # ダウンロード用の署名付きURLは返さない
+            state.pop("url", None)
+            return {"message": "Bulk export finished", "job_id": job.job_id, **state}
+        except ValueError as ve:
+            raise HTTPException(status_code=400, detail=str(ve))
+        except BulkOperationError as be:
+            logging.error(f"Bulk export failed: {be}")
+            raise HTTPException(status_code=502, detail=str(be))
+        except Exception as e:
+            logging.error(f"Error running bulk export: {e}")
+            raise HTTPException(status_code=500, detail=f"Failed to run bulk export: {str(e)}")
+
+    raise HTTPException(status_code=400, detail=f"Unknown task: {request.task}")
@@ -0,0 +1,245 @@
+import asyncio
+import re
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+# Shopify標準プランのバケット（Plusは2000 / 100）。最初のレスポンスで実際の値に置き換わる
+DEFAULT_MAXIMUM_AVAILABLE = 1000.0
+DEFAULT_RESTORE_RATE = 50.0
+# 1クエリあたりのコスト上限（プランに関係なく1000）
+MAX_QUERY_COST = 1000.0
+
+_TOKEN_RE = re.compile(
+    r'"(?:\\.|[^"\\])*"|\.\.\.|\$?[A-Za-z_][A-Za-z0-9_]*|-?\d+(?:\.\d+)?|[{}():\[\]!=@]'
+)
+# コネクションではなく単なる入れ物として扱うフィールド
+_WRAPPER_FIELDS = {"edges"}
+_FREE_FIELDS = {"pageInfo"}
+
+
+class _Field:
+    __slots__ = ("name", "page_size", "children")
+
+    def __init__(self, name: str, page_size: Optional[str], children: Optional[List["_Field"]]):
+        self.name = name
+        self.page_size = page_size
+        self.children = children
+
+
+def _parse_selection(tokens: List[str], pos: int) -> Tuple[List[_Field], int]:
+    # tokens[pos] は "{" の直後
+    fields: List[_Field] = []
+    while pos < len(tokens) and tokens[pos] != "}":
+        token = tokens[pos]
+        if token == "...":
+            # インラインフラグメント: "... on Type { ... }"
+            pos += 1
+            while tokens[pos] != "{":
+                pos += 1
+            children, pos = _parse_selection(tokens, pos + 1)
+            fields.append(_Field("...", None, children))
+            continue
+        name = token
+        pos += 1
+        if pos < len(tokens) and tokens[pos] == ":":
+            # エイリアス
+            name = tokens[pos + 1]
+            pos += 2
+        page_size = None
+        if pos < len(tokens) and tokens[pos] == "(":
+            depth = 0
+            while True:
+                if tokens[pos] == "(":
+                    depth += 1
+                elif tokens[pos] == ")":
+                    depth -= 1
+                    if depth == 0:
+                        break
+                elif tokens[pos] in ("first", "last") and tokens[pos + 1] == ":":
+                    page_size = tokens[pos + 2]
+                elif tokens[pos] == "ids" and tokens[pos + 1] == ":" and tokens[pos + 2].startswith("$"):
+                    # nodes(ids: $ids) は渡したIDの数だけオブジェクトを返す
+                    page_size = "#" + tokens[pos + 2]
+                pos += 1
+            pos += 1
+        while pos < len(tokens) and tokens[pos] == "@":
+            # ディレクティブ（@include など）は読み飛ばす
+            pos += 2
+            if pos < len(tokens) and tokens[pos] == "(":
+                while tokens[pos] != ")":
+                    pos += 1
+                pos += 1
+        children = None
+        if pos < len(tokens) and tokens[pos] == "{":
+            children, pos = _parse_selection(tokens, pos + 1)
+        fields.append(_Field(name, page_size, children))
+    return fields, pos + 1
+
+
+@lru_cache(maxsize=256)
+def _parse_query(query: str) -> Tuple[_Field, ...]:
+    tokens = _TOKEN_RE.findall(query)
+    start = tokens.index("{")
+    # 変数定義のデフォルト値に "{" が含まれることはないため、最初の "{" がルートの選択セット
+    fields, _ = _parse_selection(tokens, start + 1)
+    return tuple(fields)
+
+
+def _fields_cost(fields, variables: Dict[str, Any]) -> float:
+    return sum(_field_cost(field, variables) for field in fields)
+
+
+def _field_cost(field: _Field, variables: Dict[str, Any]) -> float:
+    if field.children is None or field.name in _FREE_FIELDS:
+        # スカラー / Enum は0
+        return 0.0
+    children_cost = _fields_cost(field.children, variables)
+    if field.name in _WRAPPER_FIELDS or field.name == "...":
+        return children_cost
+    if field.page_size is not None and field.page_size.startswith("#"):
+        count = len(variables.get(field.page_size[2:]) or [])
+        return count * (1.0 + children_cost)
+    if field.page_size is not None:
+        size = field.page_size
+        if size.startswith("$"):
+            size = variables.get(size[1:]) or 0
+        # コネクション: 2 + 取得件数 × 子要素のコスト
+        return 2.0 + float(size) * children_cost
+    # オブジェクト: 1 + 子要素のコスト
+    return 1.0 + children_cost
+
+
+def estimate_query_cost(query: str, variables: Optional[Dict[str, Any]] = None) -> float:
+    """Shopifyの計算方法に沿ってクエリの requestedQueryCost を事前に見積もる"""
+    try:
+        fields = _parse_query(query)
+    except (ValueError, IndexError):
+        return DEFAULT_MAXIMUM_AVAILABLE / 10
+    return max(_fields_cost(fields, variables or {}), 1.0)
+
+
+class CostBucket:
+    """ストアごとのリーキーバケット。レスポンスの throttleStatus で残量を補正し、
+    足りない場合は回復するまで待ってから送信する（FIFO）"""
+
+    def __init__(self, maximum_available: float = DEFAULT_MAXIMUM_AVAILABLE, restore_rate: float = DEFAULT_RESTORE_RATE):
+        self.maximum_available = maximum_available
+        self.restore_rate = restore_rate
+        self.currently_available = maximum_available
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+        # 待っている acquire を update() で起こす（ロックを持つ1件だけが待つ）
+        self._changed: Optional[asyncio.Event] = None
+
+        self.queue_depth = 0
+        self.in_flight = 0
+        self.requests = 0
+        self.throttled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.requested_cost = 0.0
+        self.actual_cost = 0.0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self.currently_available = min(
+            self.maximum_available,
+            self.currently_available + elapsed * self.restore_rate
+        )
+
+    def wait_time(self, cost: float) -> float:
+        self._refill()
+        cost = min(cost, self.maximum_available)
+        if self.currently_available >= cost:
+            return 0.0
+        return (cost - self.currently_available) / self.restore_rate
+
+    async def acquire(self, cost: float) -> float:
+        """コスト分の残量を確保する。待った秒数を返す"""
+        cost = min(cost, self.maximum_available)
+        self.queue_depth += 1
+        started = time.monotonic()
+        try:
+            async with self._lock:
+                delay = self.wait_time(cost)
+                while delay > 0:
+                    # 初回のレスポンスで実際の上限・回復速度がわかったら、既定値で見積もった待ち時間を計算し直す
+                    self._changed = asyncio.Event()
+                    try:
+                        await asyncio.wait_for(self._changed.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    delay = self.wait_time(cost)
+                cost = min(cost, self.maximum_available)
+                self.currently_available -= cost
+                self.in_flight += 1
+        finally:
+            self.queue_depth -= 1
+        waited = time.monotonic() - started
+        self.requests += 1
+        self.requested_cost += cost
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        return waited
+
+    def update(self, cost: Optional[Dict[str, Any]]) -> None:
+        """レスポンスの extensions.cost でバケットの状態を補正する。acquire 1回につき1回呼ぶ"""
+        self.in_flight = max(self.in_flight - 1, 0)
+        if not cost:
+            return
+        status = cost.get("throttleStatus") or {}
+        self._refill()
+        if status.get("maximumAvailable"):
+            self.maximum_available = float(status["maximumAvailable"])
+        if status.get("restoreRate"):
+            self.restore_rate = float(status["restoreRate"])
+        if status.get("currentlyAvailable") is not None:
+            available = float(status["currentlyAvailable"])
+            if self.in_flight:
+                # 送信中の他リクエストの見積もり分を二重に戻さないよう、小さい方を採用する
+                available = min(self.currently_available, available)
+            self.currently_available = available
+        if cost.get("actualQueryCost") is not None:
+            self.actual_cost += float(cost["actualQueryCost"])
+        if self._changed is not None:
+            self._changed.set()
+
+    def penalize(self, cost: Optional[Dict[str, Any]] = None) -> None:
+        """THROTTLEDが返ってきた場合、残量を0として扱う"""
+        self.throttled += 1
+        self.update(cost)
+        self.currently_available = min(self.currently_available, 0.0)
+
+    def stats(self) -> Dict[str, Any]:
+        self._refill()
+        return {
+            "currently_available": round(self.currently_available, 2),
+            "maximum_available": self.maximum_available,
+            "restore_rate": self.restore_rate,
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+            "requests": self.requests,
+            "throttled": self.throttled,
+            "total_wait_seconds": round(self.total_wait, 3),
+            "max_wait_seconds": round(self.max_wait, 3),
+            "requested_cost": self.requested_cost,
+            "actual_cost": self.actual_cost,
+        }
+
+
+_buckets: Dict[str, CostBucket] = {}
+
+
+def get_cost_bucket(store: str) -> CostBucket:
+    bucket = _buckets.get(store)
+    if bucket is None:
+        bucket = CostBucket()
+        _buckets[store] = bucket
+    return bucket
+
+
+def throttle_stats() -> Dict[str, Dict[str, Any]]:
+    return {store: bucket.stats() for store, bucket in _buckets.items()}
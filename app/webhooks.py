@@ -0,0 +1,311 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import html
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from fastapi import APIRouter, Header, HTTPException, Request
+
+from app.analytics import get_sales_columns
+from app.cache import get_response_cache
+from app.database import get_db
+from app.mirror import MAX_BATCH_WRITES, store_key, write_records
+from app.rfm import apply_orders
+from app.resilience import detach
+from app.search import get_search_indexes
+
+router = APIRouter()
+
+# 受け付けるトピック -> ミラーのリソース名
+WEBHOOK_TOPICS = {
+    "orders/create": "orders",
+    "orders/updated": "orders",
+    "products/update": "products",
+    "customers/update": "customers",
+}
+
+# キューの上限。溢れた場合は503を返し、Shopifyの再送に任せる
+DEFAULT_QUEUE_SIZE = 10000
+DEFAULT_WORKERS = 4
+# バースト時に同じレコードへの書き込みをまとめるため、バッチを集める最大の待ち時間（秒）
+BATCH_LINGER = 0.2
+# 再送の重複排除のために覚えておくWebhook IDの数
+SEEN_WEBHOOK_IDS = 50000
+
+_TAG_RE = re.compile(r"<[^>]+>")
+
+
+def verify_hmac(body: bytes, signature: Optional[str], secret: str) -> bool:
+    # X-Shopify-Hmac-Sha256: 生のリクエストボディのHMAC-SHA256をBase64エンコードしたもの
+    if not signature:
+        return False
+    digest = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
+    return hmac.compare_digest(base64.b64encode(digest).decode("ascii"), signature)
+
+
+def _price(value: Any) -> Optional[float]:
+    return float(value) if value not in (None, "") else None
+
+
+def order_from_webhook(payload: Dict[str, Any]) -> Dict[str, Any]:
+    # WebhookはREST形式のため、parse_order と同じ形に変換する
+    return {
+        "id": payload["id"],
+        "order_number": payload.get("name"),
+        "customer_id": (payload.get("customer") or {}).get("id"),
+        "total_price": _price(payload.get("total_price")),
+        "created_at": payload.get("created_at"),
+        "updated_at": payload.get("updated_at"),
+        "items": [
+            {
+                "product_id": item.get("product_id"),
+                "variant_id": item.get("variant_id"),
+                "title": item.get("title"),
+                "quantity": item.get("quantity"),
+                "price": _price(item.get("price")),
+            }
+            for item in payload.get("line_items") or []
+        ],
+    }
+
+
+def product_from_webhook(payload: Dict[str, Any]) -> Dict[str, Any]:
+    # GraphQLの description はHTMLを除いたテキストのため、body_html から同じ形にする
+    variants = payload.get("variants") or []
+    image = payload.get("image") or next(iter(payload.get("images") or []), None)
+    return {
+        "id": payload["id"],
+        "name": payload.get("title"),
+        "description": html.unescape(_TAG_RE.sub("", payload.get("body_html") or "")).strip(),
+        "handle": payload.get("handle"),
+        "created_at": payload.get("created_at"),
+        "updated_at": payload.get("updated_at"),
+        "price": variants[0].get("price") if variants else None,
+        "image_url": image.get("src") if image else None,
+    }
+
+
+def customer_from_webhook(payload: Dict[str, Any]) -> Dict[str, Any]:
+    # parse_customer_profile と同じ形にする（REST にない product_subscriber_status はマージで既存値を残す）
+    address = payload.get("default_address")
+    tags = payload.get("tags") or ""
+    display_name = " ".join(name for name in (payload.get("first_name"), payload.get("last_name")) if name)
+    return {
+        "id": payload["id"],
+        "created_at": payload.get("created_at"),
+        "updated_at": payload.get("updated_at"),
+        "display_name": display_name or payload.get("email"),
+        "email": payload.get("email"),
+        "phone": payload.get("phone"),
+        "tags": [tag.strip() for tag in tags.split(",") if tag.strip()],
+        "default_address": {
+            "address1": address.get("address1"),
+            "address2": address.get("address2"),
+            "city": address.get("city"),
+            "country": address.get("country"),
+            "province": address.get("province"),
+            "zip": address.get("zip"),
+        } if address else None,
+    }
+
+
+WEBHOOK_CONVERTERS = {
+    "orders": order_from_webhook,
+    "products": product_from_webhook,
+    "customers": customer_from_webhook,
+}
+
+# (ストア, リソース, レコード)
+_Event = Tuple[str, str, Dict[str, Any]]
+
+
+def coalesce(events: List[_Event]) -> Dict[Tuple[str, str], List[Dict[str, Any]]]:
+    """同じレコードへの複数のイベントは updated_at が最新のものだけを残し、(ストア, リソース)ごとにまとめる"""
+    latest: Dict[Tuple[str, str, Any], Dict[str, Any]] = {}
+    for store, resource, record in events:
+        key = (store, resource, record["id"])
+        current = latest.get(key)
+        if current is None or (record.get("updated_at") or "") >= (current.get("updated_at") or ""):
+            latest[key] = record
+    grouped: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    for (store, resource, _), record in latest.items():
+        grouped.setdefault((store, resource), []).append(record)
+    return grouped
+
+
+class WebhookQueue:
+    """受信したWebhookをプロセス内のキューに積み、ワーカーがまとめてミラーへ書き込む。
+    受信側はキューに積むだけで応答するため、Shopifyの応答期限（5秒）に影響しない。
+    書き込みに失敗したイベントは差分同期（app/sync.py）で補完される。
+    同じレコードのイベントは常に同じワーカーのキューに入れ、古い更新が新しい更新を上書きしないようにする"""
+
+    def __init__(self, db, workers: int = DEFAULT_WORKERS, maxsize: int = DEFAULT_QUEUE_SIZE):
+        self.db = db
+        self.queues: List["asyncio.Queue[_Event]"] = [
+            asyncio.Queue(maxsize=max(1, maxsize // workers)) for _ in range(workers)
+        ]
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._workers = [detach(self._worker(queue)) for queue in self.queues]
+
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.written = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def put(self, webhook_id: Optional[str], store: str, resource: str, record: Dict[str, Any]) -> bool:
+        """キューに積む。再送された重複はFalseを返す。キューが満杯の場合は asyncio.QueueFull を送出する"""
+        if webhook_id:
+            if webhook_id in self._seen:
+                self.duplicates += 1
+                return False
+        queue = self.queues[hash((store, resource, record["id"])) % len(self.queues)]
+        try:
+            queue.put_nowait((store, resource, record))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise
+        if webhook_id:
+            self._seen[webhook_id] = None
+            if len(self._seen) > SEEN_WEBHOOK_IDS:
+                self._seen.popitem(last=False)
+        self.received += 1
+        return True
+
+    async def _worker(self, queue: "asyncio.Queue[_Event]") -> None:
+        while True:
+            events = [await queue.get()]
+            try:
+                # 少し待ってバーストをまとめ、同じレコードへの書き込みを1回にする
+                deadline = asyncio.get_running_loop().time() + BATCH_LINGER
+                while len(events) < MAX_BATCH_WRITES:
+                    timeout = deadline - asyncio.get_running_loop().time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        events.append(await asyncio.wait_for(queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+                await self._write(events)
+            except Exception as e:
+                logging.error(f"Webhook worker failed to process {len(events)} events: {e}")
+            finally:
+                for _ in events:
+                    queue.task_done()
+
+    async def _write(self, events: List[_Event]) -> None:
+        grouped = coalesce(events)
+        self.coalesced += len(events) - sum(len(records) for records in grouped.values())
+        stores = set()
+        for (store, resource), records in grouped.items():
+            try:
+                # RESTのペイロードにないフィールドを消さないようマージする
+                self.written += await asyncio.to_thread(write_records, self.db, store, resource, records, merge=True)
+                stores.add(store)
+                if resource == "products":
+                    get_search_indexes().upsert(store, records)
+                if resource == "orders":
+                    # 編集・キャンセル・返金された注文は売上の列データで置き換える
+                    get_sales_columns().upsert(store, records)
+                    # 新しい注文を顧客サマリー（RFM）に反映する。反映済みの注文は無視される
+                    await asyncio.to_thread(apply_orders, self.db, store, records)
+            except Exception as e:
+                self.failed += len(records)
+                logging.error(f"Failed to write {len(records)} {resource} webhooks for {store}: {e}")
+        for store in stores:
+            await get_response_cache().invalidate(store)
+
+    async def close(self, timeout: float = 8.0) -> None:
+        # 停止時はキューに残ったイベントをできるだけ書き込んでから終了する
+        try:
+            await asyncio.wait_for(asyncio.gather(*(queue.join() for queue in self.queues)), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Dropping {self.queued} queued webhooks on shutdown")
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+
+    @property
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self.queues)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "queued": self.queued,
+            "written": self.written,
+            "coalesced": self.coalesced,
+            "failed": self.failed,
+        }
+
+
+_webhook_queue: Optional[WebhookQueue] = None
+
+
+async def get_webhook_queue() -> WebhookQueue:
+    # ワーカーはイベントループ上で動くため、最初のWebhook受信時に起動する。
+    # Firestoreクライアントの作成は同期処理のため、イベントループを止めないようスレッドで行う
+    global _webhook_queue
+    if _webhook_queue is None:
+        db = await asyncio.to_thread(get_db)
+        # スレッドで待っている間に他のリクエストが作っていれば、そちらを使う
+        if _webhook_queue is None:
+            _webhook_queue = WebhookQueue(
+                db,
+                workers=int(os.getenv("SHOPIFY_WEBHOOK_WORKERS", str(DEFAULT_WORKERS))),
+                maxsize=int(os.getenv("SHOPIFY_WEBHOOK_QUEUE_SIZE", str(DEFAULT_QUEUE_SIZE))),
+            )
+    return _webhook_queue
+
+
+async def close_webhook_queue() -> None:
+    global _webhook_queue
+    queue, _webhook_queue = _webhook_queue, None
+    if queue is not None:
+        await queue.close()
+
+
+@router.post("/webhooks/shopify")
+async def receive_webhook(
+    request: Request,
+    x_shopify_topic: str = Header(...),
+    x_shopify_shop_domain: str = Header(...),
+    x_shopify_hmac_sha256: Optional[str] = Header(default=None),
+    x_shopify_webhook_id: Optional[str] = Header(default=None),
+):
+    secret = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+    if not secret:
+        logging.error("SHOPIFY_WEBHOOK_SECRET is not set")
+        raise HTTPException(status_code=500, detail="Webhook secret is not configured.")
+    body = await request.body()
+    if not verify_hmac(body, x_shopify_hmac_sha256, secret):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature.")
+
+    resource = WEBHOOK_TOPICS.get(x_shopify_topic)
+    if resource is None:
+        # 対象外のトピックも2xxで応答し、Shopifyに再送させない
+        return {"status": "ignored"}
+    try:
+        record = WEBHOOK_CONVERTERS[resource](await request.json())
+    except (ValueError, KeyError, TypeError, AttributeError) as e:
+        logging.error(f"Malformed {x_shopify_topic} webhook from {x_shopify_shop_domain}: {e}")
+        raise HTTPException(status_code=400, detail="Malformed webhook payload.")
+
+    try:
+        queued = (await get_webhook_queue()).put(x_shopify_webhook_id, store_key(x_shopify_shop_domain), resource, record)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Webhook queue is full.")
+    return {"status": "queued" if queued else "duplicate"}
+
+
+@router.get("/webhooks/shopify/stats")
+async def get_webhook_stats():
+    return (await get_webhook_queue()).stats()
@@ -0,0 +1,262 @@
+"""ベンチマーク用のShopify Admin GraphQL APIの代替サーバー。
+
+アプリの SHOPIFY_GRAPHQL_URL を http://127.0.0.1:{port}/{store}/admin/api/{version}/graphql.json に向けて使う。
+件数・明細数・レイテンシ・コストのレート制限（THROTTLED）を指定でき、同じ設定なら同じレスポンスを返す。
+
+    python -m bench.fake_shopify --port 8787 --orders 1000 --line-items 5 --latency-ms 50
+"""
+import argparse
+import asyncio
+import math
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response
+
+from app.throttle import estimate_query_cost
+
+
+@dataclass
+class FakeShopifyConfig:
+    orders: int = 1000
+    products: int = 500
+    customers: int = 200
+    line_items: int = 5
+    latency_ms: float = 30.0
+    # 0の場合はレート制限をしない（残量は常に満タンとして返す）
+    bucket_size: float = 1000.0
+    restore_rate: float = 50.0
+    # 実際のコストは見積もりより小さい（Shopifyと同様に未使用分を返却する）
+    actual_cost_ratio: float = 0.6
+
+
+# レート制限なしの場合に返すバケット（アプリ側のコストバケットでも待たないよう十分大きくする）
+UNLIMITED_BUCKET_SIZE = 1_000_000.0
+UNLIMITED_RESTORE_RATE = 1_000_000.0
+
+
+class _Bucket:
+    def __init__(self, size: float, restore_rate: float):
+        self.size = size
+        self.restore_rate = restore_rate
+        self.available = size
+        self.updated = time.monotonic()
+
+    def take(self, cost: float) -> bool:
+        now = time.monotonic()
+        self.available = min(self.size, self.available + (now - self.updated) * self.restore_rate)
+        self.updated = now
+        if cost > self.available:
+            return False
+        self.available -= cost
+        return True
+
+    def refund(self, amount: float) -> None:
+        self.available = min(self.size, self.available + amount)
+
+
+def _throttle_status(bucket: _Bucket) -> Dict[str, Any]:
+    return {
+        "maximumAvailable": bucket.size,
+        "currentlyAvailable": math.floor(bucket.available),
+        "restoreRate": bucket.restore_rate,
+    }
+
+
+def _gid(kind: str, number: int) -> str:
+    return f"gid://shopify/{kind}/{number}"
+
+
+def _number(gid: str) -> int:
+    return int(gid[gid.rfind('/') + 1:])
+
+
+def _timestamp(number: int) -> str:
+    # 連番から決まる日時（注文番号が大きいほど新しい）
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(1704067200 + number * 3600))
+
+
+def _line_item(order: int, index: int) -> Dict[str, Any]:
+    product = (order * 7 + index) % 500 + 1
+    return {
+        "product": {"id": _gid("Product", product)},
+        "variant": {"id": _gid("ProductVariant", product * 10 + 1)},
+        "title": f"商品 {product}",
+        "quantity": index % 3 + 1,
+        "originalUnitPrice": f"{(product % 50) * 100 + 980}.00",
+    }
+
+
+def _line_items(order: int, total: int, first: int = 10, after: Optional[str] = None) -> Dict[str, Any]:
+    start = int(after) if after else 0
+    end = min(total, start + first)
+    return {
+        "pageInfo": {"hasNextPage": end < total, "endCursor": str(end)},
+        "edges": [{"node": _line_item(order, index)} for index in range(start, end)],
+    }
+
+
+class FakeShopify:
+    def __init__(self, config: FakeShopifyConfig):
+        self.config = config
+        self.buckets: Dict[str, _Bucket] = {}
+        self.requests = 0
+        self.throttled = 0
+
+    def order(self, number: int) -> Dict[str, Any]:
+        return {
+            "id": _gid("Order", number),
+            "name": f"#{1000 + number}",
+            "totalPriceSet": {"shopMoney": {"amount": f"{number % 90 * 110 + 1200}.00"}},
+            "createdAt": _timestamp(number),
+            "updatedAt": _timestamp(number + 1),
+            "customer": {"id": _gid("Customer", number % self.config.customers + 1)},
+            "lineItems": _line_items(number, self.config.line_items),
+        }
+
+    def product(self, number: int) -> Dict[str, Any]:
+        return {
+            "id": _gid("Product", number),
+            "title": f"商品 {number} Organic Cotton T-Shirt",
+            "description": f"オーガニックコットンのTシャツ。サイズ {number % 5 + 1}",
+            "handle": f"product-{number}",
+            "createdAt": _timestamp(number),
+            "updatedAt": _timestamp(number + 1),
+            "variants": {"edges": [{"node": {"id": _gid("ProductVariant", number * 10 + 1), "price": f"{(number % 50) * 100 + 980}.00", "compareAtPrice": None}}]},
+            "images": {"edges": [{"node": {"url": f"https://cdn.example.com/{number}.jpg"}}]},
+        }
+
+    def customer(self, number: int, first: int) -> Dict[str, Any]:
+        # 顧客 n の注文は n, n + customers, n + 2 * customers, ...
+        numbers = list(range(number, self.config.orders + 1, self.config.customers))
+        return {
+            "id": _gid("Customer", number),
+            "createdAt": _timestamp(number),
+            "displayName": f"顧客 {number}",
+            "email": f"customer{number}@example.com",
+            "phone": None,
+            "tags": ["bench"],
+            "productSubscriberStatus": "NEVER_SUBSCRIBED",
+            "lastOrder": {"id": _gid("Order", numbers[-1]), "lineItems": _line_items(numbers[-1], self.config.line_items)} if numbers else None,
+            "defaultAddress": {"address1": "1-1", "address2": None, "city": "渋谷区", "country": "Japan", "province": "東京都", "zip": "150-0001"},
+            "orders": {"edges": [{"node": self.order(n)} for n in numbers[:first]]},
+        }
+
+    def _connection(self, total: int, build, first: int, after: Optional[str]) -> Dict[str, Any]:
+        start = int(after) if after else 0
+        end = min(total, start + first)
+        return {
+            "pageInfo": {"hasNextPage": end < total, "endCursor": str(end)},
+            "edges": [{"cursor": str(n), "node": build(n)} for n in range(start + 1, end + 1)],
+        }
+
+    def resolve(self, query: str, variables: Dict[str, Any]) -> Dict[str, Any]:
+        operation = re.search(r"(?:query|mutation)\s+(\w+)", query)
+        name = operation.group(1) if operation else ""
+        first = int(variables.get("first") or 10)
+        if name in ("GetOrders", "SyncOrders"):
+            return {"orders": self._connection(self.config.orders, self.order, first, variables.get("after"))}
+        if name in ("GetProducts", "SyncProducts"):
+            return {"products": self._connection(self.config.products, self.product, first, variables.get("after"))}
+        if name == "GetProduct":
+            number = _number(variables["id"])
+            return {"product": self.product(number) if number <= self.config.products else None}
+        if name == "GetProductsByIds":
+            return {"nodes": [self.product(_number(gid)) if _number(gid) <= self.config.products else None for gid in variables["ids"]]}
+        if name == "GetCustomerOrders":
+            number = _number(variables["customerId"])
+            return {"customer": self.customer(number, first) if number <= self.config.customers else None}
+        if name == "GetCustomersByIds":
+            return {"nodes": [self.customer(_number(gid), first) if _number(gid) <= self.config.customers else None for gid in variables["ids"]]}
+        if name == "GetOrderLineItems":
+            page_size = int(re.search(r"lineItems\(first: (\d+)", query).group(1))
+            return {
+                f"o{i}": {"lineItems": _line_items(_number(variables[f"id{i}"]), self.config.line_items, page_size, variables[f"after{i}"])}
+                for i in range(len(variables) // 2)
+            }
+        if name == "GetShop":
+            return {"shop": {"id": _gid("Shop", 1)}}
+        raise ValueError(f"Unsupported operation: {name or query[:40]}")
+
+    async def handle(self, store: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        self.requests += 1
+        query, variables = body["query"], body.get("variables") or {}
+        cost = float(estimate_query_cost(query, variables))
+        bucket = self.buckets.setdefault(store, _Bucket(
+            self.config.bucket_size or UNLIMITED_BUCKET_SIZE,
+            self.config.restore_rate if self.config.bucket_size else UNLIMITED_RESTORE_RATE,
+        ))
+        if self.config.latency_ms:
+            await asyncio.sleep(self.config.latency_ms / 1000)
+        if self.config.bucket_size and not bucket.take(cost):
+            self.throttled += 1
+            return {
+                "errors": [{"message": "Throttled", "extensions": {"code": "THROTTLED"}}],
+                "extensions": {"cost": {"requestedQueryCost": cost, "actualQueryCost": None, "throttleStatus": _throttle_status(bucket)}},
+            }
+        actual = math.ceil(cost * self.config.actual_cost_ratio)
+        bucket.refund(cost - actual if self.config.bucket_size else bucket.size)
+        try:
+            data = self.resolve(query, variables)
+        except (KeyError, ValueError) as e:
+            return {"errors": [{"message": str(e)}]}
+        return {
+            "data": data,
+            "extensions": {"cost": {"requestedQueryCost": cost, "actualQueryCost": actual, "throttleStatus": _throttle_status(bucket)}},
+        }
+
+
+def create_fake_shopify_app(config: FakeShopifyConfig) -> FastAPI:
+    app = FastAPI(title="Fake Shopify Admin API")
+    shopify = FakeShopify(config)
+    app.state.shopify = shopify
+
+    @app.post("/{store}/admin/api/{version}/graphql.json")
+    async def graphql(store: str, version: str, request: Request):
+        if not request.headers.get("X-Shopify-Access-Token"):
+            return JSONResponse(status_code=401, content={"errors": "[API] Invalid API key or access token"})
+        return JSONResponse(content=await shopify.handle(store, await request.json()))
+
+    @app.head("/{store}/admin/api/{version}/graphql.json")
+    async def warmup(store: str, version: str):
+        return Response(status_code=401)
+
+    @app.get("/stats")
+    def stats():
+        return {"requests": shopify.requests, "throttled": shopify.throttled}
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8787)
+    parser.add_argument("--orders", type=int, default=FakeShopifyConfig.orders)
+    parser.add_argument("--products", type=int, default=FakeShopifyConfig.products)
+    parser.add_argument("--customers", type=int, default=FakeShopifyConfig.customers)
+    parser.add_argument("--line-items", type=int, default=FakeShopifyConfig.line_items)
+    parser.add_argument("--latency-ms", type=float, default=FakeShopifyConfig.latency_ms)
+    parser.add_argument("--bucket-size", type=float, default=FakeShopifyConfig.bucket_size, help="0でレート制限なし")
+    parser.add_argument("--restore-rate", type=float, default=FakeShopifyConfig.restore_rate)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    config = FakeShopifyConfig(
+        orders=args.orders,
+        products=args.products,
+        customers=args.customers,
+        line_items=args.line_items,
+        latency_ms=args.latency_ms,
+        bucket_size=args.bucket_size,
+        restore_rate=args.restore_rate,
+    )
+    uvicorn.run(create_fake_shopify_app(config), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
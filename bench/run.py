@@ -0,0 +1,404 @@
+"""create_app() の各エンドポイントに固定の並列数で負荷をかけ、レイテンシ・スループット・メモリを計測する。
+
+偽のShopifyサーバー（bench/fake_shopify.py）とアプリ（uvicorn）を別プロセスで起動し、
+シナリオごとに同じ件数のリクエストを送る。Firestoreを使うシナリオは --firestore-emulator を指定した場合だけ実行する。
+
+    python -m bench.run --requests 300 --concurrency 16 --output bench/results.json
+    python -m bench.run --baseline bench/baseline.json             # 基準値と比較し、劣化していれば終了コード1
+    python -m bench.run --save-baseline bench/baseline.json        # 基準値を更新する
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+from app.shopify import SHOPIFY_GRAPHQL_API_VERSION
+
+BENCH_STORE = "bench.myshopify.com"
+BENCH_TOKEN = "shpat_bench"
+WEBHOOK_SECRET = "bench-webhook-secret"
+CREDENTIALS = {"access_token": BENCH_TOKEN, "store_url": BENCH_STORE}
+# items_batch_delete の1リクエストあたりの件数
+BATCH_DELETE_SIZE = 10
+
+# (method, path, json, headers)
+RequestSpec = Tuple[str, str, Optional[Any], Dict[str, str]]
+
+
+@dataclass
+class Scenario:
+    name: str
+    # (リクエストの連番, setup の結果) -> リクエスト
+    request: Callable[[int, Any], RequestSpec]
+    firestore: bool = False
+    # 計測前に1回だけ実行する準備（Firestoreにアイテムを作るなど）
+    setup: Optional[Callable[[httpx.AsyncClient, int], Awaitable[Any]]] = None
+
+
+def _post(path: str, body: Any = None) -> Callable[[int, Any], RequestSpec]:
+    return lambda i, state: ("POST", path, CREDENTIALS if body is None else body, {})
+
+
+def _get(path: str) -> Callable[[int, Any], RequestSpec]:
+    return lambda i, state: ("GET", path, None, {})
+
+
+def _webhook(i: int, state: Any) -> RequestSpec:
+    payload = json.dumps({
+        "id": 900000 + i,
+        "title": f"Webhook product {i}",
+        "body_html": "<p>bench</p>",
+        "handle": f"webhook-product-{i}",
+        "created_at": "2024-01-01T00:00:00Z",
+        "updated_at": "2024-01-02T00:00:00Z",
+        "variants": [{"price": "1200.00"}],
+        "images": [],
+    }).encode("utf-8")
+    signature = base64.b64encode(hmac.new(WEBHOOK_SECRET.encode("utf-8"), payload, hashlib.sha256).digest()).decode("ascii")
+    return ("POST", "/webhooks/shopify", payload, {
+        "Content-Type": "application/json",
+        "X-Shopify-Topic": "products/update",
+        "X-Shopify-Shop-Domain": BENCH_STORE,
+        "X-Shopify-Hmac-Sha256": signature,
+        "X-Shopify-Webhook-Id": f"bench-{i}",
+    })
+
+
+async def _create_items(client: httpx.AsyncClient, count: int) -> List[str]:
+    ids = []
+    for start in range(0, count, 500):
+        items = [{"name": f"bench item {n}", "description": "bench"} for n in range(start, min(count, start + 500))]
+        response = await client.post("/items:batchCreate", json={"items": items})
+        response.raise_for_status()
+        ids.extend(result["id"] for result in response.json()["results"])
+    return ids
+
+
+def _with_items(count: Optional[int] = None, per_request: int = 1) -> Callable[[httpx.AsyncClient, int], Awaitable[List[str]]]:
+    # count を省略した場合はリクエスト数 × per_request 件（削除のシナリオ用）
+    return lambda client, requests: _create_items(client, count or requests * per_request)
+
+
+def _run_task(task: str) -> Callable[[httpx.AsyncClient, int], Awaitable[None]]:
+    # ミラーや顧客サマリーを読むシナリオの前に、偽Shopifyの全件をFirestoreへ取り込む
+    async def setup(client: httpx.AsyncClient, requests: int) -> None:
+        response = await client.post("/tasks/execute", json={"task": task, "credentials": CREDENTIALS})
+        response.raise_for_status()
+    return setup
+
+
+def _batch_update(i: int, ids: List[str]) -> RequestSpec:
+    items = [{"id": item_id, "name": f"updated {i}", "description": "bench"} for item_id in ids]
+    return ("POST", "/items:batchUpdate", {"items": items}, {})
+
+
+def _batch_delete(i: int, ids: List[str]) -> RequestSpec:
+    # リクエストごとに別のアイテムを削除する
+    return ("POST", "/items:batchDelete", {"ids": ids[i * BATCH_DELETE_SIZE:(i + 1) * BATCH_DELETE_SIZE]}, {})
+
+
+def scenarios() -> List[Scenario]:
+    return [
+        Scenario("shopify_products", _post("/shopify/products?limit=50")),
+        Scenario("shopify_products_fields", _post("/shopify/products?limit=50&fields=id,name,price")),
+        Scenario("shopify_product", lambda i, state: ("POST", f"/shopify/products/{i % 100 + 1}", CREDENTIALS, {})),
+        Scenario("shopify_products_batch_get", _post("/shopify/products:batchGet", {"credentials": CREDENTIALS, "ids": list(range(1, 101))})),
+        Scenario("shopify_products_search", lambda i, state: ("POST", f"/shopify/products/search?q=コットン {i % 50}", CREDENTIALS, {})),
+        Scenario("shopify_orders", _post("/shopify/orders?first=250")),
+        Scenario("shopify_orders_fields", _post("/shopify/orders?first=250&fields=id,total_price,created_at")),
+        Scenario("shopify_orders_stream", _post("/shopify/orders?stream=true&max_rows=1000")),
+        Scenario("shopify_customer_orders", lambda i, state: ("POST", f"/shopify/customers/{i % 100 + 1}/orders?first=10", CREDENTIALS, {})),
+        Scenario("shopify_customers_batch_get", _post("/shopify/customers:batchGet?first=5", {"credentials": CREDENTIALS, "ids": [str(n) for n in range(1, 51)]})),
+        Scenario("shopify_analytics_sales", _post("/shopify/analytics/sales?utc_offset_minutes=540")),
+        Scenario("shopify_fanout_orders", _post("/shopify/fanout/orders?first=50", {"stores": [
+            {"access_token": BENCH_TOKEN, "store_url": f"bench-{n}.myshopify.com"} for n in range(5)
+        ]})),
+        Scenario("stats_throttle", _get("/shopify/throttle")),
+        Scenario("stats_cache", _get("/shopify/cache")),
+        Scenario("stats_resilience", _get("/shopify/resilience")),
+        Scenario("items_create", _post("/items", {"name": "bench item", "description": "bench"}), firestore=True),
+        Scenario("items_list", _get("/items?limit=100"), firestore=True, setup=_with_items(200)),
+        Scenario("items_get", lambda i, ids: ("GET", f"/items/{ids[i % len(ids)]}", None, {}), firestore=True, setup=_with_items(100)),
+        Scenario("items_update", lambda i, ids: ("PUT", f"/items/{ids[i % len(ids)]}", {"name": f"updated {i}"}, {}), firestore=True, setup=_with_items(100)),
+        Scenario("items_batch_get", lambda i, ids: ("POST", "/items:batchGet", {"ids": ids}, {}), firestore=True, setup=_with_items(100)),
+        Scenario("items_batch_update", _batch_update, firestore=True, setup=_with_items(100)),
+        Scenario("items_delete", lambda i, ids: ("DELETE", f"/items/{ids[i]}", None, {}), firestore=True, setup=_with_items()),
+        Scenario("items_batch_delete", _batch_delete, firestore=True, setup=_with_items(per_request=BATCH_DELETE_SIZE)),
+        Scenario("shopify_products_mirror", _post("/shopify/products?limit=50&source=mirror"), firestore=True, setup=_run_task("delta_sync")),
+        Scenario("shopify_orders_mirror", _post("/shopify/orders?first=250&source=mirror"), firestore=True, setup=_run_task("delta_sync")),
+        Scenario(
+            "shopify_customer_summary",
+            lambda i, state: ("POST", f"/shopify/customers/{i % 100 + 1}/summary", CREDENTIALS, {}),
+            firestore=True,
+            setup=_run_task("customer_summaries"),
+        ),
+        Scenario("webhooks_product_update", _webhook, firestore=True),
+    ]
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return round(sorted_values[index], 2)
+
+
+def _rss_kb(pid: int) -> Dict[str, int]:
+    # Linuxのみ。VmRSS: 現在の常駐メモリ、VmHWM: 最大値
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            values = dict(line.split(":", 1) for line in status if line.startswith(("VmRSS", "VmHWM")))
+        return {key: int(value.split()[0]) for key, value in values.items()}
+    except OSError:
+        return {}
+
+
+async def _send(client: httpx.AsyncClient, scenario: Scenario, i: int, state: Any) -> Tuple[float, Any]:
+    """(レイテンシ（ミリ秒）, ステータスコードまたは例外名) を返す"""
+    method, path, body, headers = scenario.request(i, state)
+    content = body if isinstance(body, bytes) else None
+    started = time.perf_counter()
+    try:
+        response = await client.request(method, path, json=None if content is not None else body, content=content, headers=headers)
+        await response.aread()
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    return (time.perf_counter() - started) * 1000, status
+
+
+def _count_error(errors: Dict[str, int], status: Any) -> None:
+    if not isinstance(status, int) or status >= 400:
+        errors[str(status)] = errors.get(str(status), 0) + 1
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenario: Scenario,
+    requests: int,
+    concurrency: int,
+    app_pid: int,
+    warmup: int = 0,
+) -> Dict[str, Any]:
+    # 計測前に warmup 件を送り、接続の確立や初回のインデックス構築を計測から外す
+    state = await scenario.setup(client, requests + warmup) if scenario.setup is not None else None
+    warmup_errors: Dict[str, int] = {}
+    for i in range(warmup):
+        _, status = await _send(client, scenario, requests + i, state)
+        _count_error(warmup_errors, status)
+
+    latencies: List[float] = []
+    errors: Dict[str, int] = {}
+    counter = iter(range(requests))
+
+    async def worker() -> None:
+        for i in counter:
+            latency, status = await _send(client, scenario, i, state)
+            latencies.append(latency)
+            _count_error(errors, status)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "warmup_errors": warmup_errors,
+        "rps": round(requests / elapsed, 1),
+        "p50_ms": _percentile(latencies, 0.50),
+        "p95_ms": _percentile(latencies, 0.95),
+        "p99_ms": _percentile(latencies, 0.99),
+        "max_ms": round(latencies[-1], 2) if latencies else 0.0,
+        "rss_kb": _rss_kb(app_pid).get("VmRSS"),
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """基準値よりp95がtolerance以上遅い、またはrpsがtolerance以上低いシナリオを返す"""
+    regressions = []
+    for name, current in results["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        if base["p95_ms"] and current["p95_ms"] > base["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {base['p95_ms']}ms -> {current['p95_ms']}ms")
+        if base["rps"] and current["rps"] < base["rps"] * (1 - tolerance):
+            regressions.append(f"{name}: rps {base['rps']} -> {current['rps']}")
+        if current["errors"] and not base.get("errors"):
+            regressions.append(f"{name}: errors {current['errors']}")
+    base_peak = (baseline.get("memory") or {}).get("VmHWM")
+    peak = (results.get("memory") or {}).get("VmHWM")
+    if base_peak and peak and peak > base_peak * (1 + tolerance):
+        regressions.append(f"memory: peak RSS {base_peak}kB -> {peak}kB")
+    return regressions
+
+
+def _start(args: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    # 標準エラーは一時ファイルに書く。パイプのままだと誰も読まないため、約64KBで子プロセスのログ出力が止まる
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen([sys.executable, *args], env=env, stdout=subprocess.DEVNULL, stderr=log)
+    process.log = log
+    return process
+
+
+def _log_tail(process: subprocess.Popen, limit: int = 2000) -> str:
+    process.log.seek(max(0, os.fstat(process.log.fileno()).st_size - limit))
+    return process.log.read().decode("utf-8", "replace")
+
+
+async def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url} exited: {_log_tail(process)}")
+            try:
+                if (await client.get(url)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"{url} did not become ready in {timeout}s")
+
+
+async def main_async(args: argparse.Namespace) -> int:
+    env = dict(os.environ)
+    fake = _start([
+        "-m", "bench.fake_shopify",
+        "--port", str(args.fake_port),
+        "--orders", str(args.orders),
+        "--line-items", str(args.line_items),
+        "--latency-ms", str(args.latency_ms),
+        "--bucket-size", str(args.bucket_size),
+    ], env)
+
+    env.update({
+        "ENVIRONMENT": "bench",
+        "SHOPIFY_GRAPHQL_URL": f"http://127.0.0.1:{args.fake_port}/{{store}}/admin/api/{{version}}/graphql.json",
+        "SHOPIFY_WARMUP_STORES": BENCH_STORE,
+        "SHOPIFY_WEBHOOK_SECRET": WEBHOOK_SECRET,
+        # 毎回Shopify（偽）まで到達させる。キャッシュ込みで計測する場合は --cache
+        "SHOPIFY_CACHE_TTL": env.get("SHOPIFY_CACHE_TTL", "60") if args.cache else "0",
+        "SHOPIFY_CACHE_STALE_TTL": env.get("SHOPIFY_CACHE_STALE_TTL", "300") if args.cache else "0",
+    })
+    if args.firestore_emulator:
+        env["FIRESTORE_EMULATOR_HOST"] = args.firestore_emulator
+    else:
+        env.pop("FIRESTORE_EMULATOR_HOST", None)
+        env["STARTUP_WARMUP"] = "false"
+    app = _start([
+        "-m", "uvicorn", "app.main:app",
+        "--port", str(args.app_port),
+        "--log-level", "warning",
+        "--no-access-log",
+    ], env)
+
+    selected = set(args.scenarios.split(",")) if args.scenarios else None
+    results: Dict[str, Any] = {
+        "config": {
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "concurrency": args.concurrency,
+            "orders": args.orders,
+            "line_items": args.line_items,
+            "latency_ms": args.latency_ms,
+            "bucket_size": args.bucket_size,
+            "cache": args.cache,
+            "shopify_api_version": SHOPIFY_GRAPHQL_API_VERSION,
+            "python": platform.python_version(),
+        },
+        "scenarios": {},
+        "skipped": [],
+    }
+    try:
+        await _wait_ready(f"http://127.0.0.1:{args.fake_port}/stats", fake)
+        await _wait_ready(f"http://127.0.0.1:{args.app_port}/startup", app)
+        limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.app_port}", limits=limits, timeout=60.0) as client:
+            results["startup"] = (await client.get("/startup")).json()
+            for scenario in scenarios():
+                if selected is not None and scenario.name not in selected:
+                    continue
+                if scenario.firestore and not args.firestore_emulator:
+                    results["skipped"].append(scenario.name)
+                    continue
+                result = await run_scenario(client, scenario, args.requests, args.concurrency, app.pid, warmup=args.warmup)
+                results["scenarios"][scenario.name] = result
+                print(
+                    f"{scenario.name:32s} rps={result['rps']:8.1f} p50={result['p50_ms']:8.2f} "
+                    f"p95={result['p95_ms']:8.2f} p99={result['p99_ms']:8.2f} errors={result['errors'] or 0}"
+                    + (f" warmup_errors={result['warmup_errors']}" if result['warmup_errors'] else ""),
+                    flush=True,
+                )
+            results["throttle"] = (await client.get("/shopify/throttle")).json()
+        results["memory"] = _rss_kb(app.pid)
+        results["fake_shopify"] = httpx.get(f"http://127.0.0.1:{args.fake_port}/stats").json()
+    finally:
+        for process in (app, fake):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            process.log.close()
+
+    if results["skipped"]:
+        print(f"skipped (no --firestore-emulator): {', '.join(results['skipped'])}")
+    print(f"memory: {results['memory']}")
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as output:
+            json.dump(results, output, ensure_ascii=False, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        changed = {key for key, value in results["config"].items() if baseline.get("config", {}).get(key) != value}
+        if changed:
+            print(f"warning: config differs from baseline: {', '.join(sorted(changed))}")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("REGRESSIONS:\n  " + "\n  ".join(regressions))
+            return 1
+        print(f"no regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300, help="シナリオごとのリクエスト数")
+    parser.add_argument("--warmup", type=int, default=20, help="シナリオごとに計測前に送るリクエスト数")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--scenarios", help="実行するシナリオ名（カンマ区切り）")
+    parser.add_argument("--orders", type=int, default=1000)
+    parser.add_argument("--line-items", type=int, default=5)
+    parser.add_argument("--latency-ms", type=float, default=30.0)
+    parser.add_argument("--bucket-size", type=float, default=0.0, help="偽Shopifyのコスト上限（0でレート制限なし）")
+    parser.add_argument("--cache", action="store_true", help="Shopifyレスポンスキャッシュを有効にして計測する")
+    parser.add_argument("--firestore-emulator", default=os.getenv("FIRESTORE_EMULATOR_HOST"), help="例: 127.0.0.1:8080")
+    parser.add_argument("--app-port", type=int, default=8790)
+    parser.add_argument("--fake-port", type=int, default=8787)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(main_async(args)))
+
+
+if __name__ == "__main__":
+    main()
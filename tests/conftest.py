@@ -0,0 +1,22 @@
+from types import SimpleNamespace
+
+import httpx
+import pytest_asyncio
+
+
+@pytest_asyncio.fixture
+async def shopify_app(monkeypatch):
+    """create_app() に送るASGIクライアント（client）と、ストアごとのShopifyの応答（shopify）。
+    shopify[ストアのドメイン] に httpx.Request を受けて httpx.Response を返す関数（async可）を登録する"""
+    from app import shopify
+    from app.crud import create_app
+
+    handlers = {}
+    upstream = httpx.AsyncClient(transport=httpx.MockTransport(lambda request: handlers[request.url.host](request)))
+    monkeypatch.setattr(shopify, "get_http_client", lambda store: upstream)
+    transport = httpx.ASGITransport(app=create_app())
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            yield SimpleNamespace(client=client, shopify=handlers)
+    finally:
+        await upstream.aclose()
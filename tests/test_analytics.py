@@ -0,0 +1,101 @@
+import asyncio
+from datetime import date
+import pytest
+from app.analytics import SalesColumns, SalesColumnStore
+
+
+def _order(order_id, created_at, total, items):
+    return {
+        "id": order_id,
+        "created_at": created_at,
+        "total_price": total,
+        "items": [
+            {"product_id": product_id, "variant_id": None, "title": f"P{product_id}", "quantity": quantity, "price": price}
+            for product_id, quantity, price in items
+        ],
+    }
+
+
+def _columns():
+    columns = SalesColumns()
+    columns.upsert([
+        _order(1, "2024-01-01T10:00:00Z", 30.0, [(5, 2, 10.0), (None, 1, 10.0)]),
+        _order(2, "2024-01-01T20:00:00Z", 20.0, [(6, 1, 20.0)]),
+    ])
+    # 追加分は次の集計時に連結される
+    columns.upsert([_order(3, "2024-01-02T01:00:00Z", 50.0, [(6, 2, 25.0)])])
+    return columns
+
+
+def test_summarize_groups_by_day_and_product():
+    summary = _columns().summarize()
+    assert summary["orders"] == 3
+    assert summary["revenue"] == 100.0
+    assert summary["average_order_value"] == round(100 / 3, 2)
+    assert summary["revenue_by_day"] == [
+        {"date": "2024-01-01", "orders": 2, "revenue": 50.0},
+        {"date": "2024-01-02", "orders": 1, "revenue": 50.0},
+    ]
+    # 商品IDのない明細は上位商品に含めない
+    assert [(p["product_id"], p["quantity"], p["revenue"]) for p in summary["top_products"]] == [(6, 3, 70.0), (5, 2, 20.0)]
+
+
+def test_summarize_filters_by_local_date():
+    # 日本時間では 2024-01-01T20:00Z は 1/2 になる
+    summary = _columns().summarize(start=date(2024, 1, 2), end=date(2024, 1, 2), utc_offset_minutes=540)
+    assert summary["orders"] == 2
+    assert summary["revenue_by_day"] == [{"date": "2024-01-02", "orders": 2, "revenue": 70.0}]
+
+
+def test_upsert_replaces_edited_orders():
+    columns = _columns()
+    columns.summarize()
+    # 返金で金額と数量が変わった注文と、同じバッチで2回届いた注文は最後のもので置き換える
+    columns.upsert([
+        _order(1, "2024-01-01T10:00:00Z", 10.0, [(5, 1, 10.0)]),
+        _order(3, "2024-01-02T01:00:00Z", 40.0, [(6, 2, 20.0)]),
+        _order(3, "2024-01-02T01:00:00Z", 25.0, [(6, 1, 25.0)]),
+    ])
+    summary = columns.summarize()
+    assert summary["orders"] == 3
+    assert summary["revenue"] == 55.0
+    assert [(p["product_id"], p["quantity"], p["revenue"]) for p in summary["top_products"]] == [(6, 2, 45.0), (5, 1, 10.0)]
+    assert columns.stats()["line_items"] == 3
+
+
+class _SlowOrders:
+    """1ページ目を返す前に release が設定されるまで待つ注文の一覧"""
+
+    store = "analytics-test.myshopify.com"
+
+    def __init__(self, orders):
+        self.orders = orders
+        self.release = asyncio.Event()
+        self.release.set()
+
+    async def iter_orders(self, after=None):
+        await self.release.wait()
+        rows = [(str(order["id"]), order) for order in self.orders if after is None or order["id"] > int(after)]
+        if rows:
+            yield rows
+
+
+@pytest.mark.asyncio
+async def test_rebuild_runs_in_background_and_swaps_when_done():
+    client = _SlowOrders([_order(1, "2024-01-01T10:00:00Z", 10.0, [])])
+    store = SalesColumnStore(refresh_interval=0, rebuild_interval=0)
+    # 初回は列データがないため読み込みを待つ
+    first = await store.get(client)
+    assert first.summarize()["revenue"] == 10.0
+
+    client.orders = [_order(1, "2024-01-01T10:00:00Z", 4.0, []), _order(2, "2024-01-01T11:00:00Z", 6.0, [])]
+    client.release.clear()
+    # 作り直しの間は待たずに今の列データを返す
+    assert await asyncio.wait_for(store.get(client), 0.1) is first
+    store.upsert(client.store, [_order(3, "2024-01-01T12:00:00Z", 5.0, [])])
+    client.release.set()
+    await asyncio.sleep(0.01)
+    rebuilt = await store.get(client)
+    assert rebuilt is not first
+    # 作り直し中に届いたWebhookの注文も残る
+    assert rebuilt.summarize()["revenue"] == 15.0
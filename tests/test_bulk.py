@@ -0,0 +1,56 @@
+import json
+import pytest
+from types import SimpleNamespace
+from unittest import mock
+from app.bulk import assemble_records, BulkExportJob, BULK_RESOURCES
+from app.parsers import parse_order
+
+ORDER_LINES = [
+    {"id": "gid://shopify/Order/1", "name": "#1001", "createdAt": "2024-01-01T00:00:00Z", "updatedAt": "2024-01-01T00:00:00Z",
+     "totalPriceSet": {"shopMoney": {"amount": "30.0"}}},
+    {"id": "gid://shopify/LineItem/11", "product": {"id": "gid://shopify/Product/5"}, "variant": None,
+     "title": "A", "quantity": 2, "originalUnitPrice": "10.0", "__parentId": "gid://shopify/Order/1"},
+    {"id": "gid://shopify/LineItem/12", "product": None, "variant": None,
+     "title": "B", "quantity": 1, "originalUnitPrice": "10.0", "__parentId": "gid://shopify/Order/1"},
+    {"id": "gid://shopify/Order/2", "name": "#1002", "createdAt": "2024-01-02T00:00:00Z", "updatedAt": "2024-01-02T00:00:00Z",
+     "totalPriceSet": {"shopMoney": {"amount": "5.0"}}},
+]
+
+
+async def _lines(rows):
+    for row in rows:
+        yield json.dumps(row)
+
+
+async def _collect(skip_lines=0):
+    children = BULK_RESOURCES["orders"][1]
+    return [(parse_order(node), next_line) async for node, next_line in assemble_records(_lines(ORDER_LINES), children, skip_lines)]
+
+
+@pytest.mark.asyncio
+async def test_children_are_attached_to_parent():
+    records = await _collect()
+    assert [(order["id"], len(order["items"])) for order, _ in records] == [(1, 2), (2, 0)]
+    assert records[0][0]["items"][0]["product_id"] == 5
+    # 1件目が確定した時点の再開位置は2件目の親の行
+    assert [next_line for _, next_line in records] == [3, 4]
+
+
+@pytest.mark.asyncio
+async def test_resume_skips_committed_lines():
+    records = await _collect(skip_lines=3)
+    assert [order["id"] for order, _ in records] == [2]
+
+
+@pytest.mark.asyncio
+async def test_job_of_another_store_is_not_resumed():
+    db = mock.MagicMock()
+    db.collection.return_value.document.return_value.get.return_value = SimpleNamespace(
+        exists=True,
+        to_dict=lambda: {"store": "other.myshopify.com", "resource": "orders", "status": "importing", "url": "https://signed"},
+    )
+    client = mock.MagicMock(store="mine.myshopify.com")
+    job = BulkExportJob(db, client, "orders", job_id="other.myshopify.com_orders")
+    with pytest.raises(ValueError):
+        await job.run()
+    client.execute_query.assert_not_called()
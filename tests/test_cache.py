@@ -0,0 +1,74 @@
+import asyncio
+import pytest
+from app.cache import ResponseCache
+
+
+def _fetcher(calls, value):
+    async def fetch():
+        calls.append(1)
+        return value
+    return fetch
+
+
+@pytest.mark.asyncio
+async def test_local_hit_and_invalidate():
+    cache = ResponseCache(ttl=60, stale_ttl=60)
+    calls = []
+    fetch = _fetcher(calls, {"data": 1})
+    assert await cache.get_or_fetch("a.myshopify.com", "q", {"x": 1}, fetch) == {"data": 1}
+    assert await cache.get_or_fetch("a.myshopify.com", "q", {"x": 1}, fetch) == {"data": 1}
+    assert len(calls) == 1
+    assert cache.stats()["local_hits"] == 1
+
+    assert await cache.invalidate("a.myshopify.com") == 1
+    await cache.get_or_fetch("a.myshopify.com", "q", {"x": 1}, fetch)
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_while_revalidate():
+    cache = ResponseCache(ttl=0, stale_ttl=60)
+    calls = []
+    await cache.get_or_fetch("s", "q", None, _fetcher(calls, "old"))
+    assert await cache.get_or_fetch("s", "q", None, _fetcher(calls, "new")) == "old"
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert cache.stats()["stale_hits"] == 1
+    assert cache.local.get(cache.make_key("s", "q", None))[0] == "new"
+
+
+@pytest.mark.asyncio
+async def test_lru_eviction_by_entries():
+    cache = ResponseCache(max_entries=2)
+    for i in range(3):
+        await cache.get_or_fetch("s", f"q{i}", None, _fetcher([], i))
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.mark.asyncio
+async def test_shared_redis_layer():
+    fakeredis = pytest.importorskip("fakeredis")
+    server = fakeredis.FakeServer()
+    first = ResponseCache(redis_client=fakeredis.FakeAsyncRedis(server=server))
+    second = ResponseCache(redis_client=fakeredis.FakeAsyncRedis(server=server))
+    calls = []
+    await first.get_or_fetch("s", "q", None, _fetcher(calls, {"v": 1}))
+    assert await second.get_or_fetch("s", "q", None, _fetcher(calls, {"v": 2})) == {"v": 1}
+    assert second.stats()["redis_hits"] == 1
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_invalidate_endpoint_requires_valid_credentials(shopify_app):
+    import httpx
+    from app.cache import get_response_cache
+
+    store = "invalidate-test.myshopify.com"
+    shopify_app.shopify[store] = lambda request: httpx.Response(401, json={"errors": "Invalid API key or access token"})
+    await get_response_cache().get_or_fetch(store, "q", {}, _fetcher([], {"data": 1}))
+
+    response = await shopify_app.client.post("/shopify/cache/invalidate", json={"access_token": "wrong", "store_url": store})
+    # 無効なトークンでは他の利用者のキャッシュを消せない
+    assert response.status_code == 401
+    assert await get_response_cache().invalidate(store) == 1
@@ -0,0 +1,23 @@
+from bench.fake_shopify import FakeShopify, FakeShopifyConfig
+from bench.run import compare
+from app.graphql_query import q_get_customer_orders, q_get_orders
+from app.parsers import parse_customer, parse_order
+
+
+def test_fake_payloads_parse_like_shopify():
+    shopify = FakeShopify(FakeShopifyConfig(orders=30, customers=10, line_items=3))
+    orders = shopify.resolve(q_get_orders, {"first": 25})["orders"]
+    assert orders["pageInfo"] == {"hasNextPage": True, "endCursor": "25"}
+    assert parse_order(orders["edges"][0]["node"])["items"][0]["quantity"] == 1
+
+    customer = shopify.resolve(q_get_customer_orders, {"customerId": "gid://shopify/Customer/3", "first": 2})["customer"]
+    parsed = parse_customer(customer)
+    assert [order["id"] for order in parsed["orders"]] == [3, 13]
+    assert len(parsed["last_order"]["items"]) == 3
+
+
+def test_compare_reports_regressions_beyond_tolerance():
+    baseline = {"scenarios": {"orders": {"p95_ms": 100.0, "rps": 200.0, "errors": {}}}}
+    assert compare({"scenarios": {"orders": {"p95_ms": 115.0, "rps": 190.0, "errors": {}}}}, baseline, 0.2) == []
+    regressions = compare({"scenarios": {"orders": {"p95_ms": 130.0, "rps": 150.0, "errors": {"500": 1}}}}, baseline, 0.2)
+    assert len(regressions) == 3
@@ -0,0 +1,25 @@
+import pytest
+
+from app.fanout import PER_STORE_CONCURRENCY, _store_semaphore
+
+
+@pytest.mark.asyncio
+async def test_fan_out_timeout_is_clamped_to_the_request_deadline(shopify_app):
+    store = "fanout-deadline-test.myshopify.com"
+    # 他のリクエストがストアの同時実行数を使い切っている
+    semaphore = _store_semaphore(store)
+    for _ in range(PER_STORE_CONCURRENCY):
+        await semaphore.acquire()
+    try:
+        response = await shopify_app.client.post(
+            "/shopify/fanout/orders?timeout=60",
+            json={"stores": [{"access_token": "token", "store_url": store}]},
+            headers={"X-Request-Timeout": "0.2"},
+        )
+    finally:
+        for _ in range(PER_STORE_CONCURRENCY):
+            semaphore.release()
+    # 60秒ではなくリクエストの期限で打ち切り、ストアごとのエラーとして返す
+    assert response.status_code == 200
+    assert response.json()["stores"][store]["status"] == "error"
+    assert response.json()["elapsed_ms"] < 1000
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from app.kb_export import KnowledgeBaseExport, build_chunks, split_text
+
+PRODUCT = {"id": 3, "name": "Tシャツ", "description": "", "handle": "t-shirt", "price": "1980.00", "image_url": None}
+
+
+def test_split_text_respects_limit_and_sentences():
+    text = "最初の文です。" * 40 + "\n" + "x" * 250
+    chunks = split_text(text, 100)
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert chunks[0].endswith("。")
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+    # 小数点では区切らない
+    assert split_text("価格は1.5倍です. 次の文", 10) == ["価格は1.5倍です.", "次の文"]
+
+
+def test_each_chunk_starts_with_header_and_has_stable_hash():
+    product = {**PRODUCT, "description": "長い説明。" * 500}
+    chunks = build_chunks("products", product, 1000)
+    assert len(chunks) == 3
+    assert all(chunk["text"].startswith("商品: Tシャツ\n") and len(chunk["text"]) <= 1000 for chunk in chunks)
+    assert [chunk["id"] for chunk in chunks] == ["products-3-0", "products-3-1", "products-3-2"]
+    assert chunks[0]["hash"] == build_chunks("products", product, 1000)[0]["hash"]
+
+
+def test_diff_emits_only_changed_chunks_and_deletes_leftovers():
+    export = KnowledgeBaseExport(mock.MagicMock(), SimpleNamespace(store="a.myshopify.com"), "products", max_chars=1000)
+    long_product = {**PRODUCT, "description": "長い説明。" * 500}
+    previous = [chunk["hash"] for chunk in build_chunks("products", long_product, 1000)]
+
+    lines, updates = export.diff_page([long_product], {"3": previous})
+    assert lines == [] and updates == {}
+
+    lines, updates = export.diff_page([PRODUCT], {"3": previous})
+    assert [(line["op"], line["id"]) for line in lines] == [
+        ("upsert", "products-3-0"), ("delete", "products-3-1"), ("delete", "products-3-2"),
+    ]
+    assert len(updates["3"]) == 1
@@ -0,0 +1,42 @@
+from types import SimpleNamespace
+
+from app.metrics import FIRESTORE_RPC_DURATION, Histogram, instrument_firestore, phase, start_request, _phases
+from app.request_log import request_id_from_headers
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("test_seconds", "Test.", ("route",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, route="/items/{item_id}")
+    lines = histogram.render()
+    assert 'test_seconds_bucket{route="/items/{item_id}",le="0.1"} 2' in lines
+    assert 'test_seconds_bucket{route="/items/{item_id}",le="1"} 3' in lines
+    assert 'test_seconds_bucket{route="/items/{item_id}",le="+Inf"} 4' in lines
+    assert 'test_seconds_count{route="/items/{item_id}"} 4' in lines
+
+
+def test_phases_accumulate_per_request():
+    token = start_request()
+    with phase("parse"):
+        pass
+    with phase("parse"):
+        pass
+    assert set(_phases.get()) == {"parse"}
+    _phases.reset(token)
+
+
+def test_firestore_streaming_rpc_is_timed_at_first_response():
+    api = SimpleNamespace(batch_get_documents=lambda **kwargs: iter(["doc", "more"]), _transport="transport")
+    client = SimpleNamespace(_firestore_api=api, _firestore_api_internal=api)
+    instrument_firestore(client)
+    before = FIRESTORE_RPC_DURATION.snapshot(method="batch_get_documents")["count"]
+    # DocumentReference.get と同じく最初の応答だけを読む
+    assert next(client._firestore_api_internal.batch_get_documents(request={}), None) == "doc"
+    assert FIRESTORE_RPC_DURATION.snapshot(method="batch_get_documents")["count"] == before + 1
+    assert client._firestore_api_internal._transport == "transport"
+
+
+def test_request_id_prefers_header_then_cloud_trace():
+    assert request_id_from_headers({"X-Request-ID": "abc"}) == "abc"
+    assert request_id_from_headers({"X-Cloud-Trace-Context": "105445aa7843bc8b/1;o=1"}) == "105445aa7843bc8b"
+    assert len(request_id_from_headers({})) == 32
@@ -0,0 +1,22 @@
+import pytest
+
+from app.query_builder import build_query, normalize_fields, parse_fields_param
+
+
+def test_customer_orders_do_not_select_the_customer():
+    query = build_query("customer", ("orders",))
+    assert "orders(first: $first)" in query
+    assert "customer { id }" not in query
+    assert "customer { id }" in build_query("orders", normalize_fields("orders", ["customer_id"]))
+
+
+@pytest.mark.parametrize("fields", [",", " , "])
+def test_empty_customer_field_list_is_rejected(fields):
+    with pytest.raises(ValueError, match="No customers fields"):
+        parse_fields_param("customers", fields)
+
+
+def test_required_fields_keep_other_selections_non_empty():
+    assert parse_fields_param("products", ",") == ("id",)
+    with pytest.raises(ValueError, match="Unknown customers fields"):
+        parse_fields_param("customers", "nope")
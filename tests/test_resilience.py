@@ -0,0 +1,145 @@
+import asyncio
+
+import httpx
+import pytest
+
+from app.resilience import BACKOFF_CAP, CircuitBreaker, RetryBudget, backoff_delay, detach, remaining, reset_deadline, set_deadline
+
+EMPTY_ORDERS = {"data": {"orders": {"edges": [], "pageInfo": {"hasNextPage": False, "endCursor": None}}}}
+
+
+def test_retry_budget_stops_retrying_after_repeated_failures():
+    budget = RetryBudget(max_tokens=10, token_ratio=0.1)
+    for _ in range(5):
+        budget.record_failure()
+    assert not budget.allow_retry()
+    # 成功が続けば再び再送できる
+    for _ in range(10):
+        budget.record_success()
+    assert budget.allow_retry()
+
+
+def test_circuit_breaker_opens_and_probes_once():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    breaker.opened_at -= 30
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    # 試行中は他のリクエストを通さない
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_reopens_circuit():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=30)
+    breaker.record_failure()
+    breaker.opened_at -= 30
+    assert breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+    assert breaker.opened == 2
+
+
+def test_backoff_delay_is_capped():
+    assert all(0 <= backoff_delay(attempt) <= BACKOFF_CAP for attempt in range(20))
+
+
+@pytest.mark.asyncio
+async def test_detached_tasks_do_not_inherit_deadline():
+    async def background():
+        return remaining()
+
+    token = set_deadline(1.0)
+    try:
+        assert remaining() is not None
+        assert await detach(background()) is None
+    finally:
+        reset_deadline(token)
+
+
+async def _slow_orders(request):
+    await asyncio.sleep(0.5)
+    return httpx.Response(200, json=EMPTY_ORDERS)
+
+
+@pytest.mark.asyncio
+async def test_coalesced_requests_keep_their_own_request_timeout(shopify_app):
+    store = "deadline-test.myshopify.com"
+    shopify_app.shopify[store] = _slow_orders
+    credentials = {"access_token": "token", "store_url": store}
+    # 同じクエリが1回の呼び出しにまとめられても、期限はそれぞれのリクエストのもの
+    short, long = await asyncio.gather(
+        shopify_app.client.post("/shopify/orders?first=5", json=credentials, headers={"X-Request-Timeout": "0.1"}),
+        shopify_app.client.post("/shopify/orders?first=5", json=credentials, headers={"X-Request-Timeout": "5"}),
+    )
+    assert short.status_code == 504
+    assert long.status_code == 200
+
+
+@pytest.mark.asyncio
+async def test_streams_are_unbounded_for_every_true_spelling(shopify_app, monkeypatch):
+    from app import crud
+
+    store = "stream-deadline-test.myshopify.com"
+    shopify_app.shopify[store] = _slow_orders
+    monkeypatch.setattr(crud, "DEFAULT_DEADLINE", 0.1)
+    credentials = {"access_token": "token", "store_url": store}
+    *streams, bounded = [
+        await shopify_app.client.post(f"/shopify/orders?stream={value}&page_size=1", json=credentials)
+        for value in ("true", "1", "yes", "on", "false")
+    ]
+    # FastAPIが真と解釈する値はすべて期限なしのストリームになる
+    assert all(response.status_code == 200 and "error" not in response.text for response in streams)
+    assert bounded.status_code == 504
+
+
+def _replay(*outcomes):
+    """順に応答を返す（例外は送出する）Shopifyの応答と、受けたリクエストの一覧"""
+    calls = []
+
+    def handler(request):
+        outcome = outcomes[len(calls)]
+        calls.append(request)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    return handler, calls
+
+
+@pytest.mark.asyncio
+async def test_mutations_are_resent_only_when_they_never_reached_shopify(shopify_app):
+    from app.shopify import ShopifyClient, ShopifyUnavailableError
+
+    ok = httpx.Response(200, json={"data": {"bulkOperationRunQuery": {"userErrors": []}}})
+    mutation = "mutation { bulkOperationRunQuery(query: \"{ orders { edges { node { id } } } }\") { userErrors { message } } }"
+
+    store = "mutation-5xx-test.myshopify.com"
+    shopify_app.shopify[store], calls = _replay(httpx.Response(502), ok)
+    # 5xx はShopifyが受け付けた後かもしれないため、二重に実行しないよう再送しない
+    with pytest.raises(ShopifyUnavailableError):
+        await ShopifyClient("token", store).execute_query(mutation)
+    assert len(calls) == 1
+
+    store = "mutation-read-timeout-test.myshopify.com"
+    shopify_app.shopify[store], calls = _replay(httpx.ReadTimeout("timed out"), ok)
+    with pytest.raises(ShopifyUnavailableError):
+        await ShopifyClient("token", store).execute_query(mutation)
+    assert len(calls) == 1
+
+    store = "mutation-connect-test.myshopify.com"
+    shopify_app.shopify[store], calls = _replay(httpx.ConnectError("refused"), ok)
+    # 接続できなかった場合は送られていないため再送する
+    assert await ShopifyClient("token", store).execute_query(mutation) == ok.json()
+    assert len(calls) == 2
+
+    store = "query-5xx-test.myshopify.com"
+    shopify_app.shopify[store], calls = _replay(httpx.Response(502), ok)
+    assert await ShopifyClient("token", store).execute_query("{ shop { name } }") == ok.json()
+    assert len(calls) == 2
@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+from unittest import mock
+
+from google.api_core.exceptions import FailedPrecondition
+
+from app import rfm
+from app.parsers import epoch_seconds
+from app.rfm import _empty_summary, accumulate, apply_orders, apply_scores, compute_breakpoints
+
+NOW = epoch_seconds("2024-07-01T00:00:00Z")
+
+
+def _order(order_id, created_at, total, product_ids, customer_id=1):
+    return {
+        "id": order_id,
+        "customer_id": customer_id,
+        "created_at": created_at,
+        "total_price": total,
+        "items": [{"product_id": product_id, "title": f"P{product_id}"} for product_id in product_ids],
+    }
+
+
+def test_accumulate_tracks_totals_and_recent_products():
+    summary = _empty_summary(1)
+    accumulate(summary, _order(10, "2024-01-01T00:00:00Z", 30.0, [5, 6]))
+    accumulate(summary, _order(11, "2024-02-01T00:00:00Z", 20.0, [6, 7]))
+    assert summary["orders"] == 2
+    assert summary["total_spent"] == 50.0
+    assert summary["first_order_at"] == "2024-01-01T00:00:00Z"
+    assert summary["last_order_at"] == "2024-02-01T00:00:00Z"
+    assert [product["product_id"] for product in summary["recent_products"]] == [6, 7, 5]
+    # 注文IDの一覧は持たない（サマリーの大きさは注文数によらない）
+    assert "order_ids" not in summary
+
+
+def test_accumulate_handles_orders_that_arrive_out_of_order():
+    summary = _empty_summary(1)
+    accumulate(summary, _order(12, "2024-03-01T00:00:00Z", 10.0, [8]))
+    # 過去の注文が後から届いても、最初・最後の購入日と直近の商品の順は日時で決まる
+    accumulate(summary, _order(11, "2024-02-01T00:00:00Z", 20.0, [7]))
+    assert summary["orders"] == 2
+    assert summary["total_spent"] == 30.0
+    assert summary["first_order_at"] == "2024-02-01T00:00:00Z"
+    assert summary["last_order_at"] == "2024-03-01T00:00:00Z"
+    assert [product["product_id"] for product in summary["recent_products"]] == [8, 7]
+
+
+def test_accumulate_compares_timestamps_across_utc_offsets():
+    summary = _empty_summary(1)
+    accumulate(summary, _order(10, "2024-01-01T20:00:00-05:00", 10.0, [1]))
+    # 文字列としては小さいが、UTCでは1時間後
+    accumulate(summary, _order(11, "2024-01-02T02:00:00+00:00", 10.0, [2]))
+    assert summary["first_order_at"] == "2024-01-01T20:00:00-05:00"
+    assert summary["last_order_at"] == "2024-01-02T02:00:00+00:00"
+
+
+def _firestore(monkeypatch, docs):
+    """docs（"リソース/ID" -> データ）を返す顧客サマリー用のFirestore"""
+    db = mock.MagicMock()
+    state = {"breakpoints": {"recency": [], "frequency": [], "monetary": []}, "high_water_order_id": 10}
+    db.collection.return_value.document.return_value.get.return_value = SimpleNamespace(
+        exists=True, to_dict=lambda: {"customer_summaries": state}
+    )
+    updated_at = SimpleNamespace(timestamp_pb=lambda: "t1")
+    db.get_all.side_effect = lambda refs: [
+        SimpleNamespace(id=ref.id, exists=True, update_time=updated_at, to_dict=lambda data=docs[ref.path]: dict(data))
+        for ref in refs if ref.path in docs
+    ]
+    monkeypatch.setattr(rfm, "mirror_collection", lambda db, store, resource: SimpleNamespace(
+        document=lambda doc_id: SimpleNamespace(id=doc_id, path=f"{resource}/{doc_id}")
+    ))
+    return db
+
+
+def test_apply_orders_counts_each_order_once(monkeypatch):
+    summary = {**_empty_summary(1), "orders": 1, "total_spent": 30.0,
+               "first_order_at": "2024-01-01T00:00:00Z", "last_order_at": "2024-01-01T00:00:00Z"}
+    db = _firestore(monkeypatch, {"customer_summaries/1": summary, "customer_summary_orders/12": {"customer_id": 1}})
+    orders = [
+        # 全件集計で数えた注文・目印のある注文・同じバッチで重複した注文は数えない
+        _order(9, "2023-12-01T00:00:00Z", 5.0, []),
+        _order(12, "2024-03-01T00:00:00Z", 50.0, []),
+        _order(11, "2024-02-01T00:00:00Z", 20.0, [7]),
+        _order(11, "2024-02-01T00:00:00Z", 20.0, [7]),
+    ]
+    assert apply_orders(db, "shop", orders) == 1
+    batch = db.batch.return_value
+    ref, record = batch.update.call_args.args
+    assert ref.path == "customer_summaries/1"
+    assert record["orders"] == 2 and record["total_spent"] == 50.0
+    assert [call.args[0].path for call in batch.create.call_args_list] == ["customer_summary_orders/11"]
+    db.write_option.assert_called_with(last_update_time="t1")
+
+
+def test_apply_orders_retries_when_a_summary_was_updated_concurrently(monkeypatch):
+    db = _firestore(monkeypatch, {})
+    batch = db.batch.return_value
+    # 1回目は他のワーカーが先に書き込んでいたため前提条件エラーになる
+    batch.commit.side_effect = [FailedPrecondition("modified"), None]
+    assert apply_orders(db, "shop", [_order(11, "2024-02-01T00:00:00Z", 20.0, [7])]) == 1
+    # 目印とサマリーを読み直して反映し直す
+    assert db.get_all.call_count == 4
+    assert batch.commit.call_count == 2
+
+
+def test_scores_rank_recent_frequent_big_spenders_highest():
+    summaries = []
+    for customer_id in range(1, 6):
+        summary = _empty_summary(customer_id)
+        for n in range(customer_id):
+            accumulate(summary, _order(customer_id * 100 + n, f"2024-0{customer_id}-01T00:00:00Z", 10.0 * customer_id, [1]))
+        summaries.append(summary)
+    breakpoints = compute_breakpoints(summaries, NOW)
+    scored = [apply_scores(summary, breakpoints, NOW) for summary in summaries]
+    assert scored[-1]["rfm"] == "555"
+    assert scored[0]["rfm"] == "111"
+    assert scored[-1]["lifetime_value"] == 250.0
+    assert scored[-1]["average_order_value"] == 50.0
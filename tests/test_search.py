@@ -0,0 +1,39 @@
+from app.search import ProductSearchIndex, tokenize
+
+PRODUCTS = [
+    {"id": 1, "name": "抹茶ラテ", "handle": "matcha-latte", "description": "京都産の抹茶", "price": "680"},
+    {"id": 2, "name": "ほうじ茶ラテ", "handle": "hojicha-latte", "description": None, "price": "620"},
+    {"id": 3, "name": "Blue T-Shirt", "handle": "blue-t-shirt", "description": "Cotton", "price": "2980"},
+]
+
+
+def test_tokenize_uses_bigrams_for_japanese_and_words_for_ascii():
+    assert tokenize("抹茶ラテ") == ["抹茶", "茶ラ", "ラテ"]
+    # 全角英数は半角に正規化する
+    assert tokenize("ＢＬＵＥ Shirt") == ["blue", "shirt"]
+    assert "茶" in tokenize("抹茶", unigrams=True)
+
+
+def test_search_ranks_and_paginates():
+    index = ProductSearchIndex()
+    index.upsert(PRODUCTS)
+    total, hits = index.search("抹茶ラテ")
+    assert total == 2
+    assert [product["id"] for _, product in hits] == [1, 2]
+
+    total, hits = index.search("latte", offset=1, limit=1)
+    assert total == 2 and len(hits) == 1
+
+    total, _ = index.search("ラテ", max_price=650)
+    assert total == 1
+
+
+def test_upsert_replaces_previous_terms():
+    index = ProductSearchIndex()
+    index.upsert(PRODUCTS)
+    index.upsert([{**PRODUCTS[2], "name": "Red Sweater", "handle": "red-sweater", "description": None}])
+    assert index.search("blue")[0] == 0
+    assert index.search("sweater")[0] == 1
+    index.remove([3])
+    assert index.search("sweater")[0] == 0
+    assert "sweater" not in index.postings
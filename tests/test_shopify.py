@@ -0,0 +1,61 @@
+import httpx
+import pytest
+
+from app import shopify
+from app.shopify import close_http_clients, get_http_client, get_shopify_client
+
+
+@pytest.mark.asyncio
+async def test_http_clients_are_bounded_and_evicted_pools_are_closed(monkeypatch):
+    monkeypatch.setattr(shopify, "MAX_HTTP_CLIENTS", 2)
+    first = get_http_client("a.myshopify.com")
+    get_http_client("b.myshopify.com")
+    # 使った順に残す
+    assert get_http_client("a.myshopify.com") is first
+    get_http_client("c.myshopify.com")
+    assert list(shopify._http_clients) == ["a.myshopify.com", "c.myshopify.com"]
+    evicted = next(iter(shopify._retiring_http_clients))
+    await close_http_clients()
+    assert evicted.is_closed and first.is_closed
+    assert not shopify._retiring_http_clients
+
+
+@pytest.mark.asyncio
+async def test_shopify_clients_are_cached_only_after_a_successful_call(shopify_app):
+    store = "client-cache-test.myshopify.com"
+
+    def handler(request):
+        if request.headers["X-Shopify-Access-Token"] != "good":
+            return httpx.Response(401, json={"errors": "Invalid API key or access token"})
+        return httpx.Response(200, json={"data": {"shop": {"name": "s"}}})
+
+    shopify_app.shopify[store] = handler
+    try:
+        bogus = get_shopify_client("bogus", store)
+        with pytest.raises(httpx.HTTPStatusError):
+            await bogus.execute_query("{ shop { name } }")
+        # 失敗したトークンのクライアントは保持しない
+        assert get_shopify_client("bogus", store) is not bogus
+
+        good = get_shopify_client("good", store)
+        await good.execute_query("{ shop { name } }")
+        assert get_shopify_client("good", store) is good
+    finally:
+        await close_http_clients()
+
+
+@pytest.mark.asyncio
+async def test_store_keys_are_normalized_for_every_per_store_cache(shopify_app):
+    from app.cache import get_response_cache
+
+    shopify_app.shopify["mixed-case-test.myshopify.com"] = lambda request: httpx.Response(200, json={"data": {"shop": {"name": "s"}}})
+    try:
+        client = get_shopify_client("token", " https://Mixed-Case-Test.myshopify.com/ ")
+        assert client.store == "mixed-case-test.myshopify.com"
+        assert client.store_url.startswith("https://mixed-case-test.myshopify.com/")
+        await client.cached_query("{ shop { name } }")
+        # Webhookの X-Shopify-Shop-Domain で破棄しても、別の表記で作られたキャッシュが残らない
+        assert await get_response_cache().invalidate("mixed-case-test.myshopify.com") == 1
+        assert get_shopify_client("token", "mixed-case-test.myshopify.com") is client
+    finally:
+        await close_http_clients()
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from app.resilience import remaining, reset_deadline, set_deadline
+from app.singleflight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_waiters_are_bounded_by_their_own_deadline():
+    flight = SingleFlight()
+    seen_deadlines = []
+
+    async def fetch():
+        # 共有の呼び出しは最初の呼び出し元の期限を引き継がない
+        seen_deadlines.append(remaining())
+        await asyncio.sleep(0.3)
+        return "result"
+
+    async def call(timeout):
+        token = set_deadline(timeout)
+        try:
+            return await flight.do("key", fetch)
+        finally:
+            reset_deadline(token)
+
+    results = await asyncio.gather(call(0.05), call(5), return_exceptions=True)
+    assert isinstance(results[0], asyncio.TimeoutError)
+    assert results[1] == "result"
+    assert seen_deadlines == [None]
+    assert flight.stats() == {"executed": 1, "coalesced": 1, "in_flight": 0}
+
+
+@pytest.mark.asyncio
+async def test_shared_call_is_cancelled_when_every_waiter_leaves():
+    flight = SingleFlight()
+    started = asyncio.Event()
+    cancelled = asyncio.Event()
+
+    async def fetch():
+        started.set()
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    waiter = asyncio.ensure_future(flight.do("key", fetch))
+    await started.wait()
+    waiter.cancel()
+    await asyncio.wait_for(cancelled.wait(), 1)
@@ -0,0 +1,20 @@
+import json
+
+from app.startup import phase, startup_report, warmup_stores
+
+
+def test_warmup_stores_fall_back_to_sync_stores(monkeypatch):
+    monkeypatch.delenv("SHOPIFY_WARMUP_STORES", raising=False)
+    monkeypatch.setenv("SHOPIFY_SYNC_STORES", json.dumps([{"store_url": "a.myshopify.com", "access_token": "t"}]))
+    assert warmup_stores() == ["a.myshopify.com"]
+    monkeypatch.setenv("SHOPIFY_WARMUP_STORES", "b.myshopify.com, c.myshopify.com")
+    assert warmup_stores() == ["b.myshopify.com", "c.myshopify.com"]
+
+
+def test_phase_records_duration_even_on_error():
+    try:
+        with phase("test.failing"):
+            raise RuntimeError
+    except RuntimeError:
+        pass
+    assert startup_report()["phases_ms"]["test.failing"] >= 0
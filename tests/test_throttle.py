@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from app.graphql_query import q_get_orders, q_get_customer_orders, q_get_product
+from app.throttle import CostBucket, estimate_query_cost
+
+
+def test_estimate_scales_with_page_size():
+    small = estimate_query_cost(q_get_orders, {"first": 10})
+    large = estimate_query_cost(q_get_orders, {"first": 50})
+    assert large > small * 4
+    assert estimate_query_cost(q_get_customer_orders, {"first": 10}) > small
+
+
+def test_estimate_single_object_query():
+    # product(1) + variants(2 + 1) + images(2 + 1)
+    assert estimate_query_cost(q_get_product, {"id": "gid://shopify/Product/1"}) == 7
+
+
+def test_bucket_tracks_throttle_status():
+    bucket = CostBucket()
+    asyncio.run(bucket.acquire(100))
+    bucket.update({
+        "actualQueryCost": 40,
+        "throttleStatus": {"maximumAvailable": 2000.0, "currentlyAvailable": 1960, "restoreRate": 100.0},
+    })
+    stats = bucket.stats()
+    assert stats["maximum_available"] == 2000.0
+    assert stats["restore_rate"] == 100.0
+    assert stats["currently_available"] >= 1960
+    assert stats["actual_cost"] == 40
+    assert stats["in_flight"] == 0
+
+
+@pytest.mark.asyncio
+async def test_bucket_waits_for_restore():
+    bucket = CostBucket(maximum_available=100.0, restore_rate=1000.0)
+    await bucket.acquire(100)
+    waited = await bucket.acquire(50)
+    assert waited >= 0.04
+    assert bucket.stats()["requests"] == 2
+
+
+@pytest.mark.asyncio
+async def test_waiting_acquire_wakes_when_real_limits_arrive():
+    # 既定値（回復 1/秒）で見積もると約100秒待つが、実際の回復速度がわかった時点で計算し直す
+    bucket = CostBucket(maximum_available=100.0, restore_rate=1.0)
+    await bucket.acquire(100)
+    waiter = asyncio.create_task(bucket.acquire(100))
+    await asyncio.sleep(0.01)
+    bucket.update({"throttleStatus": {"maximumAvailable": 100.0, "currentlyAvailable": 0.0, "restoreRate": 1000.0}})
+    waited = await asyncio.wait_for(waiter, 1)
+    assert waited < 1
@@ -0,0 +1,65 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import threading
+from unittest import mock
+import pytest
+from app import webhooks
+from app.webhooks import coalesce, close_webhook_queue, get_webhook_queue, order_from_webhook, product_from_webhook, verify_hmac
+
+
+def _sign(body: bytes, secret: str) -> str:
+    return base64.b64encode(hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()).decode("ascii")
+
+
+def test_verify_hmac():
+    body = b'{"id": 1}'
+    assert verify_hmac(body, _sign(body, "secret"), "secret")
+    assert not verify_hmac(body, _sign(body, "other"), "secret")
+    assert not verify_hmac(body + b" ", _sign(body, "secret"), "secret")
+    assert not verify_hmac(body, None, "secret")
+
+
+def test_webhook_payloads_match_parsed_shape():
+    order = order_from_webhook({
+        "id": 1, "name": "#1001", "total_price": "30.00", "created_at": "a", "updated_at": "b",
+        "line_items": [{"product_id": 5, "variant_id": None, "title": "A", "quantity": 2, "price": "15.00"}],
+    })
+    assert order["order_number"] == "#1001"
+    assert order["total_price"] == 30.0
+    assert order["items"] == [{"product_id": 5, "variant_id": None, "title": "A", "quantity": 2, "price": 15.0}]
+
+    product = product_from_webhook({"id": 9, "title": "P", "body_html": "<p>Tea &amp; cake</p>", "variants": [], "images": []})
+    assert product["description"] == "Tea & cake"
+    assert product["price"] is None and product["image_url"] is None
+
+
+def test_coalesce_keeps_latest_update_per_record():
+    events = [
+        ("s", "orders", {"id": 1, "updated_at": "2024-01-02"}),
+        ("s", "orders", {"id": 1, "updated_at": "2024-01-01"}),
+        ("s", "orders", {"id": 2, "updated_at": "2024-01-01"}),
+        ("s", "products", {"id": 1, "updated_at": "2024-01-01"}),
+    ]
+    grouped = coalesce(events)
+    assert grouped[("s", "orders")] == [{"id": 1, "updated_at": "2024-01-02"}, {"id": 2, "updated_at": "2024-01-01"}]
+    assert len(grouped[("s", "products")]) == 1
+
+
+@pytest.mark.asyncio
+async def test_webhook_queue_creates_the_firestore_client_off_the_event_loop(monkeypatch):
+    threads = []
+
+    def get_db():
+        threads.append(threading.current_thread())
+        return mock.MagicMock()
+
+    monkeypatch.setattr(webhooks, "get_db", get_db)
+    try:
+        # 同時に届いた最初のWebhookでも、キューは1つだけ作られる
+        first, second = await asyncio.gather(get_webhook_queue(), get_webhook_queue())
+        assert first is second
+    finally:
+        await close_webhook_queue()
+    assert threads and threading.main_thread() not in threads